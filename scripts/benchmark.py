@@ -0,0 +1,623 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Measure the performance of the build tooling on the recipes and on synthetic
+data, optionally comparing the results to a previous run."""
+
+import argparse
+from dataclasses import asdict, dataclass
+import functools
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tarfile
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import zipfile
+from toltec import bash, index, ipk, paths
+from toltec.filecache import FileCache
+from toltec.repo import Repo
+from toltec.util import (
+    argparse_add_verbose,
+    auto_extract,
+    file_sha256,
+    LOGGING_FORMAT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait after creating files so that the cache can record them
+CACHE_SETTLE_DELAY = 2.5
+
+# Version of the format of saved results, bump when the layout changes
+RESULTS_FORMAT = 2
+
+# Benchmarks faster than this in the baseline, in seconds, are too noisy
+# to be compared
+MIN_COMPARED_DURATION = 0.01
+
+# Size of the blocks written to create large files
+BLOCK_SIZE = 1024 * 1024
+
+
+@dataclass
+class Timing:
+    """Summary of the durations of the measured runs of a benchmark."""
+
+    # Shortest duration in seconds, which is the least affected by noise
+    best: float
+
+    # Median duration in seconds
+    median: float
+
+    # Difference between the longest and the shortest duration in seconds
+    spread: float
+
+    @classmethod
+    def from_durations(cls, durations: List[float]) -> "Timing":
+        """Summarize the durations of the measured runs."""
+        return cls(
+            best=min(durations),
+            median=statistics.median(durations),
+            spread=max(durations) - min(durations),
+        )
+
+
+Results = List[Tuple[str, Timing]]
+
+
+def measure(
+    options: argparse.Namespace,
+    action: Callable[[], object],
+    setup: Optional[Callable[[], object]] = None,
+) -> Timing:
+    """
+    Measure the time taken by an action over several runs.
+
+    :param options: options giving the number of warm-up and measured runs
+    :param action: function to call
+    :param setup: function to call before each run, outside of the
+        measured time
+    :returns: summary of the durations of the measured runs
+    """
+    durations = []
+
+    for run in range(options.warmup + options.repeat):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        action()
+        duration = time.perf_counter() - start
+
+        if run >= options.warmup:
+            durations.append(duration)
+
+    return Timing.from_durations(durations)
+
+
+def _remove(path: str) -> None:
+    """Remove a file if it exists."""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _recreate_dir(path: str) -> None:
+    """Create an empty directory, removing any previous one."""
+    shutil.rmtree(path, ignore_errors=True)
+    os.mkdir(path)
+
+
+def make_tree(
+    root: str, small_files: int, huge_files: int, huge_size: int
+) -> int:
+    """
+    Create a synthetic package tree.
+
+    Small files hold a short text, large files are filled with incompressible
+    data to stand for binaries and assets.
+
+    :param root: directory in which to create the tree
+    :param small_files: number of small files to create
+    :param huge_files: number of large files to create
+    :param huge_size: size of each large file, in bytes
+    :returns: total size of the created files, in bytes
+    """
+    total = 0
+
+    for number in range(small_files):
+        directory = os.path.join(
+            root, "opt", "share", f"dir-{number // 100:03}"
+        )
+        os.makedirs(directory, exist_ok=True)
+        contents = f"Synthetic file number {number}\n".encode() * 4
+
+        with open(os.path.join(directory, f"file-{number:05}"), "wb") as file:
+            file.write(contents)
+
+        total += len(contents)
+
+    os.makedirs(os.path.join(root, "opt", "lib"), exist_ok=True)
+    block = os.urandom(BLOCK_SIZE)
+
+    for number in range(huge_files):
+        with open(
+            os.path.join(root, "opt", "lib", f"huge-{number}.bin"), "wb"
+        ) as file:
+            for offset in range(0, huge_size, BLOCK_SIZE):
+                file.write(block[: huge_size - offset])
+
+        total += huge_size
+
+    return total
+
+
+def make_feed(repo_dir: str, count: int) -> List[str]:
+    """
+    Create a repository of small synthetic packages.
+
+    :param repo_dir: directory in which to create the packages
+    :param count: number of packages to create
+    :returns: names of the created archives
+    """
+    filenames = []
+
+    with tempfile.TemporaryDirectory() as pkg_dir:
+        os.makedirs(os.path.join(pkg_dir, "opt", "bin"))
+
+        for number in range(count):
+            name = f"bench-{number:05}"
+            filename = f"{name}_1.0.0-1_armv7-3.2.ipk"
+
+            with open(
+                os.path.join(pkg_dir, "opt", "bin", "bench"), "w"
+            ) as file:
+                file.write(f"#!/bin/sh\necho {name}\n")
+
+            with open(os.path.join(repo_dir, filename), "wb") as file:
+                ipk.make_ipk(
+                    file,
+                    epoch=0,
+                    pkg_dir=pkg_dir,
+                    metadata=f"""Package: {name}
+Description: Synthetic package number {number}
+Homepage: https://toltec-dev.org
+Version: 1.0.0-1
+Section: utils
+Maintainer: Benchmark <bench@example.org>
+License: MIT
+Architecture: armv7-3.2
+""",
+                    scripts={},
+                )
+
+            filenames.append(filename)
+
+    return filenames
+
+
+def bench_index(options: argparse.Namespace) -> Results:
+    """Measure full and incremental index generation on a synthetic feed."""
+    results = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        repo_dir = os.path.join(work_dir, "repo")
+        cache_path = os.path.join(work_dir, "cache.json")
+        os.mkdir(repo_dir)
+
+        logger.info("Creating a feed of %d packages", options.packages)
+        filenames = make_feed(repo_dir, options.packages)
+        time.sleep(CACHE_SETTLE_DELAY)
+
+        def run(
+            name: str,
+            action: Callable[[], None],
+            setup: Optional[Callable[[], None]] = None,
+        ) -> None:
+            results.append((name, measure(options, action, setup)))
+
+        def change_packages() -> None:
+            """Replace 1% of the packages with new archives."""
+            for filename in filenames[::100]:
+                with open(os.path.join(repo_dir, filename), "ab") as file:
+                    file.write(b"\0" * 512)
+
+        run("index/full-cold", lambda: index.make_index(repo_dir))
+        run(
+            "index/full-fill-cache",
+            lambda: index.make_index(repo_dir, cache=FileCache(cache_path)),
+            lambda: _remove(cache_path),
+        )
+        run(
+            "index/full-cached",
+            lambda: index.make_index(repo_dir, cache=FileCache(cache_path)),
+        )
+        run(
+            "index/incremental-unchanged",
+            lambda: index.make_index(
+                repo_dir, cache=FileCache(cache_path), incremental=True
+            ),
+        )
+
+        run(
+            "index/incremental-changed",
+            lambda: index.make_index(
+                repo_dir, cache=FileCache(cache_path), incremental=True
+            ),
+            change_packages,
+        )
+
+    return results
+
+
+def bench_bash(options: argparse.Namespace) -> Results:
+    """Measure parsing the declarations of all the recipes of the tree."""
+    sources = []
+
+    for name in sorted(os.listdir(paths.RECIPE_DIR)):
+        if name[0] != ".":
+            with open(os.path.join(paths.RECIPE_DIR, name, "package")) as file:
+                sources.append(file.read())
+
+    return [
+        (
+            "bash/get-declarations",
+            measure(
+                options,
+                lambda: [bash.get_declarations(src) for src in sources],
+            ),
+        )
+    ]
+
+
+def bench_repo(options: argparse.Namespace) -> Results:
+    """Measure loading all the recipes of the tree."""
+    return [("repo/load", measure(options, Repo))]
+
+
+def _make_ipk(path: str, pkg_dir: str, metadata: str) -> None:
+    """Pack a tree into an ipk package."""
+    with open(path, "wb") as file:
+        ipk.make_ipk(file, 0, pkg_dir, metadata, {})
+
+
+def bench_ipk(options: argparse.Namespace) -> Results:
+    """Measure packing synthetic trees with many small or a few large files."""
+    results = []
+    metadata = """Package: bench
+Description: Synthetic package
+Version: 1.0.0-1
+Section: utils
+Architecture: armv7-3.2
+"""
+
+    for name, small_files, huge_files in (
+        ("ipk/small-files", options.files, 0),
+        ("ipk/huge-files", 0, options.huge_files),
+    ):
+        with tempfile.TemporaryDirectory() as work_dir:
+            pkg_dir = os.path.join(work_dir, "pkg")
+            logger.info("Creating a tree for %s", name)
+            make_tree(pkg_dir, small_files, huge_files, options.huge_size)
+
+            action = functools.partial(
+                _make_ipk,
+                os.path.join(work_dir, "bench.ipk"),
+                pkg_dir,
+                metadata,
+            )
+            results.append((name, measure(options, action)))
+
+    return results
+
+
+def bench_extract(options: argparse.Namespace) -> Results:
+    """Measure extracting large tar and zip source archives."""
+    results = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        tree_dir = os.path.join(work_dir, "tree")
+        logger.info("Creating the archives to extract")
+        make_tree(
+            os.path.join(tree_dir, "bench-1.0"),
+            options.files,
+            options.huge_files,
+            options.huge_size,
+        )
+
+        tar_path = os.path.join(work_dir, "bench.tar.gz")
+        zip_path = os.path.join(work_dir, "bench.zip")
+
+        with tarfile.open(tar_path, "w:gz") as tar_archive:
+            tar_archive.add(os.path.join(tree_dir, "bench-1.0"), "bench-1.0")
+
+        with zipfile.ZipFile(
+            zip_path, "w", zipfile.ZIP_DEFLATED
+        ) as zip_archive:
+            for directory, _, filenames in os.walk(tree_dir):
+                if directory != tree_dir:
+                    zip_archive.write(
+                        directory, os.path.relpath(directory, tree_dir)
+                    )
+
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    zip_archive.write(path, os.path.relpath(path, tree_dir))
+
+        for name, archive_path in (
+            ("extract/tar.gz", tar_path),
+            ("extract/zip", zip_path),
+        ):
+            dest_dir = os.path.join(work_dir, "dest")
+            results.append(
+                (
+                    name,
+                    measure(
+                        options,
+                        functools.partial(auto_extract, archive_path, dest_dir),
+                        functools.partial(_recreate_dir, dest_dir),
+                    ),
+                )
+            )
+
+    return results
+
+
+def bench_sha256(options: argparse.Namespace) -> Results:
+    """Measure the checksum throughput on a large file."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        size = make_tree(work_dir, 0, 1, options.huge_size)
+        path = os.path.join(work_dir, "opt", "lib", "huge-0.bin")
+
+        # Warm-up runs read the file into the page cache
+        timing = measure(options, functools.partial(file_sha256, path))
+        logger.info(
+            "Checksum throughput: %.1f MiB/s", size / timing.best / 2 ** 20
+        )
+        return [("sha256/file", timing)]
+
+
+# Available benchmarks, by name
+BENCHMARKS: Dict[str, Callable[[argparse.Namespace], Results]] = {
+    "bash": bench_bash,
+    "repo": bench_repo,
+    "ipk": bench_ipk,
+    "extract": bench_extract,
+    "index": bench_index,
+    "sha256": bench_sha256,
+}
+
+
+def sizes(options: argparse.Namespace) -> Dict[str, int]:
+    """Get the options which set the size of the synthetic data."""
+    return {
+        "packages": options.packages,
+        "files": options.files,
+        "huge_files": options.huge_files,
+        "huge_size": options.huge_size,
+    }
+
+
+def save_results(
+    path: str, results: Results, options: argparse.Namespace
+) -> None:
+    """
+    Save benchmark results to a JSON file.
+
+    :param path: path of the file to write
+    :param results: timing of each benchmark
+    :param options: options used to run the benchmarks
+    """
+    with open(path + ".tmp", "w") as file:
+        json.dump(
+            {
+                "format": RESULTS_FORMAT,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "options": sizes(options),
+                "repeat": options.repeat,
+                "results": {name: asdict(timing) for name, timing in results},
+            },
+            file,
+            indent=4,
+        )
+
+    os.replace(path + ".tmp", path)
+
+
+def load_results(path: str) -> Dict[str, Any]:
+    """
+    Load benchmark results saved by :func:`save_results`.
+
+    :param path: path of the file to read
+    :returns: saved results and options
+    """
+    with open(path, "r") as file:
+        data = json.load(file)
+
+    if data.get("format") != RESULTS_FORMAT:
+        raise ValueError(f"Unsupported results format in {path}")
+
+    data["results"] = {
+        name: Timing(**timing) for name, timing in data["results"].items()
+    }
+    return data
+
+
+def format_timing(timing: Timing) -> str:
+    """Format the durations of a benchmark for display."""
+    return (
+        f"{timing.best:10.4f} s (median {timing.median:.4f} s, "
+        f"spread {timing.spread:.4f} s)"
+    )
+
+
+def compare_results(
+    results: Results, baseline: Dict[str, Timing], threshold: float
+) -> List[str]:
+    """
+    Print benchmark results next to a baseline and find regressions.
+
+    Benchmarks are compared on their best duration. A benchmark regressed
+    if it slowed down by more than the threshold and by more than the
+    spread of the durations measured in either run, which is noise.
+
+    :param results: timing of each benchmark
+    :param baseline: previous timing of each benchmark
+    :param threshold: relative slowdown above which a benchmark regressed
+    :returns: names of the benchmarks which regressed
+    """
+    regressions = []
+
+    for name, timing in results:
+        if name not in baseline:
+            print(f"{name:40} {format_timing(timing)} {'(new)':>10}")
+            continue
+
+        previous = baseline[name]
+        change = timing.best / previous.best - 1 if previous.best > 0 else 0.0
+        flag = ""
+
+        if (
+            previous.best >= MIN_COMPARED_DURATION
+            and change > threshold
+            and timing.best - previous.best
+            > max(timing.spread, previous.spread)
+        ):
+            regressions.append(name)
+            flag = "  REGRESSION"
+
+        print(f"{name:40} {format_timing(timing)} {change:+10.1%}{flag}")
+
+    return regressions
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "benchmarks",
+    nargs="*",
+    metavar="BENCHMARK",
+    help=f"""benchmarks to run, among {", ".join(sorted(BENCHMARKS))}
+    (default: all)""",
+)
+
+parser.add_argument(
+    "--packages",
+    type=int,
+    default=5000,
+    metavar="N",
+    help="number of packages in synthetic feeds (default: %(default)s)",
+)
+
+parser.add_argument(
+    "--files",
+    type=int,
+    default=5000,
+    metavar="N",
+    help="number of small files in synthetic trees (default: %(default)s)",
+)
+
+parser.add_argument(
+    "--huge-files",
+    type=int,
+    default=3,
+    metavar="N",
+    help="number of large files in synthetic trees (default: %(default)s)",
+)
+
+parser.add_argument(
+    "--huge-size",
+    type=lambda size: int(size) * 1024 * 1024,
+    default=64 * 1024 * 1024,
+    metavar="MIB",
+    help="size of each large file in MiB (default: 64)",
+)
+
+parser.add_argument(
+    "-r",
+    "--repeat",
+    type=int,
+    default=5,
+    metavar="N",
+    help="""number of measured runs of each benchmark, of which the best and
+    median durations are reported (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "-w",
+    "--warmup",
+    type=int,
+    default=1,
+    metavar="N",
+    help="""number of runs of each benchmark before the measured ones
+    (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "-o",
+    "--output",
+    metavar="PATH",
+    help="save the results to a JSON file",
+)
+
+parser.add_argument(
+    "-c",
+    "--compare",
+    metavar="PATH",
+    help="""compare the results to a JSON file saved by a previous run, and
+    exit with an error if any benchmark regressed""",
+)
+
+parser.add_argument(
+    "-t",
+    "--threshold",
+    type=float,
+    default=10,
+    metavar="PERCENT",
+    help="""slowdown above which a benchmark is considered to have regressed
+    (default: %(default)s%%)""",
+)
+
+argparse_add_verbose(parser)
+
+args = parser.parse_args()
+logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+
+for bench in args.benchmarks:
+    if bench not in BENCHMARKS:
+        parser.error(f"unknown benchmark '{bench}'")
+
+if args.repeat < 1:
+    parser.error("at least one measured run is needed")
+
+if args.warmup < 0:
+    parser.error("the number of warm-up runs cannot be negative")
+
+all_results: Results = []
+
+for bench in args.benchmarks or BENCHMARKS:
+    logger.info("Running the %s benchmark", bench)
+    all_results += BENCHMARKS[bench](args)
+
+if args.output is not None:
+    save_results(args.output, all_results, args)
+
+if args.compare is not None:
+    baseline_data = load_results(args.compare)
+
+    if baseline_data["options"] != sizes(args):
+        logger.warning("Baseline was measured on data of a different size")
+
+    if compare_results(
+        all_results, baseline_data["results"], args.threshold / 100
+    ):
+        sys.exit(1)
+else:
+    for bench_name, bench_timing in all_results:
+        print(f"{bench_name:40} {format_timing(bench_timing)}")
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Query the history of past builds."""
+
+import argparse
+from datetime import datetime
+import logging
+import os
+import sys
+import time
+from toltec import paths
+from toltec.builddb import BuildDatabase
+from toltec.util import argparse_add_verbose, LOGGING_FORMAT
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "--database",
+    default=paths.BUILD_DB,
+    metavar="PATH",
+    help="path to the build database (default: %(default)s)",
+)
+
+argparse_add_verbose(parser)
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+slowest_parser = subparsers.add_parser(
+    "slowest", help="list the recipes which take the longest to build"
+)
+
+slowest_parser.add_argument(
+    "--days",
+    type=float,
+    default=30,
+    help="only consider builds from the last N days (default: %(default)s)",
+)
+
+slowest_parser.add_argument(
+    "--limit",
+    type=int,
+    default=10,
+    help="maximum number of recipes to list (default: %(default)s)",
+)
+
+growth_parser = subparsers.add_parser(
+    "growth",
+    help="list packages whose latest archive is larger than the previous one",
+)
+
+growth_parser.add_argument(
+    "--threshold",
+    type=float,
+    default=10,
+    metavar="PERCENT",
+    help="minimum size increase to report (default: %(default)s%%)",
+)
+
+changes_parser = subparsers.add_parser(
+    "changes",
+    help="""list packages which changed between two repository builds
+    (default: the last two, or OLD and the last one)""",
+)
+
+changes_parser.add_argument(
+    "old",
+    nargs="?",
+    type=int,
+    metavar="OLD",
+    help="identifier of the older snapshot",
+)
+
+changes_parser.add_argument(
+    "new",
+    nargs="?",
+    type=int,
+    metavar="NEW",
+    help="identifier of the newer snapshot (default: the latest one)",
+)
+
+subparsers.add_parser("snapshots", help="list the recorded repository builds")
+
+args = parser.parse_args()
+logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+
+if not os.path.isfile(args.database):
+    print(f"No build history at '{args.database}'", file=sys.stderr)
+    sys.exit(1)
+
+database = BuildDatabase(args.database)
+
+if args.command == "slowest":
+    for recipe, count, average, longest in database.slowest_recipes(
+        since=time.time() - args.days * 86400, limit=args.limit
+    ):
+        print(
+            f"{recipe:<30} {average:>8.1f}s average, {longest:>8.1f}s max, "
+            f"{count} build(s)"
+        )
+elif args.command == "growth":
+    for row in database.size_growth(args.threshold / 100):
+        package, old_version, old_size, new_version, new_size = row
+        growth = (new_size / max(old_size, 1) - 1) * 100
+        print(
+            f"{package:<30} {old_size:>10d} B ({old_version}) -> "
+            f"{new_size:>10d} B ({new_version}), +{growth:.1f}%"
+        )
+elif args.command == "changes":
+    latest = database.snapshots(limit=2)
+
+    if args.old is None and len(latest) < 2:
+        print("Need at least two repository builds", file=sys.stderr)
+        sys.exit(1)
+
+    if args.new is None and not latest:
+        print("No repository build recorded", file=sys.stderr)
+        sys.exit(1)
+
+    old = args.old if args.old is not None else latest[1][0]
+    new = args.new if args.new is not None else latest[0][0]
+
+    for package, before, after in database.compare_snapshots(old, new):
+        if before is None:
+            print(f"+ {package} {after}")
+        elif after is None:
+            print(f"- {package} {before}")
+        else:
+            print(f"~ {package} {before} -> {after}")
+elif args.command == "snapshots":
+    for snapshot_id, created, count in database.snapshots(limit=50):
+        date = datetime.fromtimestamp(created)
+        print(f"{snapshot_id:>5d}  {date:%Y-%m-%d %H:%M}  {count} package(s)")
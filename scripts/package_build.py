@@ -5,8 +5,16 @@
 
 import argparse
 import logging
+import os
 import sys
-from toltec.builder import Builder
+from toltec import paths
+from toltec.builddb import BuildDatabase
+from toltec.cli import (
+    argparse_add_build_options,
+    enable_instrumentation,
+    make_builder,
+)
+from toltec.planner import DurationHistory
 from toltec.util import argparse_add_verbose, LOGGING_FORMAT
 
 parser = argparse.ArgumentParser(description=__doc__)
@@ -24,13 +32,26 @@ parser.add_argument(
     help="list of packages to build (default: all packages from the recipe)",
 )
 
+argparse_add_build_options(parser)
 argparse_add_verbose(parser)
 
 args = parser.parse_args()
 logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
-builder = Builder()
 
-if not builder.make(
+enable_instrumentation(args)
+
+database = BuildDatabase(paths.BUILD_DB)
+database.start_run(" ".join(sys.argv))
+builder = make_builder(
+    args,
+    history=DurationHistory(os.path.join(paths.CACHE_DIR, "durations.json")),
+    database=database,
+)
+
+if builder.make(
     args.recipe_name, args.packages_names if args.packages_names else None
 ):
+    database.finish_run(True)
+else:
+    database.finish_run(False)
     sys.exit(1)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Rebuild a package from its previous version and a delta."""
+
+import argparse
+import hashlib
+import logging
+import os
+import sys
+from toltec.delta import DeltaError, apply_delta
+from toltec.util import argparse_add_verbose, LOGGING_FORMAT
+
+logger = logging.getLogger(__name__)
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "old_package",
+    metavar="OLDPACKAGE",
+    help="archive of the previous version of the package",
+)
+
+parser.add_argument(
+    "delta",
+    metavar="DELTA",
+    help="delta from the previous version to the new one",
+)
+
+parser.add_argument(
+    "output",
+    metavar="OUTPUT",
+    help="path at which to save the archive of the new version",
+)
+
+parser.add_argument(
+    "--sha256",
+    metavar="CHECKSUM",
+    help="""expected checksum of the new archive, as listed in the package
+    index (the checksum recorded in the delta is always verified)""",
+)
+
+argparse_add_verbose(parser)
+
+args = parser.parse_args()
+logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+
+with open(args.old_package, "rb") as old_file, open(
+    args.delta, "rb"
+) as delta_file:
+    try:
+        new = apply_delta(old_file.read(), delta_file.read())
+    except DeltaError as err:
+        logger.error("%s", err)
+        sys.exit(1)
+
+if (
+    args.sha256 is not None
+    and hashlib.sha256(new).hexdigest() != args.sha256.lower()
+):
+    logger.error("Rebuilt package does not match the expected checksum")
+    sys.exit(1)
+
+with open(args.output + ".tmp", "wb") as output_file:
+    output_file.write(new)
+
+os.replace(args.output + ".tmp", args.output)
+logger.info("Rebuilt %s (%d bytes)", args.output, len(new))
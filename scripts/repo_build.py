@@ -4,9 +4,23 @@
 """Build all packages and create a package index."""
 
 import argparse
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from toltec.builder import Builder
+import os
+import sys
+from toltec import metrics, paths
+from toltec.builddb import BuildDatabase, recorded_image_digests
+from toltec.cli import (
+    argparse_add_build_options,
+    enable_instrumentation,
+    make_builder,
+)
+from toltec.planner import DurationHistory, PlannedBuild, format_plan, plan
+from toltec.prefetch import Prefetcher
+from toltec.remote import RemoteError
 from toltec.repo import Repo
+from toltec.resources import ResourcePool, limits_for, parse_size
 from toltec.util import argparse_add_verbose, LOGGING_FORMAT
 
 parser = argparse.ArgumentParser(description=__doc__)
@@ -15,9 +29,108 @@ parser.add_argument(
     "-n",
     "--no-fetch",
     action="store_true",
-    help="do not fetch missing packages from the remote repository",
+    help="""do not fetch missing packages, nor the previous versions from which
+    deltas are made, from the remote repository""",
+)
+
+parser.add_argument(
+    "--ignore-changes",
+    action="store_true",
+    help="""do not rebuild recipes that changed since their last successful
+    build without a version change, nor the recipes depending on them""",
 )
 
+parser.add_argument(
+    "--fetch-jobs",
+    type=int,
+    default=8,
+    metavar="N",
+    help="""maximum number of packages to fetch concurrently from the remote
+    repository (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    metavar="N",
+    help="number of recipes to build in parallel (default: %(default)s)",
+)
+
+parser.add_argument(
+    "--prefetch",
+    type=int,
+    default=2,
+    metavar="N",
+    help="""fetch the sources of up to N upcoming recipes while other recipes
+    build, 0 to disable (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "--prefetch-size",
+    type=parse_size,
+    default="4g",
+    metavar="SIZE",
+    help="""stop prefetching sources once the fetched sources waiting for
+    their build take up SIZE (default: 4g)""",
+)
+
+parser.add_argument(
+    "--host-memory",
+    type=parse_size,
+    metavar="SIZE",
+    help="""memory available to parallel builds, e.g. 16g; builds whose memory
+    limit or last recorded peak memory use would exceed it wait for other
+    builds to finish""",
+)
+
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="""print the build plan with its estimated duration and the packages
+    available from the artifact cache, without fetching or building anything""",
+)
+
+parser.add_argument(
+    "--no-deltas",
+    action="store_true",
+    help="""do not generate deltas from the previous to the latest version of
+    each package""",
+)
+
+parser.add_argument(
+    "--delta-max-size",
+    type=parse_size,
+    default="64m",
+    metavar="SIZE",
+    help="""do not generate deltas for packages larger than SIZE, since both
+    versions are decompressed in memory (default: 64m)""",
+)
+
+parser.add_argument(
+    "--strict",
+    action="store_true",
+    help="""fail if packages install the same files without conflicting with
+    each other, instead of only warning about it""",
+)
+
+parser.add_argument(
+    "--metrics",
+    metavar="FILE",
+    help="""write build metrics to FILE at the end of the run, in the
+    Prometheus text format (use a .prom file in the directory of the node
+    exporter textfile collector)""",
+)
+
+parser.add_argument(
+    "--metrics-interval",
+    type=float,
+    metavar="SECONDS",
+    help="also write the metrics periodically while building",
+)
+
+argparse_add_build_options(parser)
 argparse_add_verbose(parser)
 
 group = parser.add_mutually_exclusive_group()
@@ -43,14 +156,157 @@ group.add_argument(
 args = parser.parse_args()
 remote = args.remote_repo if not args.local else None
 logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+logger = logging.getLogger(__name__)
+
+enable_instrumentation(args)
+
+if args.metrics is not None:
+    atexit.register(metrics.write, args.metrics)
+
+    if args.metrics_interval is not None:
+        writer = metrics.PeriodicWriter(args.metrics, args.metrics_interval)
+        writer.start()
+        atexit.register(writer.stop)
 
 repo = Repo()
-builder = Builder()
-missing = repo.fetch_packages(remote, fetch_missing=not args.no_fetch)
+history = DurationHistory(os.path.join(paths.CACHE_DIR, "durations.json"))
+database = BuildDatabase(paths.BUILD_DB) if not args.dry_run else None
+
+if database is not None:
+    database.start_run(" ".join(sys.argv))
+
+builder = make_builder(args, history, database)
+
+try:
+    missing = repo.fetch_packages(
+        remote,
+        fetch_missing=not args.no_fetch and not args.dry_run,
+        jobs=args.fetch_jobs,
+    )
+except RemoteError as err:
+    logger.error("%s", err)
+
+    if database is not None:
+        database.finish_run(False)
+
+    sys.exit(1)
+
+if not args.ignore_changes:
+    for recipe_name in repo.find_changes(remote):
+        missing[recipe_name] = [
+            package.name
+            for package in repo.recipes[recipe_name].packages.values()
+        ]
+
+builds = {
+    recipe_name: packages
+    for recipe_name, packages in missing.items()
+    if packages
+}
+metrics.RECIPES.inc(len(repo.recipes) - len(builds), result="skipped")
+
+# Dry runs take the image digests from previous builds instead of asking
+# Docker, which would pull the missing images
+images = recorded_image_digests(paths.BUILD_DB) if args.dry_run else None
+
+cache_status = {
+    recipe_name: builder.is_cached(recipe_name, packages, images)
+    for recipe_name, packages in builds.items()
+}
+schedule = plan(
+    builds,
+    history,
+    jobs=args.jobs,
+    cached={
+        recipe_name
+        for recipe_name, status in cache_status.items()
+        if status is True
+    },
+    memory={
+        recipe_name: limits_for(builder.limits, recipe_name).memory
+        or history.memory(recipe_name)
+        or 0
+        for recipe_name in builds
+    },
+    host_memory=args.host_memory,
+)
+
+if args.dry_run:
+    print(format_plan(schedule))
+    unknown = sorted(
+        recipe_name
+        for recipe_name, status in cache_status.items()
+        if status is None
+    )
 
-for recipe_name, packages in missing.items():
-    if packages:
-        builder.make(recipe_name, packages)
+    if unknown:
+        print(
+            "Unknown cache status (no recorded image digests): "
+            + ", ".join(unknown)
+        )
+
+    sys.exit(0)
+
+pool = ResourcePool(args.host_memory)
+prefetcher = (
+    Prefetcher(
+        builder,
+        [build.recipe for build in schedule if not build.cached],
+        depth=args.prefetch,
+        max_size=args.prefetch_size,
+    )
+    if args.prefetch > 0
+    else None
+)
+
+if prefetcher is not None:
+    prefetcher.start()
+
+
+def make(build: PlannedBuild) -> bool:
+    """Build a planned recipe once enough memory is available."""
+    pool.acquire(build.memory)
+
+    try:
+        success = builder.make(
+            build.recipe,
+            build.packages,
+            prefetcher.take(build.recipe) if prefetcher is not None else None,
+        )
+    finally:
+        pool.release(build.memory)
+
+    if not success and prefetcher is not None:
+        # Stop downloading ahead as soon as the run is known to fail, the
+        # remaining builds fetch whatever sources they still need
+        prefetcher.cancel()
+
+    return success
+
+
+try:
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(make, schedule))
+finally:
+    if prefetcher is not None:
+        prefetcher.cancel()
+
+built = [build.recipe for build, success in zip(schedule, results) if success]
+
+repo.save_manifest(built)
+
+repo.make_index(database)
+
+if not args.no_deltas:
+    repo.make_deltas(remote if not args.no_fetch else None, args.delta_max_size)
 
-repo.make_index()
 repo.make_listing()
+
+if not repo.check_dependencies(strict=args.strict):
+    if database is not None:
+        database.finish_run(False)
+
+    sys.exit(1)
+
+if database is not None:
+    database.finish_run(all(results))
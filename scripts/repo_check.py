@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Check that a local repository and a remote repository are identical."""
+
+import argparse
+import logging
+import os
+import sys
+from toltec import compare, paths
+from toltec.filecache import FileCache
+from toltec.remote import RemoteError, RemoteRepo
+from toltec.util import argparse_add_verbose, LOGGING_FORMAT
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "local_repo",
+    metavar="LOCALREPO",
+    help="path to the local repository",
+)
+
+parser.add_argument(
+    "remote_repo",
+    nargs="?",
+    default="https://toltec-dev.org/testing",
+    metavar="REMOTEREPO",
+    help="root of the remote repository (default: %(default)s)",
+)
+
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=8,
+    metavar="N",
+    help="""maximum number of packages to fetch and compare concurrently
+    (default: %(default)s)""",
+)
+
+argparse_add_verbose(parser)
+
+args = parser.parse_args()
+logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+logger = logging.getLogger(__name__)
+
+try:
+    report = compare.compare(
+        args.local_repo,
+        RemoteRepo(args.remote_repo, jobs=args.jobs),
+        cache=FileCache(os.path.join(paths.CACHE_DIR, "repo.json")),
+        jobs=args.jobs,
+    )
+except FileNotFoundError:
+    logger.error("Local repository is missing packages index")
+    sys.exit(1)
+except RemoteError as err:
+    logger.error("%s", err)
+    sys.exit(1)
+
+if not report.is_empty():
+    print(report.format())
+    logger.error("Some files differ")
+    sys.exit(1)
+
+logger.info("Successful")
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Find the packages which install given files."""
+
+import argparse
+import fnmatch
+from io import BytesIO
+import logging
+import os
+import re
+import sys
+from typing import IO
+from toltec import paths
+from toltec.contents import CONTENTS_NAME, iter_contents, normalize_path
+from toltec.remote import RemoteRepo
+from toltec.util import argparse_add_verbose, LOGGING_FORMAT
+
+logger = logging.getLogger(__name__)
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "patterns",
+    nargs="+",
+    metavar="PATH",
+    help="""path of an installed file, e.g. /opt/bin/koreader, or shell-style
+    pattern matching several paths, e.g. '/opt/etc/*.conf'""",
+)
+
+parser.add_argument(
+    "-r",
+    "--repo",
+    default=paths.REPO_DIR,
+    metavar="LOCATION",
+    help="""directory or HTTP URL of the repository to search
+    (default: %(default)s)""",
+)
+
+argparse_add_verbose(parser)
+
+args = parser.parse_args()
+logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+
+exact = set()
+globs = []
+
+for pattern in args.patterns:
+    if any(char in pattern for char in "*?["):
+        globs.append(re.compile(fnmatch.translate(normalize_path(pattern))))
+    else:
+        exact.add(normalize_path(pattern))
+
+file: IO[bytes]
+
+if re.match(r"^[a-z]+://", args.repo):
+    data = RemoteRepo(args.repo).fetch_file(CONTENTS_NAME)
+
+    if data is None:
+        logger.error("Remote repository has no contents index")
+        sys.exit(1)
+
+    file = BytesIO(data)
+else:
+    try:
+        file = open(os.path.join(args.repo, CONTENTS_NAME), "rb")
+    except FileNotFoundError:
+        logger.error("Repository has no contents index")
+        sys.exit(1)
+
+found = set()
+
+with file:
+    for installed, packages in iter_contents(file):
+        if installed in exact or any(glob.match(installed) for glob in globs):
+            found.add(installed)
+            print(f"/{installed}: {', '.join(packages)}")
+
+for missing in sorted(exact - found):
+    logger.error("No package installs /%s", missing)
+
+if not found or exact - found:
+    sys.exit(1)
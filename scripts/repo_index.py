@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Generate the package index of a repository from its package archives."""
+
+import argparse
+import logging
+import os
+from toltec import index, paths
+from toltec.filecache import FileCache
+from toltec.util import argparse_add_verbose, LOGGING_FORMAT
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "repo_dir",
+    nargs="?",
+    default=paths.REPO_DIR,
+    metavar="REPODIR",
+    help="repository directory to index (default: %(default)s)",
+)
+
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    metavar="N",
+    help="number of archives to read concurrently (default: number of CPUs)",
+)
+
+parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="read all archives instead of reusing cached metadata",
+)
+
+parser.add_argument(
+    "--full",
+    action="store_true",
+    help="regenerate the whole index instead of updating the existing one",
+)
+
+argparse_add_verbose(parser)
+
+args = parser.parse_args()
+logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+index.make_index(
+    args.repo_dir,
+    jobs=args.jobs,
+    cache=(
+        None
+        if args.no_cache
+        else FileCache(os.path.join(paths.CACHE_DIR, "repo.json"))
+    ),
+    incremental=not args.full,
+)
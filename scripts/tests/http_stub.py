@@ -0,0 +1,159 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Local HTTP server standing in for remote repositories and caches."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import re
+import threading
+import unittest
+from typing import Any, Dict, List, Optional, Tuple
+
+# Date sent in the Last-Modified header of all the served files
+LAST_MODIFIED = "Mon, 01 Feb 2021 00:00:00 GMT"
+
+# Parse the single byte range requests sent by the mirroring engine
+_RANGE_REGEX = re.compile(r"bytes=([0-9]+)-$")
+
+
+class StubServer:
+    """
+    HTTP server serving files from memory in a background thread.
+
+    Files are answered to GET requests with an ETag and a Last-Modified
+    header, honoring conditional and range requests, and are replaced by
+    PUT requests. Status codes queued in :attr:`failures` for a path are
+    sent instead of the file, one per request, before serving it normally.
+    """
+
+    def __init__(self) -> None:
+        """Create a server listening on a free local port."""
+        self.files: Dict[str, bytes] = {}
+        self.failures: Dict[str, List[int]] = {}
+        self.requests: List[Tuple[str, str, Dict[str, str]]] = []
+        self.lock = threading.Lock()
+        self._server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), _make_handler(self)
+        )
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        """Root URL of the server."""
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def requested(self, method: str, path: str) -> List[Dict[str, str]]:
+        """Get the headers of each request made with a method on a path."""
+        with self.lock:
+            return [
+                headers
+                for req_method, req_path, headers in self.requests
+                if req_method == method and req_path == path
+            ]
+
+    def start(self) -> None:
+        """Start answering requests."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop answering requests and close the server."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+def serve(test: unittest.TestCase) -> StubServer:
+    """Start a stub server for the duration of a test."""
+    server = StubServer()
+    server.start()
+    test.addCleanup(server.stop)
+    return server
+
+
+def _make_handler(server: StubServer) -> type:
+    """Create a request handler class bound to a stub server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        """Answer requests from the files of the stub server."""
+
+        # pylint:disable=arguments-differ
+        def log_message(self, *_: Any) -> None:
+            pass
+
+        def _begin(self) -> Optional[int]:
+            """Record a request and get the failure to send for it."""
+            with server.lock:
+                server.requests.append(
+                    (self.command, self.path, dict(self.headers.items()))
+                )
+                queue = server.failures.get(self.path)
+                return queue.pop(0) if queue else None
+
+        def _send(self, status: int, body: bytes = b"", **headers: str) -> None:
+            """Send a complete response."""
+            self.send_response(status)
+            headers["Content-Length"] = str(len(body))
+
+            for name, value in headers.items():
+                self.send_header(name.replace("_", "-"), value)
+
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:  # pylint:disable=invalid-name
+            """Serve a file."""
+            failure = self._begin()
+
+            if failure is not None:
+                self._send(failure)
+                return
+
+            with server.lock:
+                body = server.files.get(self.path)
+
+            if body is None:
+                self._send(404)
+                return
+
+            etag = f'"{hash(body) & 0xFFFFFFFF:x}"'
+
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, ETag=etag)
+                return
+
+            match = _RANGE_REGEX.match(self.headers.get("Range", ""))
+
+            if match is not None:
+                start = int(match.group(1))
+
+                if start >= len(body):
+                    self._send(416)
+                    return
+
+                self._send(
+                    206,
+                    body[start:],
+                    Content_Range=f"bytes {start}-{len(body) - 1}/{len(body)}",
+                    Last_Modified=LAST_MODIFIED,
+                )
+                return
+
+            self._send(200, body, ETag=etag, Last_Modified=LAST_MODIFIED)
+
+        def do_PUT(self) -> None:  # pylint:disable=invalid-name
+            """Store a file."""
+            failure = self._begin()
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+
+            if failure is not None:
+                self._send(failure)
+                return
+
+            with server.lock:
+                server.files[self.path] = body
+
+            self._send(201)
+
+    return Handler
@@ -0,0 +1,162 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Check the artifact cache against a local HTTP server."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import List
+import unittest
+from toltec import ipk
+from toltec.artifacts import ArtifactCache, HTTPBackend
+from toltec.recipe import Recipe
+from tests.http_stub import serve
+
+# Split recipe whose packages are stored in the cache
+RECIPE = """\
+pkgnames=(foo foo-extra)
+pkgdesc="Cached package"
+url=https://example.org/foo
+pkgver=0.1-2
+timestamp=2021-02-01T00:00Z
+section=devel
+maintainer="Cache <cache@example.org>"
+license=GPL-3.0-only
+
+foo() {
+    package() {
+        :
+    }
+}
+
+foo-extra() {
+    package() {
+        :
+    }
+}
+"""
+
+# Cache key under which the packages are stored
+KEY = "0" * 64
+
+
+def _stored_path(filename: str) -> str:
+    """Get the path on the server of a file of the cache entry."""
+    return f"/cache/{KEY}/{filename}"
+
+
+class TestArtifactCache(unittest.TestCase):
+    """Check storing and restoring packages through an HTTP cache."""
+
+    def setUp(self) -> None:
+        self.server = serve(self)
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+
+        self.src_dir = os.path.join(temp_dir, "src")
+        self.dest_dir = os.path.join(temp_dir, "dest")
+        pkg_dir = os.path.join(temp_dir, "pkg")
+
+        for directory in (self.src_dir, self.dest_dir, pkg_dir):
+            os.mkdir(directory)
+
+        with open(os.path.join(pkg_dir, "data.txt"), "w") as file:
+            file.write("data\n")
+
+        self.packages = list(Recipe("foo", RECIPE).packages.values())
+
+        for package in self.packages:
+            path = os.path.join(self.src_dir, package.filename())
+
+            with open(path, "wb") as file:
+                ipk.make_ipk(file, 0, pkg_dir, package.control_fields(), {})
+
+        self.cache = ArtifactCache(HTTPBackend(f"{self.server.url}/cache"))
+
+    def restored(self) -> List[str]:
+        """Get the names of the files in the destination directory."""
+        return sorted(os.listdir(self.dest_dir))
+
+    def test_round_trip(self) -> None:
+        """Check that stored packages are restored unchanged."""
+        self.cache.store(KEY, {"inputs": True}, self.packages, self.src_dir)
+        self.assertTrue(self.cache.contains(KEY, self.packages))
+        self.assertTrue(self.cache.restore(KEY, self.packages, self.dest_dir))
+        self.assertEqual(
+            self.restored(),
+            sorted(package.filename() for package in self.packages),
+        )
+
+        for package in self.packages:
+            with open(
+                os.path.join(self.src_dir, package.filename()), "rb"
+            ) as original, open(
+                os.path.join(self.dest_dir, package.filename()), "rb"
+            ) as restored:
+                self.assertEqual(restored.read(), original.read())
+
+        with self.server.lock:
+            meta = json.loads(self.server.files[_stored_path("meta.json")])
+
+        self.assertEqual(meta["inputs"], {"inputs": True})
+
+    def test_miss(self) -> None:
+        """Check that missing entries and packages are not restored."""
+        self.assertFalse(self.cache.contains(KEY, self.packages))
+        self.assertFalse(self.cache.restore(KEY, self.packages, self.dest_dir))
+
+        self.cache.store(KEY, {}, self.packages[:1], self.src_dir)
+        self.assertFalse(self.cache.contains(KEY, self.packages))
+        self.assertFalse(self.cache.restore(KEY, self.packages, self.dest_dir))
+        self.assertEqual(self.restored(), [])
+
+    def test_corrupted(self) -> None:
+        """Check that corrupted or truncated packages are not restored."""
+        self.cache.store(KEY, {}, self.packages, self.src_dir)
+        path = _stored_path(self.packages[-1].filename())
+        meta_path = _stored_path("meta.json")
+
+        with self.server.lock:
+            original = self.server.files[path]
+            original_meta = self.server.files[meta_path]
+
+        garbage = b"!<arch>\n" + bytes(len(original) - 8)
+        meta = json.loads(original_meta)
+        meta["packages"][self.packages[-1].filename()] = {
+            "sha256": hashlib.sha256(garbage).hexdigest(),
+            "size": len(garbage),
+        }
+
+        for name, (data, meta_data) in {
+            "flipped": (
+                original[:-1] + bytes([original[-1] ^ 1]),
+                original_meta,
+            ),
+            "truncated": (original[: len(original) // 2], original_meta),
+            "not a package": (garbage, json.dumps(meta).encode()),
+        }.items():
+            with self.subTest(corruption=name):
+                with self.server.lock:
+                    self.server.files[path] = data
+                    self.server.files[meta_path] = meta_data
+
+                with self.assertLogs("toltec.artifacts", "WARNING"):
+                    self.assertFalse(
+                        self.cache.restore(KEY, self.packages, self.dest_dir)
+                    )
+
+                self.assertEqual(self.restored(), [])
+
+    def test_read_only(self) -> None:
+        """Check that read-only caches are never written to."""
+        self.cache.read_only = True
+        self.cache.store(KEY, {}, self.packages, self.src_dir)
+
+        with self.server.lock:
+            self.assertEqual(self.server.files, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
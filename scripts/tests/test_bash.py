@@ -0,0 +1,60 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Check the extraction of declarations from Bash scripts."""
+
+import unittest
+from toltec import bash
+
+
+class TestGetDeclarations(unittest.TestCase):
+    """Check that declarations are read back with their exact values."""
+
+    def test_ansi_c_strings(self) -> None:
+        """Check values which Bash prints with ANSI-C quoting."""
+        variables, functions = bash.get_declarations(
+            r"""
+            newline=$'a\nb'
+            quotes=$'it\'s "quoted" \\ $HOME'
+            control=$'\t\x01\e'
+            accent="Mattéo"
+            dollar="$"
+            indexed=($'\t' "$" 'plain')
+            declare -A assoc=([$'k\tk']=$'v\n' [plain]="d\$x")
+            greet() {
+                echo $'\n'
+            }
+            """
+        )
+
+        self.assertEqual(
+            variables,
+            {
+                "newline": "a\nb",
+                "quotes": 'it\'s "quoted" \\ $HOME',
+                "control": "\t\x01\x1b",
+                "accent": "Mattéo",
+                "dollar": "$",
+                "indexed": ["\t", "$", "plain"],
+                "assoc": {"k\tk": "v\n", "plain": "d$x"},
+            },
+        )
+        self.assertEqual(list(functions), ["greet"])
+
+    def test_round_trip(self) -> None:
+        """Check that generated declarations are read back unchanged."""
+        variables: bash.Variables = {
+            "text": "line\nline\t'\"\\$",
+            "unicode": "Mattéo ✓",
+            "empty": "",
+            "unset": None,
+            "indexed": ["a b", None, "c\n"],
+            "assoc": {"key with space": "value\x7f"},
+        }
+        self.assertEqual(
+            bash.get_declarations(bash.put_variables(variables))[0],
+            variables,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Check the detection of recipes that changed since their last build."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from toltec import changes
+from toltec.recipe import Recipe
+
+# Recipe template, with a list of dependencies to fill in
+RECIPE = """\
+pkgnames=({name})
+pkgdesc="Test package"
+url=https://example.org
+pkgver=1.0-1
+timestamp=2021-01-01T00:00Z
+section=utils
+maintainer="Test <test@example.org>"
+license=MIT
+depends=({depends})
+
+package() {{
+    install -D -m 644 -t "$pkgdir"/opt/share "$srcdir"/data.txt
+}}
+"""
+
+
+class TestHashRecipe(unittest.TestCase):
+    """Check that recipe hashes only depend on the contents of recipes."""
+
+    def setUp(self) -> None:
+        self.recipe_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.recipe_dir)
+
+        with open(os.path.join(self.recipe_dir, "package"), "w") as file:
+            file.write(RECIPE.format(name="test", depends=""))
+
+        os.mkdir(os.path.join(self.recipe_dir, "patches"))
+        self.source = os.path.join(self.recipe_dir, "patches", "data.txt")
+
+        with open(self.source, "w") as file:
+            file.write("data\n")
+
+    def test_mtime(self) -> None:
+        """Check that touching files leaves the hash unchanged."""
+        before = changes.hash_recipe(self.recipe_dir)
+
+        for filename in ("package", os.path.join("patches", "data.txt")):
+            os.utime(os.path.join(self.recipe_dir, filename), (0, 0))
+
+        self.assertEqual(changes.hash_recipe(self.recipe_dir), before)
+
+    def test_changed(self) -> None:
+        """Check that the hash covers the contents, names and modes of files."""
+        hashes = {changes.hash_recipe(self.recipe_dir)}
+
+        with open(self.source, "a") as file:
+            file.write("more data\n")
+
+        hashes.add(changes.hash_recipe(self.recipe_dir))
+
+        with open(os.path.join(self.recipe_dir, "extra.txt"), "w") as file:
+            file.write("")
+
+        hashes.add(changes.hash_recipe(self.recipe_dir))
+        os.chmod(self.source, 0o755)
+        hashes.add(changes.hash_recipe(self.recipe_dir))
+
+        self.assertEqual(len(hashes), 4)
+
+
+class TestReverseDependencies(unittest.TestCase):
+    """Check the expansion of changed recipes to their dependents."""
+
+    def setUp(self) -> None:
+        self.recipes = {
+            name: Recipe(name, RECIPE.format(name=name, depends=depends))
+            for name, depends in (
+                ("base", ""),
+                ("lib", "base"),
+                ("app", "'lib (>= 1.0)' other"),
+                ("tool", "app"),
+                ("other", ""),
+            )
+        }
+
+    def test_transitive(self) -> None:
+        """Check that indirect dependents are selected."""
+        self.assertEqual(
+            changes.with_reverse_dependencies(self.recipes, {"base"}),
+            {"base", "lib", "app", "tool"},
+        )
+
+    def test_unrelated(self) -> None:
+        """Check that recipes which do not depend on a selection are left out."""
+        self.assertEqual(
+            changes.with_reverse_dependencies(self.recipes, {"tool"}),
+            {"tool"},
+        )
+        self.assertEqual(
+            changes.with_reverse_dependencies(self.recipes, {"other"}),
+            {"other", "app", "tool"},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Check the contents index and the detection of file collisions."""
+
+import os
+import shutil
+import tempfile
+from typing import Dict, List
+import unittest
+from unittest import mock
+from toltec import index, ipk, paths
+from toltec.contents import CONTENTS_NAME, read_contents
+from toltec.repo import Repo
+from toltec.resolver import check_collisions
+
+# Files installed by each test package, with extra control fields
+PACKAGES = {
+    "foo": (["opt/bin/tool", "opt/share/foo/data"], ""),
+    "bar": (["opt/bin/tool", "opt/share/bar/data"], ""),
+    "baz": (["opt/share/foo/data"], "Conflicts: foo\n"),
+}
+
+
+class TestContents(unittest.TestCase):
+    """Check the contents index of a repository and its uses."""
+
+    def setUp(self) -> None:
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.repo_dir = os.path.join(temp_dir, "repo")
+        os.mkdir(self.repo_dir)
+
+        for name, (files, fields) in PACKAGES.items():
+            pkg_dir = os.path.join(temp_dir, name)
+
+            for path in files:
+                os.makedirs(
+                    os.path.join(pkg_dir, os.path.dirname(path)), exist_ok=True
+                )
+
+                with open(os.path.join(pkg_dir, path), "w") as file:
+                    file.write(f"{name}\n")
+
+            filename = f"{name}_1.0-1_rmall.ipk"
+
+            with open(os.path.join(self.repo_dir, filename), "wb") as file:
+                ipk.make_ipk(
+                    file,
+                    0,
+                    pkg_dir,
+                    f"Package: {name}\nVersion: 1.0-1\n{fields}",
+                    {},
+                )
+
+        index.make_index(self.repo_dir)
+
+        for name, value in (
+            ("REPO_DIR", self.repo_dir),
+            ("RECIPE_DIR", os.path.join(temp_dir, "recipes")),
+        ):
+            patcher = mock.patch.object(paths, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        os.mkdir(paths.RECIPE_DIR)
+
+    def owners(self) -> Dict[str, List[str]]:
+        """Read the contents index of the repository."""
+        return read_contents(os.path.join(self.repo_dir, CONTENTS_NAME))
+
+    def index_text(self) -> str:
+        """Read the package index of the repository."""
+        with open(os.path.join(self.repo_dir, index.INDEX_NAME), "r") as file:
+            return file.read()
+
+    def test_owners(self) -> None:
+        """Check that the index lists the packages installing each file."""
+        self.assertEqual(
+            self.owners(),
+            {
+                "opt/bin/tool": ["bar", "foo"],
+                "opt/share/bar/data": ["bar"],
+                "opt/share/foo/data": ["baz", "foo"],
+            },
+        )
+
+    def test_collisions(self) -> None:
+        """Check that only packages which do not conflict collide."""
+        problems = check_collisions(self.index_text(), self.owners())
+        self.assertEqual(
+            [(problem.package, problem.kind) for problem in problems],
+            [("bar (1.0-1)", "collision")],
+        )
+        self.assertIn("foo (1.0-1)", problems[0].message)
+        self.assertIn("/opt/bin/tool", problems[0].message)
+
+    def test_strict(self) -> None:
+        """Check that collisions only fail the check in strict mode."""
+        repo = Repo()
+
+        with self.assertLogs("toltec.repo", "WARNING") as logs:
+            self.assertTrue(repo.check_dependencies())
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].levelname, "WARNING")
+
+        with self.assertLogs("toltec.repo", "WARNING") as logs:
+            self.assertFalse(repo.check_dependencies(strict=True))
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].levelname, "ERROR")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Check the making and applying of deltas between package versions."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Dict, List
+import unittest
+from unittest import mock
+from toltec import delta, index, ipk, paths
+from toltec.repo import Repo
+from tests.http_stub import serve
+
+# Data shared by all versions of the test package, which does not compress
+SHARED = b"".join(
+    hashlib.sha256(str(number).encode()).digest() for number in range(2048)
+)
+
+
+class TestDelta(unittest.TestCase):
+    """Check deltas between versions of a package."""
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.repo_dir = os.path.join(self.temp_dir, "repo")
+        os.mkdir(self.repo_dir)
+
+    def make_package(self, repo_dir: str, version: str) -> str:
+        """
+        Make an archive of the test package in a repository.
+
+        :returns: path to the archive
+        """
+        pkg_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        os.makedirs(os.path.join(pkg_dir, "opt", "share"))
+
+        with open(
+            os.path.join(pkg_dir, "opt", "share", "shared"), "wb"
+        ) as file:
+            file.write(SHARED)
+
+        with open(
+            os.path.join(pkg_dir, "opt", "share", "version"), "w"
+        ) as file:
+            file.write(f"{version}\n")
+
+        filename = f"foo_{version.split(':', 1)[-1]}_rmall.ipk"
+        path = os.path.join(repo_dir, filename)
+
+        with open(path, "wb") as file:
+            ipk.make_ipk(
+                file,
+                0,
+                pkg_dir,
+                f"Package: foo\nVersion: {version}\nArchitecture: rmall\n",
+                {},
+            )
+
+        return path
+
+    def make_deltas(
+        self, max_size: int = delta.MAX_SIZE
+    ) -> Dict[str, Dict[str, str]]:
+        """
+        Index the repository and make its deltas.
+
+        :returns: fields of each entry of the delta index
+        """
+        index.make_index(self.repo_dir)
+        delta.make_deltas(
+            self.repo_dir,
+            decisions_path=os.path.join(self.temp_dir, "deltas.json"),
+            max_size=max_size,
+        )
+
+        with open(os.path.join(self.repo_dir, delta.DELTA_INDEX_NAME)) as file:
+            return {
+                fields["Delta"]: fields
+                for fields in map(
+                    index.parse_fields, index.split_index(file.read()).values()
+                )
+            }
+
+    def delta_files(self) -> List[str]:
+        """Get the names of the delta files in the repository."""
+        return sorted(os.listdir(os.path.join(self.repo_dir, delta.DELTA_DIR)))
+
+    def assert_applies(self, old_path: str, new_path: str, name: str) -> None:
+        """Check that a delta rebuilds the new archive from the old one."""
+        with open(old_path, "rb") as old_file, open(
+            new_path, "rb"
+        ) as new_file, open(
+            os.path.join(self.repo_dir, delta.DELTA_DIR, name), "rb"
+        ) as delta_file:
+            self.assertEqual(
+                delta.apply_delta(old_file.read(), delta_file.read()),
+                new_file.read(),
+            )
+
+    def test_round_trip(self) -> None:
+        """Check that applying a delta gives back the exact new archive."""
+        old_path = self.make_package(self.repo_dir, "1.0-1")
+        new_path = self.make_package(self.repo_dir, "1.1-1")
+
+        with open(old_path, "rb") as file:
+            old = file.read()
+
+        with open(new_path, "rb") as file:
+            new = file.read()
+
+        data = delta.make_delta(old, new)
+        self.assertLess(len(data), len(new) // 4)
+        self.assertEqual(delta.apply_delta(old, data), new)
+
+    def test_repository(self) -> None:
+        """Check that deltas are made from the previous version."""
+        self.make_package(self.repo_dir, "0.9-1")
+        old_path = self.make_package(self.repo_dir, "1.0-1")
+        new_path = self.make_package(self.repo_dir, "1.1-1")
+        name = "foo_1.1-1_rmall_from_1.0-1.delta"
+
+        entries = self.make_deltas()
+        self.assertEqual(list(entries), [f"{delta.DELTA_DIR}/{name}"])
+        self.assertEqual(
+            entries[f"{delta.DELTA_DIR}/{name}"]["Old-Version"], "1.0-1"
+        )
+        self.assertEqual(self.delta_files(), [name])
+        self.assert_applies(old_path, new_path, name)
+
+    def test_epoch(self) -> None:
+        """Check that epochs are left out of the names of deltas."""
+        old_path = self.make_package(self.repo_dir, "1:1.0-1")
+        new_path = self.make_package(self.repo_dir, "1:1.1-1")
+        name = "foo_1.1-1_rmall_from_1.0-1.delta"
+
+        self.assertEqual(
+            list(self.make_deltas()), [f"{delta.DELTA_DIR}/{name}"]
+        )
+        self.assert_applies(old_path, new_path, name)
+
+    def test_max_size(self) -> None:
+        """Check that no deltas are made for archives above the size limit."""
+        self.make_package(self.repo_dir, "1.0-1")
+        new_path = self.make_package(self.repo_dir, "1.1-1")
+        small = os.path.getsize(new_path) - 1
+
+        self.assertEqual(self.make_deltas(max_size=small), {})
+        self.assertEqual(self.delta_files(), [])
+
+        self.assertEqual(len(self.make_deltas()), 1)
+        self.assertEqual(len(self.delta_files()), 1)
+
+        self.assertEqual(self.make_deltas(max_size=small), {})
+        self.assertEqual(self.delta_files(), [])
+
+    def test_remote(self) -> None:
+        """Check that previous versions are fetched from a remote repository."""
+        server = serve(self)
+        remote_dir = os.path.join(self.temp_dir, "remote")
+        os.mkdir(remote_dir)
+        old_path = self.make_package(remote_dir, "1.0-1")
+        index.make_index(remote_dir)
+
+        for filename in os.listdir(remote_dir):
+            with open(os.path.join(remote_dir, filename), "rb") as file:
+                server.files[f"/{filename}"] = file.read()
+
+        new_path = self.make_package(self.repo_dir, "1.1-1")
+        index.make_index(self.repo_dir)
+
+        for name, value in (
+            ("REPO_DIR", self.repo_dir),
+            ("CACHE_DIR", os.path.join(self.temp_dir, "cache")),
+            ("RECIPE_DIR", os.path.join(self.temp_dir, "recipes")),
+        ):
+            patcher = mock.patch.object(paths, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        os.mkdir(paths.RECIPE_DIR)
+        repo = Repo()
+        repo.make_deltas(None)
+        self.assertEqual(self.delta_files(), [])
+
+        repo.make_deltas(server.url)
+        name = "foo_1.1-1_rmall_from_1.0-1.delta"
+        self.assertEqual(self.delta_files(), [name])
+        self.assert_applies(old_path, new_path, name)
+        self.assertNotIn(os.path.basename(old_path), os.listdir(self.repo_dir))
+        self.assertEqual(
+            len(server.requested("GET", f"/{os.path.basename(old_path)}")), 1
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,219 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Check the install scripts generated for the packages of the repository.
+
+Install scripts only declare the variables and functions that they use.
+They are compared with the expected scripts saved in the install-scripts
+directory, then run with stubbed commands next to scripts declaring
+everything, to check that both behave the same. Set the UPDATE_GOLDEN
+environment variable to rewrite the expected scripts after changing the
+recipes or the install library.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from typing import Dict, Iterable, List, Tuple
+import unittest
+from unittest import mock
+from toltec import bash, maintainer, paths
+from toltec.recipe import Package, Recipe
+
+# Directory containing the expected install scripts
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "install-scripts")
+
+# Arguments with which dpkg or opkg invoke each install script
+ACTIONS = {
+    "preinst": ("install", "upgrade"),
+    "postinst": ("configure",),
+    "prerm": ("upgrade", "remove"),
+    "postrm": ("upgrade", "remove"),
+}
+
+# Stand-in for the external commands called by install scripts, which
+# are looked up in an empty PATH, and exit status returned by the stubs.
+# Calls to functions that a script fails to declare kill the whole script,
+# even from a subshell
+STUB = """\
+command_not_found_handle() {{
+    case $1 in
+        {functions})
+            echo "undeclared function: $1"
+            kill -KILL $$
+            ;;
+    esac
+    echo "$ $*"
+    return {status}
+}}
+"""
+STUB_STATUSES = (0, 1)
+
+# Function of the recipe from which each install script is generated,
+# among those used for the script
+FUNCTIONS = {
+    "preinst": "preinstall",
+    "postinst": "configure",
+    "prerm": "preremove",
+    "postrm": "postremove",
+}
+
+# Constructs which make install scripts keep all declarations
+DYNAMIC_ACCESSES = (
+    'eval "$1"',
+    'echo "${!1}"',
+    "source /dev/null",
+    ". /dev/null",
+)
+
+
+def _keep_all(
+    _script: str, variables: bash.Variables, functions: bash.Functions
+) -> Tuple[bash.Variables, bash.Functions]:
+    """Replacement for the pruning of declarations, keeping everything."""
+    return variables, functions
+
+
+def _run(
+    script: str, functions: Iterable[str], action: str, status: int
+) -> Tuple[int, str]:
+    """
+    Run an install script in a restricted shell with stubbed commands.
+
+    :param script: install script to run
+    :param functions: names of the functions that the script may use
+    :param action: argument passed to the script
+    :param status: exit status of the stubbed commands
+    :returns: exit status and output of the script, with line numbers
+        removed from error messages (the restricted shell also refuses
+        output redirections, which keeps scripts from changing the host)
+    """
+    with tempfile.TemporaryDirectory() as empty_dir:
+        result = subprocess.run(  # pylint:disable=subprocess-run-check
+            [
+                shutil.which("bash") or "bash",
+                "--restricted",
+                "-c",
+                STUB.format(functions="|".join(functions), status=status)
+                + script,
+                "script",
+                action,
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env={"PATH": empty_dir},
+            cwd=empty_dir,
+        )
+
+    return (
+        result.returncode,
+        re.sub(r"line [0-9]+", "line N", result.stdout.decode()),
+    )
+
+
+class TestInstallScripts(unittest.TestCase):
+    """Check the install scripts of the packages of the repository."""
+
+    packages: List[Package] = []
+    variables: bash.Variables = {}
+    functions: bash.Functions = {}
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.variables, cls.functions = bash.get_declarations(
+            maintainer.read_library(
+                os.path.join(paths.SCRIPTS_DIR, "install-lib")
+            )
+        )
+        cls.packages = []
+
+        for name in sorted(os.listdir(paths.RECIPE_DIR)):
+            recipe_dir = os.path.join(paths.RECIPE_DIR, name)
+
+            if os.path.isdir(recipe_dir):
+                recipe = Recipe.from_file(recipe_dir)
+                cls.packages.extend(recipe.packages.values())
+
+    def make_scripts(self, package: Package) -> Dict[str, str]:
+        """Generate the install scripts of a package."""
+        return maintainer.make_scripts(package, self.variables, self.functions)
+
+    def make_full_scripts(self, package: Package) -> Dict[str, str]:
+        """Generate install scripts declaring all variables and functions."""
+        with mock.patch.object(bash, "reachable_declarations", _keep_all):
+            return self.make_scripts(package)
+
+    def test_golden(self) -> None:
+        """Check that install scripts match the expected ones."""
+        update = bool(os.environ.get("UPDATE_GOLDEN"))
+        names = set()
+
+        if update:
+            shutil.rmtree(GOLDEN_DIR, ignore_errors=True)
+            os.makedirs(GOLDEN_DIR)
+
+        for package in self.packages:
+            for name, script in self.make_scripts(package).items():
+                filename = f"{package.name}.{name}"
+                path = os.path.join(GOLDEN_DIR, filename)
+                names.add(filename)
+
+                if update:
+                    with open(path, "w") as file:
+                        file.write(script)
+
+                with self.subTest(script=filename):
+                    with open(path, "r") as file:
+                        self.assertEqual(script, file.read())
+
+        self.assertEqual(set(os.listdir(GOLDEN_DIR)), names)
+
+    def test_behavior(self) -> None:
+        """Check that pruning declarations does not change what scripts do."""
+        for package in self.packages:
+            full = self.make_full_scripts(package)
+            functions = {**self.functions, **package.custom_functions}
+
+            for name, script in self.make_scripts(package).items():
+                for action in ACTIONS[name]:
+                    for status in STUB_STATUSES:
+                        with self.subTest(
+                            package=package.name,
+                            script=name,
+                            action=action,
+                            status=status,
+                        ):
+                            self.assertEqual(
+                                _run(script, functions, action, status),
+                                _run(full[name], functions, action, status),
+                            )
+
+    def test_dynamic_access(self) -> None:
+        """Check that dynamic accesses make scripts keep all declarations."""
+        for package in self.packages:
+            for name, function in FUNCTIONS.items():
+                body = package.functions[function]
+
+                for access in DYNAMIC_ACCESSES:
+                    package.functions[function] = f"{body}\n{access}"
+
+                    try:
+                        script = self.make_scripts(package)[name]
+                        full = self.make_full_scripts(package)[name]
+                    finally:
+                        package.functions[function] = body
+
+                    with self.subTest(
+                        package=package.name, script=name, access=access
+                    ):
+                        self.assertEqual(script, full)
+
+                        for function_name in self.functions:
+                            self.assertIn(f"\n{function_name}() {{", script)
+
+
+if __name__ == "__main__":
+    unittest.main()
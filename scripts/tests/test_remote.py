@@ -0,0 +1,177 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Check the access to remote repositories against a local HTTP server."""
+
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import requests
+from toltec import paths
+from toltec.mirror import Mirror, Transfer
+from toltec.remote import RemoteError, RemoteRepo
+from tests.http_stub import serve
+
+# Package index initially served by the remote repository
+INDEX = """\
+Package: foo
+Version: 1.0-1
+Filename: foo_1.0-1_rmall.ipk
+SHA256sum: 0123
+
+"""
+
+# Package index after a new version of a package was published
+NEW_INDEX = """\
+Package: foo
+Version: 1.0-1
+Filename: foo_1.0-1_rmall.ipk
+SHA256sum: 0123
+
+Package: bar
+Version: 2.0-1
+Filename: bar_2.0-1_rmall.ipk
+SHA256sum: 4567
+
+"""
+
+# Contents of the mirrored file, large enough to be resumed midway
+ARCHIVE = bytes(range(256)) * 64
+
+
+class TestFetchIndex(unittest.TestCase):
+    """Check the conditional fetching of remote indexes."""
+
+    def setUp(self) -> None:
+        self.server = serve(self)
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        patcher = mock.patch.object(paths, "CACHE_DIR", temp_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unchanged(self) -> None:
+        """Check that an unchanged index is reused from the cache."""
+        self.server.files["/Packages.gz"] = gzip.compress(INDEX.encode())
+        first = RemoteRepo(self.server.url).fetch_index()
+        second = RemoteRepo(self.server.url).fetch_index()
+
+        self.assertEqual(set(first), {"foo_1.0-1_rmall.ipk"})
+        self.assertEqual(first["foo_1.0-1_rmall.ipk"]["SHA256sum"], "0123")
+        self.assertEqual(second, first)
+
+        requests_headers = self.server.requested("GET", "/Packages.gz")
+        self.assertEqual(len(requests_headers), 2)
+        self.assertNotIn("If-None-Match", requests_headers[0])
+        self.assertIn("If-None-Match", requests_headers[1])
+        self.assertIn("If-Modified-Since", requests_headers[1])
+
+    def test_changed(self) -> None:
+        """Check that a changed index replaces the cached one."""
+        self.server.files["/Packages.gz"] = gzip.compress(INDEX.encode())
+        RemoteRepo(self.server.url).fetch_index()
+
+        self.server.files["/Packages.gz"] = gzip.compress(NEW_INDEX.encode())
+        self.assertEqual(
+            set(RemoteRepo(self.server.url).fetch_index()),
+            {"foo_1.0-1_rmall.ipk", "bar_2.0-1_rmall.ipk"},
+        )
+
+    def test_missing(self) -> None:
+        """Check that a missing index is an error, not an empty index."""
+        with self.assertRaises(RemoteError):
+            RemoteRepo(self.server.url).fetch_index()
+
+    def test_server_error(self) -> None:
+        """Check that server errors are reported."""
+        self.server.files["/Packages.gz"] = gzip.compress(INDEX.encode())
+        self.server.failures["/Packages.gz"] = [500]
+
+        with self.assertRaises(RemoteError):
+            RemoteRepo(self.server.url).fetch_index()
+
+
+class TestMirror(unittest.TestCase):
+    """Check the verification, resuming and retrying of transfers."""
+
+    def setUp(self) -> None:
+        self.server = serve(self)
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.temp_dir = os.path.join(temp_dir, "partial")
+        self.dest = os.path.join(temp_dir, "archive.ipk")
+        self.server.files["/archive.ipk"] = ARCHIVE
+        session = requests.Session()
+        self.addCleanup(session.close)
+        self.mirror = Mirror(session, self.temp_dir, jobs=2, backoff=0)
+
+    def fetch(self, sha256: str) -> bool:
+        """Mirror the served archive and tell whether it succeeded."""
+        return bool(
+            self.mirror.fetch(
+                [Transfer(f"{self.server.url}/archive.ipk", self.dest, sha256)]
+            )
+        )
+
+    def test_checksum(self) -> None:
+        """Check that files not matching their checksum are rejected."""
+        with self.assertLogs("toltec.mirror", "WARNING"):
+            self.assertFalse(self.fetch(hashlib.sha256(b"other").hexdigest()))
+
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertEqual(os.listdir(self.temp_dir), [])
+        self.assertEqual(
+            len(self.server.requested("GET", "/archive.ipk")),
+            self.mirror.retries + 1,
+        )
+
+    def test_resume(self) -> None:
+        """Check that interrupted transfers resume where they stopped."""
+        os.makedirs(self.temp_dir)
+        offset = len(ARCHIVE) // 3
+
+        with open(
+            os.path.join(self.temp_dir, "archive.ipk.part"), "wb"
+        ) as file:
+            file.write(ARCHIVE[:offset])
+
+        self.assertTrue(self.fetch(hashlib.sha256(ARCHIVE).hexdigest()))
+
+        with open(self.dest, "rb") as file:
+            self.assertEqual(file.read(), ARCHIVE)
+
+        self.assertEqual(
+            [
+                headers.get("Range")
+                for headers in self.server.requested("GET", "/archive.ipk")
+            ],
+            [f"bytes={offset}-"],
+        )
+        self.assertEqual(self.mirror.transferred, len(ARCHIVE) - offset)
+
+    def test_retry(self) -> None:
+        """Check that transfers are retried after transient errors."""
+        self.server.failures["/archive.ipk"] = [503, 429]
+        self.assertTrue(self.fetch(hashlib.sha256(ARCHIVE).hexdigest()))
+        self.assertEqual(len(self.server.requested("GET", "/archive.ipk")), 3)
+
+        with open(self.dest, "rb") as file:
+            self.assertEqual(file.read(), ARCHIVE)
+
+    def test_not_found(self) -> None:
+        """Check that missing files are not retried."""
+        with self.assertLogs("toltec.mirror", "WARNING"):
+            self.assertFalse(
+                self.mirror.fetch(
+                    [Transfer(f"{self.server.url}/missing.ipk", self.dest)]
+                )
+            )
+
+        self.assertEqual(len(self.server.requested("GET", "/missing.ipk")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
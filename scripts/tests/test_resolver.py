@@ -0,0 +1,155 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Check the installability checks of package indexes."""
+
+import textwrap
+from typing import List, Tuple
+import unittest
+from toltec.resolver import check_index
+
+
+def _index(*entries: str) -> str:
+    """Make a package index from entries missing their file names."""
+    return "".join(
+        f"{textwrap.dedent(entry).strip()}\nFilename: {number}.ipk\n\n"
+        for number, entry in enumerate(entries)
+    )
+
+
+def _problems(text: str) -> List[Tuple[str, str]]:
+    """Get the affected package and the kind of each problem of an index."""
+    return [(problem.package, problem.kind) for problem in check_index(text)]
+
+
+class TestCheckIndex(unittest.TestCase):
+    """Check the problems found in package indexes."""
+
+    def test_satisfied(self) -> None:
+        """Check that installable packages have no problems."""
+        self.assertEqual(
+            _problems(
+                _index(
+                    """
+                    Package: app
+                    Version: 1.0-1
+                    Depends: lib (>= 2.0), data | other
+                    """,
+                    """
+                    Package: lib
+                    Version: 2.1-1
+                    """,
+                    """
+                    Package: data
+                    Version: 0.1-1
+                    """,
+                )
+            ),
+            [],
+        )
+
+    def test_unsatisfiable(self) -> None:
+        """Check that dependencies on missing versions are reported."""
+        self.assertEqual(
+            _problems(
+                _index(
+                    """
+                    Package: app
+                    Version: 1.0-1
+                    Depends: lib (>= 2.0)
+                    """,
+                    """
+                    Package: lib
+                    Version: 1.9-1
+                    """,
+                )
+            ),
+            [("app (1.0-1)", "unsatisfiable")],
+        )
+
+    def test_conflict(self) -> None:
+        """Check that packages requiring conflicting packages are reported."""
+        self.assertEqual(
+            _problems(
+                _index(
+                    """
+                    Package: app
+                    Version: 1.0-1
+                    Depends: left
+                    """,
+                    """
+                    Package: left
+                    Version: 1.0-1
+                    Depends: right
+                    """,
+                    """
+                    Package: right
+                    Version: 1.0-1
+                    Conflicts: left (<< 2.0)
+                    """,
+                )
+            ),
+            [("app (1.0-1)", "conflict"), ("left (1.0-1)", "conflict")],
+        )
+
+    def test_external(self) -> None:
+        """Check dependencies outside the repository and virtual packages."""
+        self.assertEqual(
+            _problems(
+                _index(
+                    """
+                    Package: app
+                    Version: 1.0-1
+                    Depends: libc, editor
+                    """,
+                    """
+                    Package: vim
+                    Version: 8.2-1
+                    Provides: editor
+                    """,
+                )
+            ),
+            [("app (1.0-1)", "external")],
+        )
+
+    def test_versioned_provides(self) -> None:
+        """Check that versioned dependencies need versioned provides."""
+        providers = (
+            """
+            Package: any
+            Version: 9.0-1
+            Provides: editor
+            """,
+            """
+            Package: old
+            Version: 9.0-1
+            Provides: editor (= 1.0-1)
+            """,
+        )
+        app = """
+            Package: app
+            Version: 1.0-1
+            Depends: editor (>= 2.0)
+            """
+
+        self.assertEqual(
+            _problems(_index(app, *providers)),
+            [("app (1.0-1)", "unsatisfiable")],
+        )
+        self.assertEqual(
+            _problems(
+                _index(
+                    app,
+                    *providers,
+                    """
+                    Package: new
+                    Version: 0.1-1
+                    Provides: editor (= 2.0-1)
+                    """,
+                )
+            ),
+            [],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,303 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Check version ordering against a port of dpkg’s comparison algorithm.
+
+The versions are generated randomly from a fixed seed, favoring the cases
+where the Debian rules are easy to get wrong: epochs, tildes, missing
+revisions, letters next to digits and leading zeros.
+"""
+
+import functools
+import random
+import re
+from typing import Callable, List, Tuple
+import unittest
+from toltec.version import Version
+
+# Seed of the version generator, fixed so that failures can be reproduced
+SEED = 20210301
+
+# Number of generated versions compared in each test
+SAMPLES = 2000
+
+# Fragments from which the parts of generated versions are assembled
+FRAGMENTS = (
+    "0",
+    "00",
+    "01",
+    "1",
+    "007",
+    "9",
+    "10",
+    "123",
+    "a",
+    "b",
+    "z",
+    "A",
+    "Z",
+    "rc",
+    "~",
+    "~~",
+    "~rc",
+    ".",
+    "+",
+    "+b",
+)
+
+
+def _order(char: str) -> int:
+    """Get the weight of a character, as dpkg’s order() function does."""
+    if char == "":
+        return 0
+
+    if char.isdigit():
+        return 0
+
+    if char.isalpha():
+        return ord(char)
+
+    if char == "~":
+        return -1
+
+    return ord(char) + 256
+
+
+def verrevcmp(left: str, right: str) -> int:
+    """
+    Compare two upstream versions or revisions.
+
+    This is a line-by-line port of verrevcmp() from dpkg’s lib/dpkg/version.c,
+    which serves as the reference implementation of the Debian rules.
+
+    :returns: a negative number, zero or a positive number if the left
+        side sorts before, the same as or after the right side
+    """
+
+    def char_at(text: str, index: int) -> str:
+        """Get a character, or an empty string past the end of the text."""
+        return text[index] if index < len(text) else ""
+
+    i = j = 0
+
+    while i < len(left) or j < len(right):
+        first_diff = 0
+
+        while (char_at(left, i) and not char_at(left, i).isdigit()) or (
+            char_at(right, j) and not char_at(right, j).isdigit()
+        ):
+            left_order = _order(char_at(left, i))
+            right_order = _order(char_at(right, j))
+
+            if left_order != right_order:
+                return left_order - right_order
+
+            i += 1
+            j += 1
+
+        while char_at(left, i) == "0":
+            i += 1
+
+        while char_at(right, j) == "0":
+            j += 1
+
+        while char_at(left, i).isdigit() and char_at(right, j).isdigit():
+            if not first_diff:
+                first_diff = ord(left[i]) - ord(right[j])
+
+            i += 1
+            j += 1
+
+        if char_at(left, i).isdigit():
+            return 1
+
+        if char_at(right, j).isdigit():
+            return -1
+
+        if first_diff:
+            return first_diff
+
+    return 0
+
+
+def dpkg_compare(left: Version, right: Version) -> int:
+    """Compare two versions the way dpkg does."""
+    if left.epoch != right.epoch:
+        return left.epoch - right.epoch
+
+    result = verrevcmp(left.upstream, right.upstream)
+
+    if result:
+        return result
+
+    return verrevcmp(left.revision, right.revision)
+
+
+def _sign(number: int) -> int:
+    """Reduce a comparison result to -1, 0 or 1."""
+    return (number > 0) - (number < 0)
+
+
+def _version_compare(left: Version, right: Version) -> int:
+    """Compare two versions with their comparison operators."""
+    if left < right:
+        return -1
+
+    if left > right:
+        return 1
+
+    return 0
+
+
+class TestVersion(unittest.TestCase):
+    """Compare the ordering of generated versions with dpkg’s."""
+
+    def setUp(self) -> None:
+        self.random = random.Random(SEED)
+
+    def generate_part(self, first_digit: bool) -> str:
+        """
+        Generate an upstream version or a revision.
+
+        :param first_digit: whether the part must start with a digit, as
+            upstream versions should
+        """
+        part = "".join(
+            self.random.choice(FRAGMENTS)
+            for _ in range(self.random.randint(1, 5))
+        )
+
+        if first_digit and not part[0].isdigit():
+            part = str(self.random.randint(0, 3)) + part
+
+        return part
+
+    def generate(self) -> str:
+        """Generate a version string."""
+        version = self.generate_part(first_digit=True)
+
+        if self.random.random() < 0.3:
+            version = f"{self.random.randint(0, 2)}:{version}"
+
+        if self.random.random() < 0.5:
+            version += "-" + self.generate_part(first_digit=False)
+
+        return version
+
+    def generate_versions(self) -> List[Version]:
+        """Generate versions, with many of them sharing a prefix."""
+        versions: List[Version] = []
+
+        for _ in range(SAMPLES):
+            if versions and self.random.random() < 0.3:
+                # Extend an existing version to exercise the end-of-part rules
+                base = str(self.random.choice(versions))
+                extension = self.generate_part(first_digit=False)
+                version = base + ("" if "-" in base else "-") + extension
+            else:
+                version = self.generate()
+
+            versions.append(Version.parse(version))
+
+        return versions
+
+    def generate_pairs(self) -> List[Tuple[Version, Version]]:
+        """Generate pairs of versions to compare."""
+        versions = self.generate_versions()
+        return [
+            (self.random.choice(versions), self.random.choice(versions))
+            for _ in range(SAMPLES)
+        ] + list(zip(versions, versions[1:]))
+
+    def check_equivalent(self, version: str, variant: str) -> None:
+        """Check that two spellings of a version compare equal."""
+        left = Version.parse(version)
+        right = Version.parse(variant)
+
+        with self.subTest(left=version, right=variant):
+            self.assertEqual(dpkg_compare(left, right), 0)
+            self.assertEqual(left, right)
+            self.assertEqual(hash(left), hash(right))
+
+    def test_reference(self) -> None:
+        """Check the dpkg port against known orderings."""
+        for left, right, expected in (
+            ("1.0", "1.0", 0),
+            ("1.0", "1.0-0", 0),
+            ("0:1.0", "1.0", 0),
+            ("1.01", "1.1", 0),
+            ("1.0", "1.1", -1),
+            ("1.0~rc1", "1.0", -1),
+            ("1.0~~", "1.0~", -1),
+            ("1.0~", "1.0", -1),
+            ("1.0", "1.0a", -1),
+            ("1.0a", "1.0+b1", -1),
+            ("1.0a", "1.0.", -1),
+            ("1.0-1", "1.0-1a", -1),
+            ("1.9", "1.10", -1),
+            ("1:0.1", "2.0", 1),
+        ):
+            with self.subTest(left=left, right=right):
+                self.assertEqual(
+                    _sign(
+                        dpkg_compare(Version.parse(left), Version.parse(right))
+                    ),
+                    expected,
+                )
+                self.assertEqual(
+                    _version_compare(Version.parse(left), Version.parse(right)),
+                    expected,
+                )
+
+    def test_ordering(self) -> None:
+        """Check that versions are ordered as dpkg orders them."""
+        for left, right in self.generate_pairs():
+            with self.subTest(left=str(left), right=str(right)):
+                self.assertEqual(
+                    _version_compare(left, right),
+                    _sign(dpkg_compare(left, right)),
+                )
+                self.assertEqual(left == right, dpkg_compare(left, right) == 0)
+
+    def test_sorting(self) -> None:
+        """Check that sorting a list of versions agrees with dpkg."""
+        versions = self.generate_versions()
+        expected = sorted(versions, key=functools.cmp_to_key(dpkg_compare))
+        actual = sorted(versions)
+
+        for left, right in zip(expected, actual):
+            self.assertEqual(dpkg_compare(left, right), 0)
+
+    def test_equivalent_spellings(self) -> None:
+        """Check that equal versions have equal hashes."""
+        respellings: List[Callable[[str], str]] = [
+            lambda version: "0:" + version,
+            lambda version: version + "-0",
+            lambda version: version + "-00",
+            lambda version: re.sub(r"\.([0-9])", r".0\1", version),
+            lambda version: "0" + version,
+        ]
+
+        for _ in range(SAMPLES):
+            version = self.generate_part(first_digit=True)
+            self.check_equivalent(
+                version, self.random.choice(respellings)(version)
+            )
+
+    def test_hash(self) -> None:
+        """Check that equal generated versions have equal hashes."""
+        for left, right in self.generate_pairs():
+            if left == right:
+                with self.subTest(left=str(left), right=str(right)):
+                    self.assertEqual(hash(left), hash(right))
+
+    def test_interning(self) -> None:
+        """Check that parsing the same string twice gives the same object."""
+        for version in self.generate_versions():
+            text = str(version)
+            self.assertIs(Version.parse(text), version)
+            self.assertIs(Version.parse(text), Version.parse(text))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,431 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Share built packages between machines.
+
+Built packages are stored in a content-addressed cache, under a key derived
+from all the inputs of a build: the recipe directory, the checksums of remote
+sources, the digests of the Docker images, the install library and the
+version of this tooling. Each cache entry holds the package archives of a
+recipe along with a metadata file recording their checksums, which is checked
+before any archive is reused.
+
+Caches are stored either in a local directory or on an HTTP server which
+answers GET and PUT requests on the entry files.
+"""
+
+import abc
+from functools import lru_cache
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+from typing import Any, Dict, Iterable, List, Optional
+import requests
+from . import index, ipk, paths
+from .changes import hash_recipe
+from .recipe import Package, Recipe
+from .util import file_sha256
+
+logger = logging.getLogger(__name__)
+
+# Version of the cache layout, bump when the layout or the key changes
+_FORMAT_VERSION = 1
+
+# Name of the metadata file of each cache entry
+_META_NAME = "meta.json"
+
+# Seconds to wait for a remote cache before giving up on a request
+TIMEOUT = 30
+
+# Detect non-local paths
+_URL_REGEX = re.compile(r"[a-z]+://")
+
+
+class ArtifactCacheError(Exception):
+    """Raised when an artifact cache cannot be accessed."""
+
+
+class Backend(abc.ABC):
+    """Storage for artifact cache entries."""
+
+    @abc.abstractmethod
+    def get(self, name: str, path: str) -> bool:
+        """
+        Retrieve a file from the cache.
+
+        :param name: name of the file, relative to the cache root
+        :param path: path at which to save the file
+        :returns: false if the file does not exist in the cache
+        :raises ArtifactCacheError: if the cache cannot be accessed
+        """
+
+    @abc.abstractmethod
+    def put(self, name: str, path: str) -> None:
+        """
+        Store a file in the cache.
+
+        :param name: name of the file, relative to the cache root
+        :param path: path to the file to store
+        :raises ArtifactCacheError: if the cache cannot be accessed
+        """
+
+
+class LocalBackend(Backend):
+    """Artifact cache stored in a local directory."""
+
+    def __init__(self, directory: str) -> None:
+        """
+        Use a local directory as an artifact cache.
+
+        :param directory: root directory of the cache
+        """
+        super().__init__()
+        self.directory = directory
+
+    def get(self, name: str, path: str) -> bool:
+        try:
+            shutil.copyfile(os.path.join(self.directory, name), path)
+        except FileNotFoundError:
+            return False
+        except OSError as err:
+            raise ArtifactCacheError(
+                f"Unable to read '{name}' from the artifact cache: {err}"
+            ) from err
+
+        return True
+
+    def put(self, name: str, path: str) -> None:
+        target = os.path.join(self.directory, name)
+        temp_path = f"{target}.{os.getpid()}.tmp"
+
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, target)
+        except OSError as err:
+            raise ArtifactCacheError(
+                f"Unable to write '{name}' to the artifact cache: {err}"
+            ) from err
+
+
+class HTTPBackend(Backend):
+    """Artifact cache stored on an HTTP server."""
+
+    def __init__(self, url: str) -> None:
+        """
+        Use an HTTP server as an artifact cache.
+
+        :param url: root URL of the cache
+        """
+        super().__init__()
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def get(self, name: str, path: str) -> bool:
+        file_url = f"{self.url}/{name}"
+
+        try:
+            with self.session.get(
+                file_url, stream=True, timeout=TIMEOUT
+            ) as req:
+                if req.status_code == 404:
+                    return False
+
+                if req.status_code != 200:
+                    raise ArtifactCacheError(
+                        f"Unexpected status code while fetching \
+'{file_url}', got {req.status_code}"
+                    )
+
+                with open(path, "wb") as local:
+                    for chunk in req.iter_content(chunk_size=1024 * 1024):
+                        local.write(chunk)
+        except requests.RequestException as err:
+            raise ArtifactCacheError(
+                f"Unable to fetch '{file_url}': {err}"
+            ) from err
+
+        return True
+
+    def put(self, name: str, path: str) -> None:
+        file_url = f"{self.url}/{name}"
+
+        try:
+            with open(path, "rb") as local:
+                req = self.session.put(file_url, data=local, timeout=TIMEOUT)
+        except requests.RequestException as err:
+            raise ArtifactCacheError(
+                f"Unable to upload '{file_url}': {err}"
+            ) from err
+
+        if req.status_code not in (200, 201, 204):
+            raise ArtifactCacheError(
+                f"Unexpected status code while uploading '{file_url}', \
+got {req.status_code}"
+            )
+
+
+def open_backend(location: str) -> Backend:
+    """
+    Open an artifact cache.
+
+    :param location: URL of an HTTP cache or path to a local directory
+    :returns: cache backend
+    """
+    if location.startswith(("http://", "https://")):
+        return HTTPBackend(location)
+
+    return LocalBackend(location)
+
+
+@lru_cache(maxsize=None)
+def tooling_version() -> str:
+    """Get a hash of the sources of the build tooling."""
+    sha256 = hashlib.sha256()
+    package_dir = os.path.join(paths.SCRIPTS_DIR, "toltec")
+
+    for filename in sorted(os.listdir(package_dir)):
+        if filename.endswith(".py"):
+            sha256.update(filename.encode() + b"\0")
+            sha256.update(
+                file_sha256(os.path.join(package_dir, filename)).encode()
+            )
+
+    return sha256.hexdigest()
+
+
+def build_inputs(
+    recipe: Recipe,
+    recipe_dir: str,
+    images: Dict[str, str],
+    install_lib: str,
+) -> Optional[Dict[str, Any]]:
+    """
+    Describe all the inputs of a recipe build.
+
+    :param recipe: recipe to describe
+    :param recipe_dir: directory containing the recipe and its local sources
+    :param images: digest of each Docker image used by the build
+    :param install_lib: contents of the install library
+    :returns: description of the inputs, or None if some of the inputs
+        cannot be identified by their contents, which is the case of remote
+        sources without checksums
+    """
+    sources = []
+
+    for source in recipe.sources:
+        if _URL_REGEX.match(source.url) is not None:
+            if source.checksum == "SKIP":
+                return None
+
+            sources.append([source.url, source.checksum])
+
+    return {
+        "format": _FORMAT_VERSION,
+        "recipe": hash_recipe(recipe_dir),
+        "sources": sources,
+        "images": images,
+        "install_lib": hashlib.sha256(install_lib.encode()).hexdigest(),
+        "tooling": tooling_version(),
+    }
+
+
+def build_key(inputs: Dict[str, Any]) -> str:
+    """Compute the cache key for a set of build inputs."""
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode()
+    ).hexdigest()
+
+
+class ArtifactCache:
+    """Content-addressed cache of built packages."""
+
+    def __init__(self, backend: Backend, read_only: bool = False) -> None:
+        """
+        Create an artifact cache.
+
+        :param backend: storage for the cache entries
+        :param read_only: if true, never store new packages in the cache
+        """
+        self.backend = backend
+        self.read_only = read_only
+
+    def _get_meta(self, key: str, temp_dir: str) -> Optional[Dict[str, Any]]:
+        """Retrieve the metadata of a cache entry."""
+        meta_path = os.path.join(temp_dir, f".{key}.meta.tmp")
+
+        try:
+            if not self.backend.get(f"{key}/{_META_NAME}", meta_path):
+                return None
+
+            with open(meta_path, "r") as meta_file:
+                meta = json.load(meta_file)
+        except ValueError as err:
+            logger.warning("Ignoring invalid artifact cache entry %s", key)
+            logger.debug("%s", err)
+            return None
+        finally:
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+
+        if not isinstance(meta, dict) or not isinstance(
+            meta.get("packages"), dict
+        ):
+            logger.warning("Ignoring invalid artifact cache entry %s", key)
+            return None
+
+        return meta
+
+    @staticmethod
+    def _verify(package: Package, path: str, expected: Dict[str, Any]) -> bool:
+        """Check that a retrieved archive is the expected package."""
+        if os.path.getsize(path) != expected.get("size"):
+            return False
+
+        if file_sha256(path) != expected.get("sha256"):
+            return False
+
+        try:
+            with open(path, "rb") as file:
+                fields = index.parse_fields(ipk.read_control(file))
+        except ipk.InvalidPackageError:
+            return False
+
+        return fields.get("Package") == package.name and fields.get(
+            "Version"
+        ) == str(package.version)
+
+    def contains(self, key: str, packages: Iterable[Package]) -> bool:
+        """
+        Check whether built packages are in the cache, without retrieving
+        or verifying them.
+
+        :param key: cache key of the build
+        :param packages: packages to look for
+        :returns: true if all the packages are in the cache
+        """
+        try:
+            meta = self._get_meta(key, tempfile.gettempdir())
+        except ArtifactCacheError as err:
+            logger.warning("%s", err)
+            return False
+
+        return meta is not None and all(
+            package.filename() in meta["packages"] for package in packages
+        )
+
+    def restore(
+        self, key: str, packages: Iterable[Package], dest_dir: str
+    ) -> bool:
+        """
+        Restore built packages from the cache.
+
+        Either all the packages are restored or none of them is.
+
+        :param key: cache key of the build
+        :param packages: packages to restore
+        :param dest_dir: directory in which to save the packages
+        :returns: true if all the packages were restored
+        """
+        packages = list(packages)
+
+        try:
+            meta = self._get_meta(key, dest_dir)
+
+            if meta is None:
+                return False
+
+            if any(
+                package.filename() not in meta["packages"]
+                for package in packages
+            ):
+                return False
+
+            temp_paths: List[str] = []
+
+            try:
+                for package in packages:
+                    filename = package.filename()
+                    temp_path = os.path.join(dest_dir, f".{filename}.tmp")
+                    temp_paths.append(temp_path)
+
+                    if not self.backend.get(
+                        f"{key}/{filename}", temp_path
+                    ) or not self._verify(
+                        package, temp_path, meta["packages"][filename]
+                    ):
+                        logger.warning(
+                            "Corrupted package %s in artifact cache entry %s",
+                            filename,
+                            key,
+                        )
+                        return False
+
+                for package, temp_path in zip(packages, temp_paths):
+                    epoch = int(package.parent.timestamp.timestamp())
+                    os.utime(temp_path, (epoch, epoch))
+                    os.replace(
+                        temp_path, os.path.join(dest_dir, package.filename())
+                    )
+            finally:
+                for temp_path in temp_paths:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+        except ArtifactCacheError as err:
+            logger.warning("%s", err)
+            return False
+
+        return True
+
+    def store(
+        self,
+        key: str,
+        inputs: Dict[str, Any],
+        packages: Iterable[Package],
+        src_dir: str,
+    ) -> None:
+        """
+        Store built packages in the cache.
+
+        Packages already stored under the same key are kept. Errors are
+        reported but otherwise ignored, since the cache is only an
+        optimization.
+
+        :param key: cache key of the build
+        :param inputs: inputs of the build, recorded for reference
+        :param packages: packages to store
+        :param src_dir: directory containing the built packages
+        """
+        if self.read_only:
+            return
+
+        try:
+            meta = self._get_meta(key, src_dir) or {"packages": {}}
+            meta["inputs"] = inputs
+
+            for package in packages:
+                filename = package.filename()
+                path = os.path.join(src_dir, filename)
+                self.backend.put(f"{key}/{filename}", path)
+                meta["packages"][filename] = {
+                    "sha256": file_sha256(path),
+                    "size": os.path.getsize(path),
+                }
+
+            # The metadata file is stored last so that entries never
+            # reference archives that are not in the cache yet
+            meta_path = os.path.join(src_dir, f".{key}.meta.tmp")
+
+            try:
+                with open(meta_path, "w") as meta_file:
+                    json.dump(meta, meta_file, indent=4, sort_keys=True)
+
+                self.backend.put(f"{key}/{_META_NAME}", meta_path)
+            finally:
+                os.remove(meta_path)
+        except ArtifactCacheError as err:
+            logger.warning("%s", err)
@@ -2,14 +2,29 @@
 # SPDX-License-Identifier: MIT
 """Bridge Bash with Python."""
 
+import io
+import os
+import re
+import selectors
 import shlex
 import subprocess
-from typing import Dict, Generator, List, Optional, Tuple, Union
+from typing import (
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 from docker.client import DockerClient
+from . import metrics, trace
+from .resources import ResourceLimits, ResourceSampler, ResourceUsage
 
 AssociativeArray = Dict[str, str]
 IndexedArray = List[Optional[str]]
-LogGenerator = Generator[str, None, None]
+LogGenerator = Generator[List[str], None, None]
 Any = Union[str, AssociativeArray, IndexedArray]
 Variables = Dict[str, Optional[Any]]
 Functions = Dict[str, str]
@@ -19,6 +34,40 @@ class ScriptError(Exception):
     """Raised when a launched Bash script exits with a non-zero code."""
 
 
+# Constructs through which a script can use variables or functions whose
+# names do not literally appear in it: eval, indirect expansion, sourcing,
+# namerefs and listings of declarations
+_DYNAMIC_ACCESS_REGEX = re.compile(
+    r"\beval\b|\$\{!|\bsource\b|(?:^|[\s;&|(])\.\s|\bcompgen\b"
+    r"|\b(?:declare|typeset|local|export)\s+-[a-zA-Z]*[nfFp]"
+    r"|\bset\s*(?:$|[;&|)])",
+    re.MULTILINE,
+)
+
+# ANSI-C quoted string, as printed by `declare -p` for values which contain
+# non-printable characters, and the escape sequences that it can contain
+_ANSI_C_STRING_REGEX = re.compile(r"'((?:[^\\']|\\.)*)'", re.DOTALL)
+_ANSI_C_ESCAPE_REGEX = re.compile(
+    r"\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))", re.DOTALL
+)
+_ANSI_C_ESCAPES = {
+    "a": "\a",
+    "b": "\b",
+    "e": "\x1b",
+    "E": "\x1b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+}
+
+# Maximum number of bytes read from the output of a script at once
+_READ_SIZE = 65536
+
+# Maximum number of bytes written to the input of a script at once
+_WRITE_SIZE = 4096
+
 # Variables which are defined by default by Bash.  Those variables are excluded
 # from the result of `get_declarations()`. Subset of the list at:
 # <https://www.gnu.org/software/bash/manual/html_node/Bash-Variables.html>
@@ -33,6 +82,7 @@ default_variables = {
     "BASH_CMDS",
     "BASH_COMMAND",
     "BASH_LINENO",
+    "BASH_LOADABLES_PATH",
     "BASH_SOURCE",
     "BASH_SUBSHELL",
     "BASH_VERSINFO",
@@ -191,11 +241,117 @@ def put_functions(functions: Functions) -> str:
     return result
 
 
+def _uses_name(text: str, name: str) -> bool:
+    """Check whether a name appears as a word in a Bash fragment."""
+    return (
+        re.search(rf"(?<![A-Za-z0-9_]){re.escape(name)}(?![A-Za-z0-9_])", text)
+        is not None
+    )
+
+
+def _value_text(value: Optional[Any]) -> str:
+    """Get the text of a variable value, to search it for names."""
+    if value is None:
+        return ""
+
+    if isinstance(value, str):
+        return value
+
+    if isinstance(value, list):
+        return "\n".join(item for item in value if item is not None)
+
+    return "\n".join(f"{key}\n{item}" for key, item in value.items())
+
+
+def reachable_declarations(
+    script: str, variables: Variables, functions: Functions
+) -> Tuple[Variables, Functions]:
+    """
+    Find the variables and functions that a Bash script can use.
+
+    A declaration is reachable if its name appears as a word in the script,
+    in the body of a reachable function or in the value of a reachable
+    variable (which could be expanded into a command). This over-approximates
+    the declarations actually used and is thus safe to drop the others,
+    unless the script accesses declarations dynamically, in which case all
+    of them are kept.
+
+    :param script: Bash script that is run after the declarations
+    :param variables: available variables
+    :param functions: available functions
+    :returns: subsets of the variables and functions used by the script,
+        in their original order
+    """
+    pending = [script]
+    used: Set[str] = set()
+    candidates = set(variables) | set(functions)
+
+    while pending:
+        text = pending.pop()
+
+        if _DYNAMIC_ACCESS_REGEX.search(text):
+            return variables, functions
+
+        for name in candidates - used:
+            if _uses_name(text, name):
+                used.add(name)
+
+                if name in functions:
+                    pending.append(functions[name])
+
+                if name in variables:
+                    pending.append(_value_text(variables[name]))
+
+    return (
+        {name: value for name, value in variables.items() if name in used},
+        {name: value for name, value in functions.items() if name in used},
+    )
+
+
 def _parse_string(token: str) -> str:
     """Remove escape sequences from a Bash string."""
     return token.replace("\\$", "$")
 
 
+def _parse_ansi_c_string(contents: str) -> str:
+    """Decode the escape sequences of an ANSI-C quoted Bash string."""
+    result = bytearray()
+    position = 0
+
+    for match in _ANSI_C_ESCAPE_REGEX.finditer(contents):
+        result += contents[position : match.start()].encode()
+        octal, hexadecimal, char = match.groups()
+
+        if octal is not None:
+            result.append(int(octal, 8) & 0xFF)
+        elif hexadecimal is not None:
+            result.append(int(hexadecimal, 16))
+        else:
+            result += _ANSI_C_ESCAPES.get(char, char).encode()
+
+        position = match.end()
+
+    result += contents[position:].encode()
+    return result.decode()
+
+
+def _parse_value(lexer: shlex.shlex) -> str:
+    """Parse a Bash string, which may be quoted in the ANSI-C style."""
+    token = lexer.get_token()
+    stream = lexer.instream
+
+    # The lexer splits $'...' into a dollar sign and a single-quoted string
+    # without interpreting its escapes, so read it from the source instead
+    if token == "$" and not lexer.pushback and isinstance(stream, io.StringIO):
+        match = _ANSI_C_STRING_REGEX.match(stream.getvalue(), stream.tell())
+
+        if match is not None:
+            stream.seek(match.end())
+            return _parse_ansi_c_string(match.group(1))
+
+    return _parse_string(token)
+
+
 def _generate_string(string: str) -> str:
     """Generate a Bash string."""
     return shlex.quote(string)
@@ -217,7 +373,7 @@ def _parse_indexed(lexer: shlex.shlex) -> IndexedArray:
         index = int(lexer.get_token())
         assert lexer.get_token() == "]"
         assert lexer.get_token() == "="
-        value = _parse_string(lexer.get_token())
+        value = _parse_value(lexer)
 
         # Grow the result array so that the index exists
         if index >= len(result):
@@ -254,10 +410,10 @@ def _parse_assoc(lexer: shlex.shlex) -> AssociativeArray:
             break
 
         assert token == "["
-        key = lexer.get_token()
+        key = _parse_value(lexer)
         assert lexer.get_token() == "]"
         assert lexer.get_token() == "="
-        value = _parse_string(lexer.get_token())
+        value = _parse_value(lexer)
 
         result[key] = value
 
@@ -295,7 +451,7 @@ def _parse_var(lexer: shlex.shlex) -> Tuple[str, Optional[Any]]:
         elif "A" in var_flags:
             var_value = _parse_assoc(lexer)
         else:
-            var_value = _parse_string(lexer.get_token())
+            var_value = _parse_value(lexer)
     else:
         lexer.push_token(lookahead)
 
@@ -322,15 +478,87 @@ def _parse_func(lexer: shlex.shlex) -> Tuple[int, int]:
     return start_byte, end_byte
 
 
+def _split_lines(chunks: Iterable[bytes]) -> LogGenerator:
+    """
+    Split chunks of output into lines.
+
+    :param chunks: chunks of output, which can start or end anywhere
+        within a line
+    :returns: generator yielding the complete lines found in each chunk,
+        and finally the unterminated last line, if any
+    """
+    partial = b""
+
+    for chunk in chunks:
+        lines = (partial + chunk).split(b"\n")
+        partial = lines.pop()
+
+        if lines:
+            yield [line.decode(errors="replace").rstrip() for line in lines]
+
+    if partial:
+        yield [partial.decode(errors="replace").rstrip()]
+
+
+def _communicate(
+    process: subprocess.Popen, data: bytes
+) -> Generator[bytes, None, None]:
+    """
+    Write data to the input of a process while reading its output.
+
+    Bash reads scripts from its input as it executes them, so the output
+    must be drained while the script is written to avoid a deadlock once
+    both pipes are full.
+
+    :param process: process with piped input and output
+    :param data: data to write to the input of the process
+    :returns: generator yielding chunks of output until the end of file
+    """
+    assert process.stdin is not None
+    assert process.stdout is not None
+    offset = 0
+
+    with selectors.DefaultSelector() as selector:
+        os.set_blocking(process.stdin.fileno(), False)
+        selector.register(process.stdin, selectors.EVENT_WRITE)
+        selector.register(process.stdout, selectors.EVENT_READ)
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                if key.fileobj is process.stdin:
+                    try:
+                        offset += os.write(
+                            key.fd, data[offset : offset + _WRITE_SIZE]
+                        )
+                    except BlockingIOError:
+                        continue
+                    except BrokenPipeError:
+                        offset = len(data)
+
+                    if offset >= len(data):
+                        selector.unregister(process.stdin)
+                        process.stdin.close()
+                else:
+                    chunk = os.read(key.fd, _READ_SIZE)
+
+                    if chunk:
+                        yield chunk
+                    else:
+                        selector.unregister(process.stdout)
+                        process.stdout.close()
+
+
 def run_script(variables: Variables, script: str) -> LogGenerator:
     """
     Run a Bash script and stream its output.
 
     :param variables: Bash variables to set before running the script
     :param script: Bash script to execute
-    :returns: generator yielding output lines from the script
+    :returns: generator yielding output lines from the script, in batches
+        of lines received together
     :raises ScriptError: if the script exits with a non-zero code
     """
+    metrics.BASH_INVOCATIONS.inc(place="host")
     process = subprocess.Popen(
         ["/usr/bin/env", "bash"],
         stdin=subprocess.PIPE,
@@ -338,37 +566,34 @@ def run_script(variables: Variables, script: str) -> LogGenerator:
         stderr=subprocess.STDOUT,
     )
 
-    assert process.stdin is not None
-    assert process.stdout is not None
-    process.stdin.write(
-        "\n".join(
-            (
-                "set -euo pipefail",
-                put_variables(variables),
-                "script() {",
-                script,
-                "}",
-                "script",
-            )
-        ).encode()
+    yield from _split_lines(
+        _communicate(
+            process,
+            "\n".join(
+                (
+                    "set -euo pipefail",
+                    put_variables(variables),
+                    "script() {",
+                    script,
+                    "}",
+                    "script",
+                )
+            ).encode(),
+        )
     )
-    process.stdin.close()
 
-    while process.poll() is None:
-        line = process.stdout.readline()
-        if line:
-            yield line.decode().strip()
-
-    if process.returncode != 0:
+    if process.wait() != 0:
         raise ScriptError(f"Script exited with code {process.returncode}")
 
 
-def run_script_in_container(
+def run_script_in_container(  # pylint:disable=too-many-arguments
     docker: DockerClient,
     image: str,
     mounts: List,
     variables: Variables,
     script: str,
+    limits: Optional[ResourceLimits] = None,
+    usage: Optional[ResourceUsage] = None,
 ) -> LogGenerator:
     """
     Run a Bash script inside a Docker container and stream its output.
@@ -378,38 +603,70 @@ def run_script_in_container(
     :param mounts: paths to mount in the container
     :param variables: Bash variables to set before running the script
     :param script: Bash script to execute
-    :returns: generator yielding output lines from the script
+    :param limits: resources allowed to the container
+    :param usage: if not None, receives the resources used by the container
+    :returns: generator yielding output lines from the script, in batches
+        of lines received together
     :raises ScriptError: if the script exits with a non-zero code
     """
-    container = docker.containers.run(
-        image,
-        mounts=mounts,
-        command=[
-            "/usr/bin/env",
-            "bash",
-            "-c",
-            "\n".join(
-                (
-                    "set -euo pipefail",
-                    put_variables(variables),
-                    "script() {",
-                    script,
-                    "}",
-                    "script",
-                )
-            ),
-        ],
-        detach=True,
-    )
+    options: Dict[str, int] = {}
+
+    if limits is not None:
+        if limits.cpus is not None:
+            options["nano_cpus"] = int(limits.cpus * 1e9)
+
+        if limits.memory is not None:
+            options["mem_limit"] = limits.memory
+            options["memswap_limit"] = limits.memory
+
+    metrics.BASH_INVOCATIONS.inc(place="container")
+    metrics.DOCKER_CONTAINERS.inc(image=image)
+
+    with trace.span("start container", image=image):
+        container = docker.containers.run(
+            image,
+            mounts=mounts,
+            command=[
+                "/usr/bin/env",
+                "bash",
+                "-c",
+                "\n".join(
+                    (
+                        "set -euo pipefail",
+                        put_variables(variables),
+                        "script() {",
+                        script,
+                        "}",
+                        "script",
+                    )
+                ),
+            ],
+            detach=True,
+            **options,
+        )
+
+    sampler = None
+
+    if usage is not None:
+        sampler = ResourceSampler(container, usage)
+        sampler.start()
 
     try:
-        for line in container.logs(stream=True):
-            if line:
-                yield line.decode().strip()
+        yield from _split_lines(container.logs(stream=True))
 
         result = container.wait()
 
         if result["StatusCode"] != 0:
-            raise ScriptError(f"Script exited with code {result['StatusCode']}")
+            message = f"Script exited with code {result['StatusCode']}"
+
+            # Exit code of processes killed by the OOM killer
+            if result["StatusCode"] == 137 and limits and limits.memory:
+                message += " (possibly killed for exceeding its memory limit)"
+
+            raise ScriptError(message)
     finally:
-        container.remove()
+        if sampler is not None:
+            sampler.stop()
+
+        with trace.span("remove container"):
+            container.remove()
@@ -0,0 +1,495 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Record the history of builds in a local SQLite database.
+
+Each invocation of a build script is recorded as a run, under which are
+recorded the outcome and stage durations of each recipe build, the size and
+checksum of each created archive and a snapshot of the generated package
+index. The database can then be queried without scanning the archives again.
+"""
+
+from collections import defaultdict
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from .resources import ResourceUsage
+
+logger = logging.getLogger(__name__)
+
+# Version of the database schema, bump when the schema changes
+_SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE runs (
+    id INTEGER PRIMARY KEY,
+    command TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    success INTEGER
+);
+
+CREATE TABLE builds (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER REFERENCES runs(id),
+    recipe TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL,
+    success INTEGER,
+    cached INTEGER NOT NULL DEFAULT 0,
+    cache_key TEXT,
+    images TEXT
+);
+
+CREATE INDEX builds_recipe ON builds(recipe, started);
+CREATE INDEX builds_started ON builds(started);
+
+CREATE TABLE stages (
+    build_id INTEGER NOT NULL REFERENCES builds(id),
+    stage TEXT NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (build_id, stage)
+);
+
+CREATE TABLE artifacts (
+    id INTEGER PRIMARY KEY,
+    build_id INTEGER REFERENCES builds(id),
+    package TEXT NOT NULL,
+    version TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    created REAL NOT NULL
+);
+
+CREATE INDEX artifacts_package ON artifacts(package, created);
+CREATE INDEX artifacts_created ON artifacts(created);
+
+CREATE TABLE snapshots (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER REFERENCES runs(id),
+    created REAL NOT NULL
+);
+
+CREATE INDEX snapshots_created ON snapshots(created);
+
+CREATE TABLE snapshot_entries (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots(id),
+    filename TEXT NOT NULL,
+    package TEXT NOT NULL,
+    version TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (snapshot_id, filename)
+);
+"""
+
+# Statements upgrading the schema from each previous version to the next
+_MIGRATIONS = {
+    1: """
+CREATE TABLE resources (
+    build_id INTEGER NOT NULL REFERENCES builds(id),
+    stage TEXT NOT NULL,
+    peak_memory INTEGER NOT NULL,
+    cpu_time REAL NOT NULL,
+    block_read INTEGER NOT NULL,
+    block_write INTEGER NOT NULL,
+    PRIMARY KEY (build_id, stage)
+);
+""",
+}
+
+# Change of a package between two snapshots: package name, old versions,
+# new versions (None for added and removed packages)
+Change = Tuple[str, Optional[str], Optional[str]]
+
+
+class BuildDatabase:
+    """Local database of past builds."""
+
+    def __init__(self, path: str, read_only: bool = False) -> None:
+        """
+        Open a build database, creating it if needed.
+
+        :param path: path to the database file
+        :param read_only: open an existing database without modifying it,
+            in which case its schema must be up to date
+        """
+        self.path = path
+        self.run_id: Optional[int] = None
+        self._lock = threading.Lock()
+
+        if read_only:
+            self._conn = sqlite3.connect(
+                f"file:{quote(os.path.abspath(path))}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+
+        if read_only and version != _SCHEMA_VERSION:
+            self._conn.close()
+            raise sqlite3.DatabaseError(
+                f"Build database '{path}' has version {version}, run a build \
+to upgrade it to version {_SCHEMA_VERSION}"
+            )
+
+        if version == 0:
+            with self._conn:
+                self._conn.executescript(
+                    _SCHEMA + "".join(_MIGRATIONS.values())
+                )
+                self._conn.execute(f"PRAGMA user_version={_SCHEMA_VERSION}")
+        elif version > _SCHEMA_VERSION:
+            raise sqlite3.DatabaseError(
+                f"Unsupported build database version {version} in '{path}'"
+            )
+        else:
+            while version < _SCHEMA_VERSION:
+                logger.info(
+                    "Upgrading build database to version %d", version + 1
+                )
+
+                with self._conn:
+                    self._conn.executescript(_MIGRATIONS[version])
+                    version += 1
+                    self._conn.execute(f"PRAGMA user_version={version}")
+
+    def close(self) -> None:
+        """Close the database."""
+        self._conn.close()
+
+    def _insert(self, query: str, params: Tuple) -> int:
+        """Run an insertion query and commit it."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(query, params)
+            assert cursor.lastrowid is not None
+            return cursor.lastrowid
+
+    def start_run(self, command: str) -> int:
+        """
+        Record the start of a run, under which subsequent records are made.
+
+        :param command: description of the invoked command
+        :returns: identifier of the run
+        """
+        self.run_id = self._insert(
+            "INSERT INTO runs (command, started) VALUES (?, ?)",
+            (command, time.time()),
+        )
+        return self.run_id
+
+    def finish_run(self, success: bool) -> None:
+        """Record the end of the current run."""
+        if self.run_id is None:
+            return
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE runs SET finished = ?, success = ? WHERE id = ?",
+                (time.time(), int(success), self.run_id),
+            )
+
+    def start_build(self, recipe: str) -> int:
+        """
+        Record the start of a recipe build.
+
+        :param recipe: name of the recipe
+        :returns: identifier of the build
+        """
+        return self._insert(
+            "INSERT INTO builds (run_id, recipe, started) VALUES (?, ?, ?)",
+            (self.run_id, recipe, time.time()),
+        )
+
+    def finish_build(  # pylint:disable=too-many-arguments
+        self,
+        build_id: int,
+        success: bool,
+        stages: Optional[Dict[str, float]] = None,
+        cached: bool = False,
+        cache_key: Optional[str] = None,
+        images: Optional[Dict[str, str]] = None,
+        resources: Optional[Dict[str, ResourceUsage]] = None,
+    ) -> None:
+        """
+        Record the outcome of a recipe build.
+
+        :param build_id: identifier returned by :meth:`start_build`
+        :param success: whether the build succeeded
+        :param stages: duration in seconds of each stage of the build
+        :param cached: whether the packages were restored from a cache
+        :param cache_key: artifact cache key of the build
+        :param images: digest of each Docker image used by the build
+        :param resources: resources used by the containers of each stage
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                UPDATE builds
+                SET duration = ? - started, success = ?, cached = ?,
+                    cache_key = ?, images = ?
+                WHERE id = ?
+                """,
+                (
+                    time.time(),
+                    int(success),
+                    int(cached),
+                    cache_key,
+                    json.dumps(images, sort_keys=True) if images else None,
+                    build_id,
+                ),
+            )
+            self._conn.executemany(
+                "INSERT INTO stages (build_id, stage, duration) VALUES (?, ?, ?)",
+                (
+                    (build_id, stage, value)
+                    for stage, value in (stages or {}).items()
+                ),
+            )
+            self._conn.executemany(
+                """
+                INSERT INTO resources (build_id, stage, peak_memory,
+                    cpu_time, block_read, block_write)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    (
+                        build_id,
+                        stage,
+                        usage.peak_memory,
+                        usage.cpu_time,
+                        usage.block_read,
+                        usage.block_write,
+                    )
+                    for stage, usage in (resources or {}).items()
+                ),
+            )
+
+    def record_artifact(  # pylint:disable=too-many-arguments
+        self,
+        build_id: Optional[int],
+        package: str,
+        version: str,
+        filename: str,
+        size: int,
+        sha256: str,
+    ) -> None:
+        """
+        Record a created package archive.
+
+        :param build_id: identifier of the build which created the archive
+        :param package: name of the package
+        :param version: version of the package
+        :param filename: name of the archive
+        :param size: size of the archive in bytes
+        :param sha256: checksum of the archive
+        """
+        self._insert(
+            """
+            INSERT INTO artifacts
+            (build_id, package, version, filename, size, sha256, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (build_id, package, version, filename, size, sha256, time.time()),
+        )
+
+    def record_index(self, entries: Iterable[Dict[str, str]]) -> int:
+        """
+        Record a snapshot of a package index.
+
+        :param entries: fields of each entry of the index
+        :returns: identifier of the snapshot
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO snapshots (run_id, created) VALUES (?, ?)",
+                (self.run_id, time.time()),
+            )
+            snapshot_id = cursor.lastrowid
+            self._conn.executemany(
+                """
+                INSERT INTO snapshot_entries
+                (snapshot_id, filename, package, version, size, sha256)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    (
+                        snapshot_id,
+                        fields["Filename"],
+                        fields["Package"],
+                        fields["Version"],
+                        int(fields["Size"]),
+                        fields["SHA256sum"],
+                    )
+                    for fields in entries
+                ),
+            )
+
+        assert snapshot_id is not None
+        return snapshot_id
+
+    def slowest_recipes(
+        self, since: float, limit: int = 10
+    ) -> List[Tuple[str, int, float, float]]:
+        """
+        Find the recipes which took the longest to build.
+
+        Builds restored from a cache are not taken into account.
+
+        :param since: only consider builds started after this timestamp
+        :param limit: maximum number of recipes to return
+        :returns: name, number of builds, average and maximum duration of
+            each recipe, slowest first
+        """
+        return self._conn.execute(
+            """
+            SELECT recipe, COUNT(*), AVG(duration), MAX(duration)
+            FROM builds
+            WHERE started >= ? AND success = 1 AND cached = 0
+            GROUP BY recipe
+            ORDER BY AVG(duration) DESC
+            LIMIT ?
+            """,
+            (since, limit),
+        ).fetchall()
+
+    def size_growth(
+        self, threshold: float
+    ) -> List[Tuple[str, str, int, str, int]]:
+        """
+        Find packages whose latest archive grew compared to the previous one.
+
+        :param threshold: minimum relative growth, e.g. 0.1 for 10%
+        :returns: name, previous version and size, latest version and size
+            of each package, largest growth first
+        """
+        return self._conn.execute(
+            """
+            WITH ranked AS (
+                SELECT package, version, size, ROW_NUMBER() OVER (
+                    PARTITION BY package ORDER BY created DESC, id DESC
+                ) AS rank
+                FROM artifacts
+            )
+            SELECT old.package, old.version, old.size, new.version, new.size
+            FROM ranked AS new
+            JOIN ranked AS old
+                ON old.package = new.package AND old.rank = 2
+            WHERE new.rank = 1 AND new.size > old.size * (1 + ?)
+            ORDER BY CAST(new.size AS REAL) / MAX(old.size, 1) DESC
+            """,
+            (threshold,),
+        ).fetchall()
+
+    def image_digests(self) -> Dict[str, str]:
+        """
+        Get the digest of each Docker image as of its latest recorded use.
+
+        :returns: digest of each image used by the recorded builds, by name
+        """
+        result: Dict[str, str] = {}
+
+        for (images,) in self._conn.execute(
+            """
+            SELECT images FROM builds
+            WHERE images IS NOT NULL
+            ORDER BY started, id
+            """
+        ):
+            result.update(json.loads(images))
+
+        return result
+
+    def snapshots(self, limit: int = 2) -> List[Tuple[int, float, int]]:
+        """
+        List the latest index snapshots.
+
+        :param limit: maximum number of snapshots to return
+        :returns: identifier, creation time and number of packages of each
+            snapshot, latest first
+        """
+        return self._conn.execute(
+            """
+            SELECT snapshots.id, snapshots.created, COUNT(filename)
+            FROM snapshots
+            LEFT JOIN snapshot_entries ON snapshot_id = snapshots.id
+            GROUP BY snapshots.id
+            ORDER BY snapshots.id DESC
+            LIMIT ?
+            """,
+            (limit,),
+        ).fetchall()
+
+    def compare_snapshots(self, old: int, new: int) -> List[Change]:
+        """
+        List packages that changed between two index snapshots.
+
+        :param old: identifier of the older snapshot
+        :param new: identifier of the newer snapshot
+        :returns: changed packages, sorted by name
+        """
+        rows: Dict[int, Dict[str, Set[Tuple[str, str]]]] = {}
+
+        for snapshot_id in (old, new):
+            rows[snapshot_id] = defaultdict(set)
+
+            for package, version, sha256 in self._conn.execute(
+                """
+                SELECT package, version, sha256 FROM snapshot_entries
+                WHERE snapshot_id = ?
+                """,
+                (snapshot_id,),
+            ):
+                rows[snapshot_id][package].add((version, sha256))
+
+        changes: List[Change] = []
+
+        for package in sorted(rows[old].keys() | rows[new].keys()):
+            before = rows[old].get(package, set())
+            after = rows[new].get(package, set())
+
+            if before != after:
+                changes.append(
+                    (
+                        package,
+                        ", ".join(sorted(item[0] for item in before)) or None,
+                        ", ".join(sorted(item[0] for item in after)) or None,
+                    )
+                )
+
+        return changes
+
+
+def recorded_image_digests(path: str) -> Dict[str, str]:
+    """
+    Get the image digests recorded in a build database without modifying it.
+
+    :param path: path to the database
+    :returns: digest of each image used by the recorded builds, by name,
+        or an empty mapping if the database does not exist or cannot be read
+    """
+    if not os.path.isfile(path):
+        return {}
+
+    try:
+        database = BuildDatabase(path, read_only=True)
+
+        try:
+            return database.image_digests()
+        finally:
+            database.close()
+    except sqlite3.DatabaseError as err:
+        logger.warning("Ignoring unreadable build database '%s': %s", path, err)
+        return {}
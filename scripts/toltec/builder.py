@@ -2,16 +2,46 @@
 # SPDX-License-Identifier: MIT
 """Build recipes and create packages."""
 
+import gzip
 import shutil
-from typing import Any, Deque, Iterable, MutableMapping, Optional, Tuple
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 import re
 import os
 import logging
-import textwrap
+import threading
+import time
 import docker
+from docker.client import DockerClient
 import requests
-from . import bash, util, ipk, paths
+from . import (
+    bash,
+    util,
+    ipk,
+    maintainer,
+    metrics,
+    paths,
+    profiling,
+    sizes,
+    trace,
+)
+from .artifacts import ArtifactCache, build_inputs, build_key
+from .builddb import BuildDatabase
+from .planner import DurationHistory
+from .resources import ResourceLimits, ResourceUsage, limits_for
 from .recipe import Recipe, Package
 
 logger = logging.getLogger(__name__)
@@ -40,7 +70,84 @@ class BuildContextAdapter(logging.LoggerAdapter):
         return msg, kwargs
 
 
-class Builder:  # pylint: disable=too-few-public-methods
+@dataclass
+class BuildRecord:
+    """Information gathered while building a recipe."""
+
+    # Duration in seconds of each build stage
+    stages: Dict[str, float] = field(default_factory=dict)
+
+    # Whether the packages were restored from the artifact cache
+    cached: bool = False
+
+    # Artifact cache key of the build, if any
+    cache_key: Optional[str] = None
+
+    # Digest of each Docker image used by the build
+    images: Dict[str, str] = field(default_factory=dict)
+
+    # Identifier of the build in the build database, if any
+    build_id: Optional[int] = None
+
+    # Resources used by the containers of each build stage
+    resources: Dict[str, ResourceUsage] = field(default_factory=dict)
+
+    def add_concurrent(
+        self, results: List[Dict[str, float]], elapsed: float
+    ) -> None:
+        """
+        Split the time spent running stages concurrently for several
+        packages in proportion to the time spent on each stage.
+        """
+        total = sum(sum(stages.values()) for stages in results)
+
+        for name in sorted({name for stages in results for name in stages}):
+            spent = sum(stages.get(name, 0.0) for stages in results)
+            self.stages[name] = self.stages.get(name, 0.0) + (
+                spent * elapsed / total if total else 0.0
+            )
+
+    def peak_memory(self) -> int:
+        """Get the highest memory use of the build containers, in bytes."""
+        return max(
+            (usage.peak_memory for usage in self.resources.values()),
+            default=0,
+        )
+
+
+@contextmanager
+def _timed(
+    stages: Dict[str, float],
+    name: str,
+    log_dir: str,
+    package: Optional[str] = None,
+) -> Iterator[None]:
+    """
+    Add the time spent in a block to the duration of a build stage.
+
+    :param stages: duration of each stage of the build
+    :param name: name of the stage
+    :param log_dir: directory in which to save the profile of the stage
+    :param package: name of the package concerned by the stage, if any
+    """
+    start = time.monotonic()
+
+    if package is None:
+        span = trace.span(name)
+        profile = profiling.stage(name, log_dir)
+    else:
+        span = trace.span(name, package=package)
+        profile = profiling.stage(f"{name}-{package}", log_dir)
+
+    with span, profile:
+        yield
+
+    duration = time.monotonic() - start
+    stages[name] = stages.get(name, 0.0) + duration
+    metrics.STAGE_DURATION.observe(duration, stage=name)
+
+
+class Builder:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
     """Helper class for building recipes."""
 
     # Detect non-local paths
@@ -52,30 +159,72 @@ class Builder:  # pylint: disable=too-few-public-methods
     # Toltec Docker image used for generic tasks
     DEFAULT_IMAGE = "base:v1.2.2"
 
-    def __init__(self) -> None:
-        """Create a builder helper."""
-        os.makedirs(paths.WORK_DIR, exist_ok=True)
-        os.makedirs(paths.REPO_DIR, exist_ok=True)
+    # Compression level of saved script outputs, chosen for speed since
+    # build logs compress well anyway
+    LOG_COMPRESSION = 1
 
-        self.install_lib = ""
-        install_lib_path = os.path.join(paths.SCRIPTS_DIR, "install-lib")
-
-        with open(install_lib_path, "r") as file:
-            for line in file:
-                if not line.strip().startswith("#"):
-                    self.install_lib += line
+    def __init__(
+        self,
+        cache: Optional[ArtifactCache] = None,
+        history: Optional[DurationHistory] = None,
+        database: Optional[BuildDatabase] = None,
+        limits: Optional[Dict[str, ResourceLimits]] = None,
+        budgets: Optional[Dict[str, sizes.SizeBudget]] = None,
+    ) -> None:
+        """
+        Create a builder helper.
+
+        :param cache: cache from which already built packages are restored
+            and in which new packages are stored
+        :param history: record in which the duration of each build
+            stage is saved
+        :param database: database in which the outcome of each build
+            is recorded
+        :param limits: resources allowed to the build containers of each
+            recipe (see :func:`resources.load_limits`)
+        :param budgets: maximum sizes allowed for each package (see
+            :func:`sizes.load_budgets`)
+        """
+        self.cache = cache
+        self.history = history
+        self.database = database
+        self.limits = limits or {}
+        self.budgets = budgets or {}
+        self._query_lock = threading.Lock()
+        self._docker: Optional[DockerClient] = None
+        self._docker_lock = threading.Lock()
+
+        self.install_lib = maintainer.read_library(
+            os.path.join(paths.SCRIPTS_DIR, "install-lib")
+        )
 
-        try:
-            self.docker = docker.from_env()
-        except docker.errors.DockerException as err:
-            raise BuildError(
-                "Unable to connect to the Docker daemon. \
+        # Install scripts only include the parts of the library they use
+        (
+            self.install_lib_variables,
+            self.install_lib_functions,
+        ) = bash.get_declarations(self.install_lib)
+
+    @property
+    def docker(self) -> DockerClient:
+        """Client for the Docker daemon, connected on first use."""
+        with self._docker_lock:
+            if self._docker is None:
+                try:
+                    self._docker = docker.from_env()
+                except docker.errors.DockerException as err:
+                    raise BuildError(
+                        "Unable to connect to the Docker daemon. \
 Please check that the service is running and that you have the necessary \
 permissions."
-            ) from err
+                    ) from err
+
+            return self._docker
 
     def make(
-        self, recipe_name: str, packages_names: Optional[Iterable[str]] = None
+        self,
+        recipe_name: str,
+        packages_names: Optional[Iterable[str]] = None,
+        sources: Optional[str] = None,
     ) -> bool:
         """
         Build a recipe and create its associated packages.
@@ -83,72 +232,375 @@ permissions."
         :param recipe_name: name of the recipe to make
         :param packages_names: list of packages names of the recipe to make
             (default: all of them)
+        :param sources: directory containing source files fetched ahead
+            with :meth:`fetch_sources`, which is consumed by the build
         :returns: true if all packages were built correctly
         """
         recipe_dir = os.path.join(paths.RECIPE_DIR, recipe_name)
-        build_dir = os.path.join(paths.WORK_DIR, recipe_name)
         recipe = Recipe.from_file(recipe_dir)
+        packages = self._select_packages(recipe, packages_names)
+        record = BuildRecord()
+
+        if self.database is not None:
+            record.build_id = self.database.start_build(recipe.name)
+
+        success = False
+
+        try:
+            with trace.span("make", recipe=recipe.name):
+                success = self._make(
+                    recipe, recipe_dir, packages, record, sources
+                )
+        finally:
+            if sources is not None and os.path.isdir(sources):
+                shutil.rmtree(sources)
+
+            if self.database is not None and record.build_id is not None:
+                self.database.finish_build(
+                    record.build_id,
+                    success,
+                    stages=record.stages,
+                    cached=record.cached,
+                    cache_key=record.cache_key,
+                    images=record.images,
+                    resources=record.resources,
+                )
+
+        if record.cached:
+            metrics.RECIPES.inc(result="cached")
+        else:
+            metrics.RECIPES.inc(result="built" if success else "failed")
+
+        if success and not record.cached and self.history is not None:
+            self.history.record(
+                recipe.name, record.stages, record.peak_memory()
+            )
+
+        return success
+
+    def _make(
+        self,
+        recipe: Recipe,
+        recipe_dir: str,
+        packages: List[Package],
+        record: BuildRecord,
+        sources: Optional[str] = None,
+    ) -> bool:
+        """Build a recipe, gathering information about the build."""
+        os.makedirs(paths.WORK_DIR, exist_ok=True)
+        os.makedirs(paths.REPO_DIR, exist_ok=True)
+        adapter = BuildContextAdapter(logger, {"recipe": recipe.name})
+        inputs = None
+
+        if self.cache is not None or self.database is not None:
+            record.images = self._image_digests(recipe)
+
+        if self.cache is not None:
+            inputs = self._cache_inputs(recipe, recipe_dir, record.images)
+
+            if inputs is None:
+                adapter.info(
+                    "Not using the artifact cache (some sources have no \
+checksum)"
+                )
+            elif self._restore(adapter, packages, record, build_key(inputs)):
+                return True
+
+        build_dir = self._make_build_dir(recipe)
+
+        if build_dir is None:
+            return False
+
+        src_dir = os.path.join(build_dir, "src")
+        os.makedirs(src_dir, exist_ok=True)
 
-        context = {"recipe": recipe.name}
-        adapter = BuildContextAdapter(logger, context)
+        base_pkg_dir = os.path.join(build_dir, "pkg")
+        os.makedirs(base_pkg_dir, exist_ok=True)
+
+        log_dir = os.path.join(build_dir, "logs")
+        stages = record.stages
+        limits = limits_for(self.limits, recipe.name)
+        resources = record.resources
+
+        with _timed(stages, "fetch", log_dir):
+            if sources is None or not self._move_sources(
+                adapter, sources, src_dir
+            ):
+                self._fetch_source(adapter, recipe, recipe_dir, src_dir)
+
+        with _timed(stages, "prepare", log_dir):
+            self._prepare(adapter, recipe, src_dir, log_dir)
+
+        with _timed(stages, "build", log_dir):
+            resources["build"] = ResourceUsage()
+            self._build(
+                adapter, recipe, src_dir, log_dir, limits, resources["build"]
+            )
+
+        with _timed(stages, "strip", log_dir):
+            resources["strip"] = ResourceUsage()
+            self._strip(
+                adapter, recipe, src_dir, log_dir, limits, resources["strip"]
+            )
+
+        self._make_packages(packages, src_dir, base_pkg_dir, log_dir, record)
+
+        if (
+            self.cache is not None
+            and record.cache_key is not None
+            and inputs is not None
+        ):
+            adapter.info("Storing packages in the artifact cache")
+
+            with trace.span("store"):
+                self.cache.store(
+                    record.cache_key, inputs, packages, paths.REPO_DIR
+                )
+
+        return True
+
+    def _restore(
+        self,
+        adapter: BuildContextAdapter,
+        packages: List[Package],
+        record: BuildRecord,
+        cache_key: str,
+    ) -> bool:
+        """
+        Restore the packages of a build from the artifact cache.
+
+        :returns: true if the packages were restored
+        """
+        assert self.cache is not None
+        record.cache_key = cache_key
+        adapter.debug("Artifact cache key: %s", cache_key)
+
+        with trace.span("restore"):
+            restored = self.cache.restore(cache_key, packages, paths.REPO_DIR)
+
+        metrics.record_cache_lookup(restored)
+
+        if restored:
+            adapter.info("Restored packages from the artifact cache")
+            record.cached = True
+
+            for package in packages:
+                self._record_artifact(record.build_id, package)
+
+        return restored
+
+    def _make_build_dir(self, recipe: Recipe) -> Optional[str]:
+        """
+        Create the build directory of a recipe.
+
+        If the directory already exists, ask the user whether to cancel the
+        build, remove the directory or keep it.
+
+        :returns: path to the build directory, or None if cancelled
+        """
+        build_dir = os.path.join(paths.WORK_DIR, recipe.name)
 
         try:
             os.mkdir(build_dir)
         except FileExistsError:
             build_dir_rel = os.path.relpath(build_dir)
-            ans = util.query_user(
-                f"The build directory '{build_dir_rel}' for recipe \
+            with self._query_lock:
+                ans = util.query_user(
+                    f"The build directory '{build_dir_rel}' for recipe \
 '{recipe.name}' already exists.\nWould you like to [c]ancel, [r]emove that \
 directory, or [k]eep it (not recommended)?",
-                default="c",
-                options=["c", "r", "k"],
-                aliases={
-                    "cancel": "c",
-                    "remove": "r",
-                    "keep": "k",
-                },
-            )
+                    default="c",
+                    options=["c", "r", "k"],
+                    aliases={
+                        "cancel": "c",
+                        "remove": "r",
+                        "keep": "k",
+                    },
+                )
 
             if ans == "c":
-                return False
+                return None
 
             if ans == "r":
                 shutil.rmtree(build_dir)
                 os.mkdir(build_dir)
 
-        src_dir = os.path.join(build_dir, "src")
-        os.makedirs(src_dir, exist_ok=True)
+        return build_dir
 
-        base_pkg_dir = os.path.join(build_dir, "pkg")
-        os.makedirs(base_pkg_dir, exist_ok=True)
+    def _make_packages(  # pylint: disable=too-many-arguments
+        self,
+        packages: List[Package],
+        src_dir: str,
+        base_pkg_dir: str,
+        log_dir: str,
+        record: BuildRecord,
+    ) -> None:
+        """
+        Package and archive the build artifacts of each package.
 
-        self._fetch_source(adapter, recipe, recipe_dir, src_dir)
-        self._prepare(adapter, recipe, src_dir)
-        self._build(adapter, recipe, src_dir)
-        self._strip(adapter, recipe, src_dir)
+        The package() functions share the source directory, so they run one
+        after another while finished packages are archived concurrently.
+        Recipes with the “parallelpackage” flag guarantee that their package()
+        functions leave the source directory unchanged, which is checked, to
+        run them concurrently too.
 
-        for package_name in (
-            packages_names
-            if packages_names is not None
-            else recipe.packages.keys()
-        ):
+        :raises BuildError: if a parallel package() changed the sources
+        """
+        start = time.monotonic()
+        parallel = "parallelpackage" in packages[0].parent.flags
+        sources = util.tree_state(src_dir) if parallel else None
+        results: List[Dict[str, float]] = [{} for _ in packages]
+
+        def run(package: Package, times: Dict[str, float], *names: str) -> None:
+            adapter = BuildContextAdapter(
+                logger, {"recipe": package.parent.name, "package": package.name}
+            )
+            pkg_dir = os.path.join(base_pkg_dir, package.name)
+            os.makedirs(pkg_dir, exist_ok=True)
+
+            for name in names:
+                with _timed(times, name, log_dir, package.name):
+                    if name == "package":
+                        self._package(
+                            adapter, package, src_dir, pkg_dir, log_dir
+                        )
+                    else:
+                        self._archive(
+                            adapter, package, pkg_dir, log_dir, record.build_id
+                        )
+
+        with ThreadPoolExecutor(
+            max_workers=min(len(packages), os.cpu_count() or 1),
+            thread_name_prefix="package",
+        ) as executor:
+            futures = []
+
+            for args in zip(packages, results):
+                if parallel:
+                    futures.append(
+                        executor.submit(run, *args, "package", "archive")
+                    )
+                else:
+                    run(*args, "package")
+                    futures.append(executor.submit(run, *args, "archive"))
+
+            for future in futures:
+                future.result()
+
+        if sources is not None and util.tree_state(src_dir) != sources:
+            raise BuildError(
+                "The package() functions of recipes with the parallelpackage \
+flag must not modify the source directory"
+            )
+
+        record.add_concurrent(results, time.monotonic() - start)
+
+    def is_cached(
+        self,
+        recipe_name: str,
+        packages_names: Optional[Iterable[str]] = None,
+        images: Optional[Dict[str, str]] = None,
+    ) -> Optional[bool]:
+        """
+        Check whether the packages of a recipe are in the artifact cache.
+
+        :param recipe_name: name of the recipe to check
+        :param packages_names: list of packages names of the recipe to check
+            (default: all of them)
+        :param images: known digest of each Docker image, to use instead of
+            asking Docker (which pulls missing images)
+        :returns: true if all packages can be restored from the cache, or
+            None if the digest of an image is missing from the known digests
+        """
+        if self.cache is None:
+            return False
+
+        recipe_dir = os.path.join(paths.RECIPE_DIR, recipe_name)
+        recipe = Recipe.from_file(recipe_dir)
+        packages = self._select_packages(recipe, packages_names)
+        names = self._image_names(recipe)
+
+        if images is None:
+            digests = self._image_digests(recipe)
+        elif images.keys() >= set(names):
+            digests = {name: images[name] for name in names}
+        else:
+            return None
+
+        inputs = self._cache_inputs(recipe, recipe_dir, digests)
+
+        return inputs is not None and self.cache.contains(
+            build_key(inputs), packages
+        )
+
+    @staticmethod
+    def _select_packages(
+        recipe: Recipe, packages_names: Optional[Iterable[str]]
+    ) -> List[Package]:
+        """Get the packages of a recipe to build."""
+        if packages_names is None:
+            return list(recipe.packages.values())
+
+        result = []
+
+        for package_name in packages_names:
             if package_name not in recipe.packages:
                 raise BuildError(
                     f"Package '{package_name}' does not exist in \
 recipe '{recipe.name}'"
                 )
 
-            assert package_name is not None
-            package = recipe.packages[package_name]
-            context["package"] = package_name
+            result.append(recipe.packages[package_name])
 
-            pkg_dir = os.path.join(base_pkg_dir, package_name)
-            os.makedirs(pkg_dir, exist_ok=True)
+        return result
 
-            self._package(adapter, package, src_dir, pkg_dir)
-            self._archive(adapter, package, pkg_dir)
+    def _cache_inputs(
+        self, recipe: Recipe, recipe_dir: str, images: Dict[str, str]
+    ) -> Optional[Dict[str, Any]]:
+        """Describe the inputs of a recipe build for the artifact cache."""
+        return build_inputs(recipe, recipe_dir, images, self.install_lib)
 
-        return True
+    def _record_artifact(
+        self, build_id: Optional[int], package: Package
+    ) -> None:
+        """Record a package archive in the build database."""
+        if self.database is None:
+            return
+
+        ar_path = os.path.join(paths.REPO_DIR, package.filename())
+        self.database.record_artifact(
+            build_id,
+            package=package.name,
+            version=str(package.version),
+            filename=package.filename(),
+            size=os.path.getsize(ar_path),
+            sha256=util.file_sha256(ar_path),
+        )
+
+    def _image_names(self, recipe: Recipe) -> List[str]:
+        """Get the names of the Docker images used for building a recipe."""
+        names = [recipe.image] if recipe.image else []
+
+        if "nostrip" not in recipe.flags:
+            names.append(self.DEFAULT_IMAGE)
+
+        return names
+
+    def _image_digests(self, recipe: Recipe) -> Dict[str, str]:
+        """Get the digest of each Docker image used for building a recipe."""
+        result = {}
+
+        for name in self._image_names(recipe):
+            full_name = self.IMAGE_PREFIX + name
+
+            try:
+                image = self.docker.images.get(full_name)
+            except docker.errors.ImageNotFound:
+                image = self.docker.images.pull(full_name)
+
+            result[name] = image.id
+
+        return result
 
     def _fetch_source(
         self,
@@ -180,6 +632,7 @@ source file '{source.url}', got {req.status_code}"
                 with open(local_path, "wb") as local:
                     for chunk in req.iter_content(chunk_size=1024):
                         local.write(chunk)
+                        metrics.DOWNLOADED_BYTES.inc(len(chunk), kind="source")
 
             # Verify checksum
             if (
@@ -192,10 +645,54 @@ source file '{source.url}', got {req.status_code}"
 
             # Automatically extract source archives
             if not source.noextract:
-                util.auto_extract(local_path, src_dir)
+                with trace.span("extract", source=source.url):
+                    with profiling.memory(f"auto_extract {filename}"):
+                        util.auto_extract(local_path, src_dir)
+
+    def fetch_sources(self, recipe_name: str, src_dir: str) -> None:
+        """
+        Fetch and extract the source files of a recipe ahead of its build.
+
+        :param recipe_name: name of the recipe
+        :param src_dir: directory in which to save the sources, to be passed
+            to :meth:`make`
+        """
+        recipe_dir = os.path.join(paths.RECIPE_DIR, recipe_name)
+        recipe = Recipe.from_file(recipe_dir)
+        adapter = BuildContextAdapter(logger, {"recipe": recipe.name})
+
+        with trace.span("prefetch", recipe=recipe.name):
+            self._fetch_source(adapter, recipe, recipe_dir, src_dir)
+
+    @staticmethod
+    def _move_sources(
+        adapter: BuildContextAdapter, sources: str, src_dir: str
+    ) -> bool:
+        """
+        Move prefetched source files to the source directory of a build.
+
+        :returns: false if the source directory was not empty, in which
+            case the prefetched files are left untouched
+        """
+        if os.listdir(src_dir):
+            return False
+
+        adapter.info("Using prefetched source files")
+
+        for filename in os.listdir(sources):
+            os.replace(
+                os.path.join(sources, filename),
+                os.path.join(src_dir, filename),
+            )
+
+        return True
 
     def _prepare(
-        self, adapter: BuildContextAdapter, recipe: Recipe, src_dir: str
+        self,
+        adapter: BuildContextAdapter,
+        recipe: Recipe,
+        src_dir: str,
+        log_dir: str,
     ) -> None:
         """Prepare source files before building."""
         script = recipe.functions["prepare"]
@@ -214,12 +711,26 @@ source file '{source.url}', got {req.status_code}"
             },
         )
 
-        self._print_logs(logs, adapter, "prepare()")
+        self._print_logs(
+            logs, adapter, os.path.join(log_dir, "prepare.log.gz"), "prepare()"
+        )
 
-    def _build(
-        self, adapter: BuildContextAdapter, recipe: Recipe, src_dir: str
+    def _build(  # pylint: disable=too-many-arguments
+        self,
+        adapter: BuildContextAdapter,
+        recipe: Recipe,
+        src_dir: str,
+        log_dir: str,
+        limits: ResourceLimits,
+        usage: ResourceUsage,
     ) -> None:
-        """Build artifacts for a recipe."""
+        """
+        Build artifacts for a recipe.
+
+        :param log_dir: directory in which to save the build output
+        :param limits: resources allowed to the build container
+        :param usage: receives the resources used by the build container
+        """
         script = recipe.functions["build"]
 
         if not script:
@@ -259,14 +770,31 @@ source file '{source.url}', got {req.status_code}"
                     f'chown -R {uid}:{uid} "{mount_src}"',
                 )
             ),
+            limits=limits,
+            usage=usage,
         )
 
-        self._print_logs(logs, adapter, "build()")
+        self._print_logs(
+            logs, adapter, os.path.join(log_dir, "build.log.gz"), "build()"
+        )
+        adapter.info("Resources used by build(): %s", usage)
 
-    def _strip(
-        self, adapter: BuildContextAdapter, recipe: Recipe, src_dir: str
+    def _strip(  # pylint: disable=too-many-arguments
+        self,
+        adapter: BuildContextAdapter,
+        recipe: Recipe,
+        src_dir: str,
+        log_dir: str,
+        limits: ResourceLimits,
+        usage: ResourceUsage,
     ) -> None:
-        """Strip all debugging symbols from binaries."""
+        """
+        Strip all debugging symbols from binaries.
+
+        :param log_dir: directory in which to save the stripping output
+        :param limits: resources allowed to the stripping container
+        :param usage: receives the resources used by the stripping container
+        """
         if "nostrip" in recipe.flags:
             adapter.info("Not stripping binaries (nostrip flag set)")
             return
@@ -295,16 +823,19 @@ source file '{source.url}', got {req.status_code}"
 | xargs --no-run-if-empty --null strip --strip-all || true',
                 )
             ),
+            limits=limits,
+            usage=usage,
         )
 
-        self._print_logs(logs, adapter)
+        self._print_logs(logs, adapter, os.path.join(log_dir, "strip.log.gz"))
 
-    def _package(
+    def _package(  # pylint: disable=too-many-arguments
         self,
         adapter: BuildContextAdapter,
         package: Package,
         src_dir: str,
         pkg_dir: str,
+        log_dir: str,
     ) -> None:
         """Make a package from a recipe’s build artifacts."""
         adapter.info("Packaging build artifacts")
@@ -318,7 +849,12 @@ source file '{source.url}', got {req.status_code}"
             },
         )
 
-        self._print_logs(logs, adapter, "package()")
+        self._print_logs(
+            logs,
+            adapter,
+            os.path.join(log_dir, f"package-{package.name}.log.gz"),
+            "package()",
+        )
 
         adapter.debug("Resulting tree:")
 
@@ -330,10 +866,20 @@ source file '{source.url}', got {req.status_code}"
                 ),
             )
 
-    def _archive(
-        self, adapter: BuildContextAdapter, package: Package, pkg_dir: str
+    def _archive(  # pylint: disable=too-many-arguments
+        self,
+        adapter: BuildContextAdapter,
+        package: Package,
+        pkg_dir: str,
+        log_dir: str,
+        build_id: Optional[int] = None,
     ) -> None:
-        """Create an archive for a package."""
+        """
+        Create an archive for a package.
+
+        :param log_dir: directory in which to save the size report
+        :raises BuildError: if the package exceeds its size budget
+        """
         adapter.info("Creating archive")
         ar_path = os.path.join(paths.REPO_DIR, package.filename())
 
@@ -345,82 +891,10 @@ source file '{source.url}', got {req.status_code}"
             package.functions["postremove"] += oxide_hook
 
         # Convert install scripts to Debian format
-        scripts = {}
-        script_header = "\n".join(
-            (
-                textwrap.dedent(
-                    """\
-                    #!/usr/bin/env bash
-                    set -euo pipefail
-                    """
-                ),
-                bash.put_variables(
-                    {
-                        **package.parent.variables,
-                        **package.variables,
-                        **package.custom_variables,
-                    }
-                ),
-                bash.put_functions(package.custom_functions),
-                self.install_lib,
-            )
+        scripts = maintainer.make_scripts(
+            package, self.install_lib_variables, self.install_lib_functions
         )
 
-        for name, script, action in (
-            ("preinstall", "preinst", "install"),
-            ("configure", "postinst", "configure"),
-        ):
-            if package.functions[name]:
-                scripts[script] = "\n".join(
-                    (
-                        script_header,
-                        textwrap.dedent(
-                            f"""\
-                            if [[ $1 = {action} ]]; then
-                                script() {{
-                            """
-                        ),
-                        package.functions[name],
-                        textwrap.dedent(
-                            """\
-                                }
-                                script
-                            fi
-                            """
-                        ),
-                    )
-                )
-
-        for step in ("pre", "post"):
-            if (
-                package.functions[step + "upgrade"]
-                or package.functions[step + "remove"]
-            ):
-                script = script_header
-
-                for action in ("upgrade", "remove"):
-                    if package.functions[step + action]:
-                        script += "\n".join(
-                            (
-                                textwrap.dedent(
-                                    f"""\
-                                    if [[ $1 = {action} ]]; then
-                                        script() {{
-                                    """
-                                ),
-                                package.functions[step + action],
-                                textwrap.dedent(
-                                    """\
-                                        }
-                                        script
-                                    fi
-                                    """
-                                ),
-                            )
-                        )
-
-                scripts[step + "rm"] = script
-
         adapter.debug("Install scripts:")
 
         if scripts:
@@ -431,8 +905,10 @@ source file '{source.url}', got {req.status_code}"
 
         epoch = int(package.parent.timestamp.timestamp())
 
-        with open(ar_path, "wb") as file:
-            ipk.make_ipk(
+        with open(ar_path, "wb") as file, trace.span(
+            "make_ipk", package=package.name
+        ), profiling.memory(f"make_ipk {package.name}"):
+            stats = ipk.make_ipk(
                 file,
                 epoch=epoch,
                 pkg_dir=pkg_dir,
@@ -442,43 +918,81 @@ source file '{source.url}', got {req.status_code}"
 
         # Set fixed atime and mtime for the resulting archive
         os.utime(ar_path, (epoch, epoch))
+        archive_size = os.path.getsize(ar_path)
+        metrics.ARCHIVED_BYTES.inc(archive_size)
+        adapter.info(
+            "Archive size: %d KiB, installed size: %d KiB",
+            archive_size // 1024,
+            stats.installed_size // 1024,
+        )
+        sizes.write_report(
+            os.path.join(log_dir, f"size-{package.name}.json"),
+            package,
+            stats,
+            archive_size,
+        )
+        problems = sizes.check_budget(
+            sizes.budget_for(self.budgets, package.name), stats, archive_size
+        )
+
+        if problems:
+            os.remove(ar_path)
+            raise BuildError(
+                f"Package {package.name} exceeds its size budget: "
+                + "; ".join(problems)
+            )
+
+        self._record_artifact(build_id, package)
 
     @staticmethod
     def _print_logs(
         logs: bash.LogGenerator,
         adapter: BuildContextAdapter,
+        log_path: str,
         function_name: str = None,
         max_lines_on_fail: int = 50,
     ) -> None:
         """
-        Print logs to the debug output or buffer and print the last n log lines
-        if a ScriptError is caught.
+        Save logs to a compressed file and print them to the debug output,
+        or print the last n log lines if a ScriptError is caught.
 
-        :param logs: generator of log lines
+        :param logs: generator of batches of log lines
         :param adapter: logging output
+        :param log_path: path of the file in which to save the full logs
         :param function_name: calling function name
         :param max_lines_on_fail: number of context lines to print
             in non-debug mode
         """
-        log_buffer: Deque[str] = deque()
-        try:
-            for line in logs:
-                if adapter.getEffectiveLevel() <= logging.DEBUG:
-                    adapter.debug(line)
-                else:
-                    if len(log_buffer) == max_lines_on_fail:
-                        log_buffer.popleft()
-                    log_buffer.append(line)
-        except bash.ScriptError as err:
-            if len(log_buffer) > 0:
-                adapter.info(
-                    f"Only showing up to {max_lines_on_fail} lines of context. "
-                    + "Use --verbose for the full output."
-                )
-                for line in log_buffer:
-                    adapter.error(line)
+        log_tail: Deque[str] = deque(maxlen=max_lines_on_fail)
+        verbose = adapter.isEnabledFor(logging.DEBUG)
+        prefix, _ = adapter.process("", {})
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+
+        with gzip.open(
+            log_path, "wt", compresslevel=Builder.LOG_COMPRESSION
+        ) as log_file:
+            try:
+                for lines in logs:
+                    log_file.write("".join(line + "\n" for line in lines))
+
+                    if verbose:
+                        # Log each batch of lines as a single record
+                        adapter.logger.debug(
+                            "\n".join(prefix + line for line in lines)
+                        )
+                    else:
+                        log_tail.extend(lines)
+            except bash.ScriptError as err:
+                if log_tail:
+                    adapter.info(
+                        f"Only showing up to {max_lines_on_fail} lines of \
+context. Use --verbose for the full output."
+                    )
+                    for line in log_tail:
+                        adapter.error(line)
 
-            if function_name:
-                adapter.error(f"{function_name} failed")
+                if function_name:
+                    adapter.error(f"{function_name} failed")
 
-            raise err
+                adapter.error("Full output saved to %s", log_path)
+                raise err
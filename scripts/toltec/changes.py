@@ -0,0 +1,164 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Detect recipes that changed since they were last built.
+
+Each recipe is summarized by a hash of its directory, which covers the recipe
+file and all its local sources. The hashes of successfully built recipes are
+recorded in a build manifest that is published along with the repository, so
+that the next build can detect recipes that changed without a version bump.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Iterable, Set
+from .recipe import Recipe
+from .resolver import PackageInfo, Resolver, parse_relations
+
+logger = logging.getLogger(__name__)
+
+# Name of the build manifest in a repository
+MANIFEST_NAME = "manifest.json"
+
+# Map of recipe names to recipe hashes
+Manifest = Dict[str, str]
+
+
+def hash_recipe(recipe_dir: str) -> str:
+    """
+    Compute a hash of a recipe and its local sources.
+
+    :param recipe_dir: path to the recipe directory
+    :returns: hexadecimal SHA-256 hash
+    """
+    sha256 = hashlib.sha256()
+
+    for directory, subdirs, files in os.walk(recipe_dir):
+        subdirs.sort()
+
+        for filename in sorted(files):
+            path = os.path.join(directory, filename)
+            rel_path = os.path.relpath(path, recipe_dir)
+            executable = os.access(path, os.X_OK)
+            sha256.update(f"{rel_path}\0{int(executable)}\0".encode())
+
+            with open(path, "rb") as file:
+                sha256.update(hashlib.sha256(file.read()).digest())
+
+    return sha256.hexdigest()
+
+
+def parse_manifest(text: str) -> Manifest:
+    """Parse a build manifest."""
+    data = json.loads(text)
+
+    if not isinstance(data, dict):
+        raise ValueError("Build manifest must be a JSON object")
+
+    return {str(name): str(value) for name, value in data.items()}
+
+
+def load_manifest(path: str) -> Manifest:
+    """
+    Load a build manifest.
+
+    :param path: path to the manifest
+    :returns: loaded manifest, or an empty manifest if it does not exist
+        or is invalid
+    """
+    try:
+        with open(path, "r") as file:
+            return parse_manifest(file.read())
+    except FileNotFoundError:
+        return {}
+    except ValueError as err:
+        logger.warning("Ignoring invalid build manifest '%s': %s", path, err)
+        return {}
+
+
+def save_manifest(path: str, manifest: Manifest) -> None:
+    """Atomically write a build manifest."""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+        file.write("\n")
+
+    os.replace(temp_path, path)
+
+
+def changed_recipes(
+    recipes: Iterable[str], recipe_root: str, manifest: Manifest
+) -> Dict[str, str]:
+    """
+    Find recipes whose hash differs from the one recorded in a manifest.
+
+    Recipes which are absent from the manifest are not considered changed.
+
+    :param recipes: names of the recipes to check
+    :param recipe_root: directory containing the recipes
+    :param manifest: manifest of the last successful builds
+    :returns: current hash of each changed recipe
+    """
+    result = {}
+
+    for name in recipes:
+        if name in manifest:
+            current = hash_recipe(os.path.join(recipe_root, name))
+
+            if current != manifest[name]:
+                result[name] = current
+
+    return result
+
+
+def with_reverse_dependencies(
+    recipes: Dict[str, Recipe], selected: Iterable[str]
+) -> Set[str]:
+    """
+    Extend a set of recipes with all the recipes which depend on them.
+
+    :param recipes: all the recipes of the repository
+    :param selected: names of the initially selected recipes
+    :returns: names of the selected recipes and of their transitive
+        reverse dependencies
+    """
+    recipe_of = {
+        package.name: recipe.name
+        for recipe in recipes.values()
+        for package in recipe.packages.values()
+    }
+    resolver = Resolver(
+        PackageInfo(
+            name=package.name,
+            version=package.version,
+            depends=parse_relations(package.depends),
+        )
+        for recipe in recipes.values()
+        for package in recipe.packages.values()
+    )
+
+    result = set(selected)
+    stack = [
+        package.name
+        for name in result
+        for package in recipes[name].packages.values()
+    ]
+
+    while stack:
+        for dependent in resolver.reverse_depends.get(stack.pop(), set()):
+            recipe_name = recipe_of[dependent]
+
+            if recipe_name not in result:
+                logger.debug(
+                    "Recipe %s depends on a changed recipe", recipe_name
+                )
+                result.add(recipe_name)
+                stack.extend(
+                    package.name
+                    for package in recipes[recipe_name].packages.values()
+                )
+
+    return result
@@ -0,0 +1,124 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Command-line options shared by the build scripts."""
+
+import argparse
+import atexit
+from typing import Optional
+from . import profiling, trace
+from .artifacts import ArtifactCache, open_backend
+from .builddb import BuildDatabase
+from .builder import Builder
+from .planner import DurationHistory
+from .resources import load_limits
+from .sizes import load_budgets
+
+
+def argparse_add_build_options(parser: argparse.ArgumentParser) -> None:
+    """Add the options for configuring builders and profiling builds."""
+    parser.add_argument(
+        "--artifact-cache",
+        metavar="LOCATION",
+        help="""directory or HTTP URL of a cache from which already built
+        packages are restored and in which new packages are stored""",
+    )
+
+    parser.add_argument(
+        "--artifact-cache-read-only",
+        action="store_true",
+        help="do not store new packages in the artifact cache",
+    )
+
+    parser.add_argument(
+        "--resource-limits",
+        metavar="FILE",
+        help="""JSON file giving the CPUs and memory allowed to the build
+        containers of each recipe, e.g. {"koreader": {"cpus": 4, "memory":
+        "6g"}, "*": {"memory": "2g"}}""",
+    )
+
+    parser.add_argument(
+        "--size-budgets",
+        metavar="FILE",
+        help="""JSON file giving the maximum installed and archive sizes of
+        each package, e.g. {"koreader": {"installed": "200m", "archive":
+        "60m"}}; packages exceeding their budget fail to build""",
+    )
+
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="""write a trace of the time spent in each build stage to FILE,
+        in the Chrome trace event format""",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="""profile each build stage, saving the statistics next to the
+        build logs and printing a summary of the hottest functions at the
+        end""",
+    )
+
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="""when profiling, also measure the memory allocated while
+        creating archives and extracting sources (slow)""",
+    )
+
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=20,
+        metavar="N",
+        help="""number of entries to show in the profiling summary (default:
+        %(default)s)""",
+    )
+
+
+def enable_instrumentation(args: argparse.Namespace) -> None:
+    """Start tracing and profiling if requested by the build options."""
+    if args.trace is not None:
+        trace.enable()
+        atexit.register(trace.write, args.trace)
+
+    if args.profile:
+        profiling.enable(track_memory=args.profile_memory)
+        atexit.register(profiling.print_summary, args.profile_top)
+
+
+def make_builder(
+    args: argparse.Namespace,
+    history: DurationHistory,
+    database: Optional[BuildDatabase],
+) -> Builder:
+    """
+    Create a builder configured by the build options.
+
+    :param args: parsed command-line arguments
+    :param history: history in which to record the duration of builds
+    :param database: database in which to record builds, if any
+    """
+    return Builder(
+        cache=(
+            ArtifactCache(
+                open_backend(args.artifact_cache),
+                read_only=args.artifact_cache_read_only,
+            )
+            if args.artifact_cache is not None
+            else None
+        ),
+        history=history,
+        database=database,
+        limits=(
+            load_limits(args.resource_limits)
+            if args.resource_limits is not None
+            else None
+        ),
+        budgets=(
+            load_budgets(args.size_budgets)
+            if args.size_budgets is not None
+            else None
+        ),
+    )
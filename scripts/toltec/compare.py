@@ -0,0 +1,333 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Compare a local package repository to a remote one.
+
+The package indexes of both repositories are compared first. Only the
+archives whose recorded checksums disagree are then fetched from the remote
+repository and compared member by member.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import difflib
+import hashlib
+import io
+import logging
+import os
+import tarfile
+import tempfile
+from typing import Dict, IO, List, Optional, Tuple
+from . import index
+from .filecache import FileCache, hash_files
+from .mirror import Mirror, Transfer
+from .remote import RemoteRepo
+
+logger = logging.getLogger(__name__)
+
+# Archive members smaller than this are compared line by line
+_TEXT_DIFF_MAX_SIZE = 64 * 1024
+
+# Description of an archive member: type, mode, link target or checksum
+MemberInfo = Tuple[str, int, str]
+
+
+@dataclass
+class FileReport:
+    """Differences found for a single file."""
+
+    # Name of the file, relative to the repository root
+    filename: str
+
+    # Short description of the difference
+    summary: str
+
+    # Detailed differences, one item per line
+    details: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Report:
+    """Differences between a local and a remote repository."""
+
+    # Packages which only exist in the local repository
+    only_local: List[str] = field(default_factory=list)
+
+    # Packages which only exist in the remote repository
+    only_remote: List[str] = field(default_factory=list)
+
+    # Local packages which do not match their local index entry
+    corrupted: List[FileReport] = field(default_factory=list)
+
+    # Packages which exist on both sides with different contents
+    differing: List[FileReport] = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        """Check whether both repositories are identical."""
+        return not (
+            self.only_local
+            or self.only_remote
+            or self.corrupted
+            or self.differing
+        )
+
+    def format(self) -> str:
+        """Format the report for display."""
+        lines = []
+
+        for title, names in (
+            ("Only in local repository", self.only_local),
+            ("Only in remote repository", self.only_remote),
+        ):
+            if names:
+                lines.append(f"{title}:")
+                lines.extend(f"  {name}" for name in names)
+
+        for title, reports in (
+            ("Local index does not match local archive", self.corrupted),
+            ("Differing between repositories", self.differing),
+        ):
+            if reports:
+                lines.append(f"{title}:")
+
+                for report in reports:
+                    lines.append(f"  {report.filename}: {report.summary}")
+                    lines.extend(f"    {line}" for line in report.details)
+
+        return "\n".join(lines)
+
+
+def _archive_members(
+    file: IO[bytes], prefix: str, contents: Dict[str, bytes]
+) -> Dict[str, MemberInfo]:
+    """
+    List the members of a tar archive, recursing into nested archives.
+
+    :param file: archive stream
+    :param prefix: prefix added to the name of each member
+    :param contents: receives the contents of small members
+    :returns: description of each member
+    """
+    result: Dict[str, MemberInfo] = {}
+
+    with tarfile.open(fileobj=file, mode="r:*") as archive:
+        for info in archive:
+            name = prefix + info.name
+
+            if info.isfile():
+                source = archive.extractfile(info)
+                assert source is not None
+                data = source.read()
+
+                if info.name.endswith(".tar.gz"):
+                    result.update(
+                        _archive_members(io.BytesIO(data), name + "/", contents)
+                    )
+
+                if len(data) <= _TEXT_DIFF_MAX_SIZE:
+                    contents[name] = data
+
+                result[name] = (
+                    "file",
+                    info.mode,
+                    hashlib.sha256(data).hexdigest(),
+                )
+            elif info.issym() or info.islnk():
+                result[name] = ("link", info.mode, info.linkname)
+            else:
+                result[name] = (
+                    "dir" if info.isdir() else "other",
+                    info.mode,
+                    "",
+                )
+
+    return result
+
+
+def _text_diff(name: str, local: bytes, remote: bytes) -> List[str]:
+    """Get a line-by-line diff of two text members, if they are text."""
+    try:
+        local_lines = local.decode().splitlines()
+        remote_lines = remote.decode().splitlines()
+    except UnicodeDecodeError:
+        return []
+
+    return list(
+        difflib.unified_diff(
+            remote_lines,
+            local_lines,
+            fromfile=f"remote {name}",
+            tofile=f"local {name}",
+            lineterm="",
+        )
+    )[2:]
+
+
+def diff_archives(local_path: str, remote_path: str) -> List[str]:
+    """
+    Compare two package archives member by member.
+
+    :param local_path: path to the local archive
+    :param remote_path: path to the remote archive
+    :returns: description of the differences, one item per line
+    """
+    local_contents: Dict[str, bytes] = {}
+    remote_contents: Dict[str, bytes] = {}
+
+    try:
+        with open(local_path, "rb") as file:
+            local = _archive_members(file, "", local_contents)
+
+        with open(remote_path, "rb") as file:
+            remote = _archive_members(file, "", remote_contents)
+    except tarfile.TarError as err:
+        return [f"unable to compare archive contents: {err}"]
+
+    details = []
+
+    for name in sorted(local.keys() | remote.keys()):
+        if name not in remote:
+            details.append(f"+ {name} (only in local)")
+        elif name not in local:
+            details.append(f"- {name} (only in remote)")
+        elif local[name] != remote[name]:
+            # Nested archives are reported through their members
+            if name.endswith(".tar.gz"):
+                continue
+
+            if local[name][1] != remote[name][1]:
+                details.append(
+                    f"~ {name} (mode {oct(remote[name][1])} -> "
+                    f"{oct(local[name][1])})"
+                )
+
+            local_kind, _, local_target = local[name]
+            remote_kind, _, remote_target = remote[name]
+
+            if (local_kind, local_target) != (remote_kind, remote_target):
+                details.append(f"~ {name}")
+
+                if name in local_contents and name in remote_contents:
+                    details.extend(
+                        "  " + line
+                        for line in _text_diff(
+                            name, local_contents[name], remote_contents[name]
+                        )
+                    )
+
+    return details
+
+
+def compare(  # pylint:disable=too-many-locals
+    local_dir: str,
+    remote: RemoteRepo,
+    cache: Optional[FileCache] = None,
+    jobs: Optional[int] = None,
+) -> Report:
+    """
+    Compare a local repository to a remote one.
+
+    :param local_dir: local repository directory
+    :param remote: remote repository
+    :param cache: cache of checksums of the local archives
+    :param jobs: number of archives to fetch and compare concurrently
+        (default: number of CPUs)
+    :returns: differences between both repositories
+    :raises FileNotFoundError: if the local repository has no index
+    """
+    with open(os.path.join(local_dir, index.INDEX_NAME), "r") as index_file:
+        local_index = {
+            filename: index.parse_fields(entry)
+            for filename, entry in index.split_index(index_file.read()).items()
+        }
+
+    remote_index = remote.fetch_index()
+    report = Report()
+
+    report.only_local = sorted(local_index.keys() - remote_index.keys())
+    report.only_remote = sorted(remote_index.keys() - local_index.keys())
+
+    # Check that local archives match the checksums of the local index
+    present = [
+        filename
+        for filename in local_index
+        if os.path.isfile(os.path.join(local_dir, filename))
+    ]
+    digests = hash_files(
+        (os.path.join(local_dir, filename) for filename in present),
+        cache=cache,
+        jobs=jobs,
+    )
+
+    for filename, fields in sorted(local_index.items()):
+        path = os.path.join(local_dir, filename)
+
+        if path not in digests:
+            report.corrupted.append(FileReport(filename, "archive is missing"))
+        elif digests[path] != fields.get("SHA256sum"):
+            report.corrupted.append(
+                FileReport(
+                    filename,
+                    "checksum is {actual}, index says {recorded}".format(
+                        actual=digests[path],
+                        recorded=fields.get("SHA256sum"),
+                    ),
+                )
+            )
+
+    if cache is not None:
+        cache.save()
+
+    # Fetch and compare the archives whose checksums disagree
+    differing = sorted(
+        filename
+        for filename in local_index.keys() & remote_index.keys()
+        if local_index[filename].get("SHA256sum")
+        != remote_index[filename].get("SHA256sum")
+        and os.path.join(local_dir, filename) in digests
+    )
+
+    if not differing:
+        return report
+
+    logger.info("Fetching %d differing package(s)", len(differing))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        engine = Mirror(
+            remote.session,
+            temp_dir=os.path.join(temp_dir, "partial"),
+            jobs=remote.jobs,
+        )
+        fetched = {
+            os.path.basename(transfer.path)
+            for transfer in engine.fetch(
+                [
+                    Transfer(
+                        url=f"{remote.url}/{filename}",
+                        path=os.path.join(temp_dir, filename),
+                        sha256=remote_index[filename].get("SHA256sum"),
+                    )
+                    for filename in differing
+                ]
+            )
+        }
+
+        def check(filename: str) -> FileReport:
+            if filename not in fetched:
+                return FileReport(
+                    filename, "checksums differ, remote archive unavailable"
+                )
+
+            return FileReport(
+                filename,
+                "checksums differ",
+                diff_archives(
+                    os.path.join(local_dir, filename),
+                    os.path.join(temp_dir, filename),
+                ),
+            )
+
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            report.differing = list(executor.map(check, differing))
+
+    return report
@@ -0,0 +1,101 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Map installed files to the packages which install them.
+
+The contents index of a repository is a gzip compressed text file with one
+line per installed file, sorted by path. Each line holds the path of the
+file relative to the root of the device, followed by whitespace and by the
+comma-separated names of the packages that install it, as in the Contents
+indexes of Debian repositories. It is generated from the file lists saved
+in the control sub-archive of each package, without reading package data.
+"""
+
+from gzip import GzipFile
+import io
+import os
+from typing import Dict, IO, Iterable, Iterator, List, Mapping, Tuple
+
+# Name of the compressed contents index in a repository
+CONTENTS_NAME = "Contents.gz"
+
+
+def normalize_path(path: str) -> str:
+    """
+    Normalize a path to the form used in the contents index.
+
+    :param path: absolute or relative path on the device
+    :returns: path relative to the root of the device
+    """
+    return os.path.normpath("/" + path).lstrip("/")
+
+
+def make_contents(
+    manifests: Mapping[str, Iterable[str]]
+) -> Dict[str, List[str]]:
+    """
+    Group the files installed by a set of packages by path.
+
+    :param manifests: paths installed by each package, by package name
+    :returns: sorted names of the packages which install each path
+    """
+    owners: Dict[str, List[str]] = {}
+
+    for name in sorted(manifests):
+        for path in manifests[name]:
+            packages = owners.setdefault(path, [])
+
+            if not packages or packages[-1] != name:
+                packages.append(name)
+
+    return owners
+
+
+def write_contents(path: str, owners: Mapping[str, List[str]]) -> None:
+    """
+    Atomically write a contents index.
+
+    :param path: path to the index file
+    :param owners: names of the packages which install each path
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(temp_path, "wb") as file, GzipFile(
+        filename=os.path.splitext(os.path.basename(path))[0],
+        mode="wb",
+        fileobj=file,
+        mtime=0,
+    ) as gzip_file:
+        for installed in sorted(owners):
+            gzip_file.write(
+                f"{installed} {','.join(owners[installed])}\n".encode()
+            )
+
+    os.replace(temp_path, path)
+
+
+def iter_contents(file: IO[bytes]) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Read the lines of a contents index.
+
+    :param file: stream of the compressed index
+    :returns: pairs of paths and of names of the packages which install
+        them, in the order of the index
+    """
+    with GzipFile(fileobj=file, mode="rb") as gzip_file:
+        for line in io.TextIOWrapper(gzip_file):
+            installed, _, packages = line.rstrip("\n").rpartition(" ")
+
+            if installed:
+                yield installed.rstrip(), packages.split(",")
+
+
+def read_contents(path: str) -> Dict[str, List[str]]:
+    """
+    Read a contents index.
+
+    :param path: path to the index file
+    :returns: names of the packages which install each path
+    """
+    with open(path, "rb") as file:
+        return dict(iter_contents(file))
@@ -0,0 +1,610 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Make and apply binary deltas between versions of a package.
+
+A delta lets a client that has the previous version of a package rebuild the
+archive of the next version without downloading it whole. The uncompressed
+data sub-archive of the new version is described as a sequence of segments,
+each of which is either copied from the data sub-archive of the old version
+(for files whose contents did not change) or stored in the delta. The new
+sub-archive and the outer archive are then compressed again with the same
+settings as :func:`ipk.make_ipk`, and the result is checked against the
+SHA-256 checksum of the new archive.
+
+Deltas are only published if applying them is verified to reproduce the new
+archive exactly, which fails for archives that were not made by this tooling
+or with a different zlib version. A delta file is gzip compressed and starts
+with a JSON header line, followed by the bytes stored in the delta.
+"""
+
+from dataclasses import dataclass
+from gzip import GzipFile
+import hashlib
+from io import BytesIO
+import json
+import logging
+import os
+import tarfile
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from . import util
+from .index import INDEX_NAME, group_fields, group_versions
+from .version import Version
+
+logger = logging.getLogger(__name__)
+
+# Version of the delta file format, bump when the layout changes
+_FORMAT_VERSION = 1
+
+# Directory of a repository where delta files are stored
+DELTA_DIR = "deltas"
+
+# Name of the delta index in a repository
+DELTA_INDEX_NAME = "Deltas"
+
+# Deltas larger than this fraction of the new archive are not published
+MAX_RATIO = 0.6
+
+# Deltas are not made for archives larger than this size in bytes by
+# default, since both archives are decompressed in memory
+MAX_SIZE = 64 * 1024 * 1024
+
+# Segment kinds: bytes stored in the delta, bytes copied from the old data
+# sub-archive, and the rebuilt data sub-archive (in the outer archive only)
+_LITERAL = "L"
+_COPY = "C"
+_DATA = "D"
+
+# Segment of a rebuilt archive
+_Segment = List[Any]
+
+# Function fetching archives missing from a repository, given their file
+# names, which returns the local path of each fetched archive
+Fetcher = Callable[[List[str]], Dict[str, str]]
+
+
+class DeltaError(Exception):
+    """Raised when a delta cannot be made or applied."""
+
+
+def _gunzip(data: bytes) -> bytes:
+    """Decompress a gzip stream."""
+    with GzipFile(fileobj=BytesIO(data), mode="rb") as gzip_file:
+        return gzip_file.read()
+
+
+def _gzip(data: bytes, mtime: int) -> bytes:
+    """Compress data with the settings used for ipk archives."""
+    output = BytesIO()
+
+    with GzipFile(
+        filename="", mode="wb", compresslevel=9, fileobj=output, mtime=mtime
+    ) as gzip_file:
+        gzip_file.write(data)
+
+    return output.getvalue()
+
+
+def _gzip_mtime(data: bytes) -> int:
+    """Read the modification time from the header of a gzip stream."""
+    if data[:2] != b"\x1f\x8b":
+        raise DeltaError("Not a gzip stream")
+
+    return int.from_bytes(data[4:8], "little")
+
+
+def _members(tar: bytes) -> List[tarfile.TarInfo]:
+    """List the members of an uncompressed tar archive."""
+    with tarfile.open(fileobj=BytesIO(tar), mode="r:") as archive:
+        return archive.getmembers()
+
+
+def _data_member(outer: bytes) -> tarfile.TarInfo:
+    """Find the data sub-archive in the outer archive of a package."""
+    for info in _members(outer):
+        if info.name.lstrip("./") == "data.tar.gz":
+            return info
+
+    raise DeltaError("Missing data.tar.gz member")
+
+
+def _payload(tar: bytes, info: tarfile.TarInfo) -> bytes:
+    """Get the contents of a member of an uncompressed tar archive."""
+    return tar[info.offset_data : info.offset_data + info.size]
+
+
+class _Builder:
+    """Accumulator of the segments of a rebuilt archive."""
+
+    def __init__(self, literals: bytearray) -> None:
+        """
+        Start a rebuilt archive.
+
+        :param literals: bytes stored in the delta, shared by all the
+            rebuilt archives
+        """
+        self.literals = literals
+        self.segments: List[_Segment] = []
+
+    def literal(self, data: bytes) -> None:
+        """Add bytes stored in the delta."""
+        if not data:
+            return
+
+        last: _Segment = self.segments[-1] if self.segments else ["", 0, 0]
+
+        if last[0] == _LITERAL and last[1] + last[2] == len(self.literals):
+            last[2] += len(data)
+        else:
+            self.segments.append([_LITERAL, len(self.literals), len(data)])
+
+        self.literals += data
+
+    def copy(self, offset: int, size: int) -> None:
+        """Add bytes copied from the old data sub-archive."""
+        last: _Segment = self.segments[-1] if self.segments else ["", 0, 0]
+
+        if last[0] == _COPY and last[1] + last[2] == offset:
+            last[2] += size
+        else:
+            self.segments.append([_COPY, offset, size])
+
+
+def _assemble(
+    segments: List[_Segment], literals: bytes, old_data: bytes, data: bytes
+) -> bytes:
+    """Rebuild an archive from its segments."""
+    result = bytearray()
+
+    for segment in segments:
+        if segment[0] == _LITERAL:
+            result += literals[segment[1] : segment[1] + segment[2]]
+        elif segment[0] == _COPY:
+            if segment[1] + segment[2] > len(old_data):
+                raise DeltaError("Delta does not match the old package")
+
+            result += old_data[segment[1] : segment[1] + segment[2]]
+        elif segment[0] == _DATA:
+            result += data
+        else:
+            raise DeltaError(f"Unknown segment kind '{segment[0]}'")
+
+    return bytes(result)
+
+
+def _split(ipk: bytes) -> Tuple[bytes, tarfile.TarInfo, bytes]:
+    """
+    Decompress a package.
+
+    :returns: uncompressed outer archive, data sub-archive member in the
+        outer archive, and uncompressed data sub-archive
+    """
+    try:
+        outer = _gunzip(ipk)
+        member = _data_member(outer)
+        return outer, member, _gunzip(_payload(outer, member))
+    except (OSError, EOFError, tarfile.TarError) as err:
+        raise DeltaError(f"Unable to read package: {err}") from err
+
+
+def apply_delta(old: bytes, delta: bytes) -> bytes:
+    """
+    Rebuild a package from its previous version and a delta.
+
+    :param old: archive of the previous version of the package
+    :param delta: delta from the previous version to the new one
+    :returns: archive of the new version of the package
+    :raises DeltaError: if the delta does not apply to the old package or
+        if the rebuilt package does not match its checksum
+    """
+    try:
+        contents = _gunzip(delta)
+        header_line, _, literals = contents.partition(b"\n")
+        header = json.loads(header_line)
+    except (OSError, EOFError, ValueError) as err:
+        raise DeltaError(f"Invalid delta: {err}") from err
+
+    if header.get("format") != _FORMAT_VERSION:
+        raise DeltaError(f"Unsupported delta format {header.get('format')}")
+
+    if hashlib.sha256(old).hexdigest() != header["old_sha256"]:
+        raise DeltaError("Delta does not match the old package")
+
+    _, _, old_data = _split(old)
+    return _rebuild(header, literals, old_data)
+
+
+def _rebuild(header: Dict[str, Any], literals: bytes, old_data: bytes) -> bytes:
+    """
+    Rebuild a package from a parsed delta.
+
+    :param header: header of the delta
+    :param literals: bytes stored in the delta
+    :param old_data: uncompressed data sub-archive of the old package
+    :returns: archive of the new version of the package
+    :raises DeltaError: if the rebuilt package does not match its checksum
+    """
+    data = _gzip(
+        _assemble(header["data"]["segments"], literals, old_data, b""),
+        header["data"]["mtime"],
+    )
+    new = _gzip(
+        _assemble(header["outer"]["segments"], literals, b"", data),
+        header["outer"]["mtime"],
+    )
+
+    if hashlib.sha256(new).hexdigest() != header["new_sha256"]:
+        raise DeltaError("Rebuilt package does not match its checksum")
+
+    return new
+
+
+def _data_segments(
+    old_data: bytes, new_data: bytes, literals: bytearray
+) -> List[_Segment]:
+    """
+    Describe a data sub-archive in terms of a previous one.
+
+    :param old_data: old uncompressed data sub-archive
+    :param new_data: new uncompressed data sub-archive
+    :param literals: receives the bytes to store in the delta
+    :returns: segments of the new data sub-archive
+    """
+    # Locate the contents of the old files so that unchanged files are copied
+    old_files: Dict[bytes, Tuple[int, int]] = {}
+
+    for info in _members(old_data):
+        if info.isreg() and info.size > 0:
+            old_files[hashlib.sha256(_payload(old_data, info)).digest()] = (
+                info.offset_data,
+                info.size,
+            )
+
+    data = _Builder(literals)
+    cursor = 0
+
+    for info in _members(new_data):
+        data.literal(new_data[cursor : info.offset_data])
+        cursor = info.offset_data
+
+        if info.isreg() and info.size > 0:
+            payload = _payload(new_data, info)
+            source = old_files.get(hashlib.sha256(payload).digest())
+
+            if source is not None:
+                data.copy(*source)
+            else:
+                data.literal(payload)
+
+            cursor += info.size
+
+    data.literal(new_data[cursor:])
+    return data.segments
+
+
+def make_delta(old: bytes, new: bytes) -> bytes:
+    """
+    Make a delta between two versions of a package.
+
+    :param old: archive of the previous version of the package
+    :param new: archive of the new version of the package
+    :returns: delta from the previous version to the new one
+    :raises DeltaError: if either archive cannot be read or if the new
+        archive cannot be reproduced from the delta
+    """
+    _, _, old_data = _split(old)
+    new_outer, new_member, new_data = _split(new)
+    literals = bytearray()
+    data_segments = _data_segments(old_data, new_data, literals)
+
+    outer = _Builder(literals)
+    outer.literal(new_outer[: new_member.offset_data])
+    outer.segments.append([_DATA])
+    outer.literal(new_outer[new_member.offset_data + new_member.size :])
+
+    header = {
+        "format": _FORMAT_VERSION,
+        "old_sha256": hashlib.sha256(old).hexdigest(),
+        "new_sha256": hashlib.sha256(new).hexdigest(),
+        "data": {
+            "mtime": _gzip_mtime(_payload(new_outer, new_member)),
+            "segments": data_segments,
+        },
+        "outer": {"mtime": _gzip_mtime(new), "segments": outer.segments},
+    }
+
+    # Only keep deltas that reproduce the new archive exactly, reusing the
+    # decompressed old archive instead of applying the delta from scratch
+    stored = bytes(literals)
+    _rebuild(header, stored, old_data)
+    return _gzip(
+        json.dumps(header, separators=(",", ":")).encode() + b"\n" + stored,
+        0,
+    )
+
+
+@dataclass
+class DeltaEntry:
+    """Delta between two versions of a package in a repository."""
+
+    # Name of the package
+    package: str
+
+    # Fields of the index entry of the previous version
+    old: Dict[str, str]
+
+    # Fields of the index entry of the new version
+    new: Dict[str, str]
+
+    # Path to the delta file, relative to the repository
+    filename: str
+
+    @property
+    def key(self) -> str:
+        """Identify the pair of archives between which the delta is made."""
+        return f"{self.old['SHA256sum']}:{self.new['SHA256sum']}"
+
+    def format(self, sha256: str, size: int) -> str:
+        """Create the delta index entry for this delta."""
+        return f"""Package: {self.package}
+Version: {self.new["Version"]}
+Filename: {self.new["Filename"]}
+SHA256sum: {self.new["SHA256sum"]}
+Old-Version: {self.old["Version"]}
+Old-Filename: {self.old["Filename"]}
+Old-SHA256sum: {self.old["SHA256sum"]}
+Delta: {self.filename}
+Delta-SHA256sum: {sha256}
+Delta-Size: {size}
+
+"""
+
+
+def _file_version(fields: Dict[str, str]) -> str:
+    """
+    Get the version of an index entry in the form used in file names, which
+    leaves out the epoch as opkg-build does for archive names, since colons
+    are not allowed in file names on some systems.
+    """
+    return fields["Version"].split(":", 1)[-1]
+
+
+def _latest_pairs(
+    index_text: str, remote_index: Optional[Dict[str, Dict[str, str]]] = None
+) -> List[DeltaEntry]:
+    """
+    Find the latest version of each package of an index and the version
+    preceding it, in the same index or in the index of a remote repository.
+    """
+    result = []
+    remote = group_fields((remote_index or {}).values())
+
+    for name, candidates in sorted(group_versions(index_text).items()):
+        new = candidates[0]
+        version = Version.parse(new["Version"])
+        older = [
+            fields
+            for fields in candidates[1:] + remote.get(name, [])
+            if Version.parse(fields["Version"]) < version
+        ]
+
+        if not older:
+            continue
+
+        old = max(older, key=lambda fields: Version.parse(fields["Version"]))
+        result.append(
+            DeltaEntry(
+                package=name,
+                old=old,
+                new=new,
+                filename=(
+                    f"{DELTA_DIR}/{name}_{_file_version(new)}_"
+                    f"{new.get('Architecture', 'all')}_from_"
+                    f"{_file_version(old)}.delta"
+                ),
+            )
+        )
+
+    return result
+
+
+def _load_decisions(path: Optional[str]) -> Dict[str, bool]:
+    """Load the pairs of archives for which deltas were already made."""
+    if path is None:
+        return {}
+
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_decisions(path: Optional[str], decisions: Dict[str, bool]) -> None:
+    """Atomically save the pairs of archives for which deltas were made."""
+    if path is None:
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(temp_path, "w") as file:
+        json.dump(decisions, file, indent=4, sort_keys=True)
+
+    os.replace(temp_path, path)
+
+
+def _make_delta_file(repo_dir: str, pair: DeltaEntry, old_path: str) -> bool:
+    """
+    Make the delta file for a pair of versions of a package.
+
+    :param old_path: path to the archive of the previous version
+    :returns: true if the delta was made, false if it failed or is not
+        worth publishing
+    """
+    try:
+        with open(old_path, "rb") as file:
+            old = file.read()
+
+        with open(os.path.join(repo_dir, pair.new["Filename"]), "rb") as file:
+            new = file.read()
+
+        delta = make_delta(old, new)
+    except (OSError, DeltaError) as err:
+        logger.debug("Not making delta for %s: %s", pair.package, err)
+        return False
+
+    if len(delta) > MAX_RATIO * len(new):
+        logger.debug(
+            "Not making delta for %s: %d bytes for a %d bytes package",
+            pair.package,
+            len(delta),
+            len(new),
+        )
+        return False
+
+    path = os.path.join(repo_dir, pair.filename)
+
+    with open(path + ".tmp", "wb") as file:
+        file.write(delta)
+
+    os.replace(path + ".tmp", path)
+    logger.debug(
+        "Made delta for %s: %d bytes for a %d bytes package",
+        pair.package,
+        len(delta),
+        len(new),
+    )
+    return True
+
+
+def _too_large(pair: DeltaEntry, max_size: int) -> bool:
+    """Check whether an archive of a pair is too large to make a delta."""
+    size = max(int(pair.old["Size"]), int(pair.new["Size"]))
+
+    if size > max_size:
+        logger.debug(
+            "Not making delta for %s: %d bytes package is too large",
+            pair.package,
+            size,
+        )
+        return True
+
+    return False
+
+
+def _find_old_archives(
+    repo_dir: str, pairs: List[DeltaEntry], fetch: Optional[Fetcher]
+) -> Dict[str, str]:
+    """
+    Find the archives of the previous versions of pairs, fetching the ones
+    which are not in the repository.
+
+    :returns: path to each archive, keyed by file name, which may not exist
+        if the archive could not be fetched
+    """
+    old_paths = {
+        pair.old["Filename"]: os.path.join(repo_dir, pair.old["Filename"])
+        for pair in pairs
+    }
+    missing = sorted(
+        filename
+        for filename, path in old_paths.items()
+        if not os.path.isfile(path)
+    )
+
+    if missing and fetch is not None:
+        logger.info("Fetching %d previous version(s) of packages", len(missing))
+        old_paths.update(fetch(missing))
+
+    return old_paths
+
+
+def _publish(repo_dir: str, published: List[DeltaEntry]) -> None:
+    """
+    Remove the deltas of a repository which are not published and write the
+    index of the published ones.
+    """
+    names = {os.path.basename(pair.filename) for pair in published}
+
+    for name in os.listdir(os.path.join(repo_dir, DELTA_DIR)):
+        if name not in names:
+            os.remove(os.path.join(repo_dir, DELTA_DIR, name))
+
+    index_path = os.path.join(repo_dir, DELTA_INDEX_NAME)
+
+    with open(index_path + ".tmp", "w") as index_file:
+        for pair in published:
+            path = os.path.join(repo_dir, pair.filename)
+            index_file.write(
+                pair.format(util.file_sha256(path), os.path.getsize(path))
+            )
+
+    os.replace(index_path + ".tmp", index_path)
+
+
+def make_deltas(
+    repo_dir: str,
+    decisions_path: Optional[str] = None,
+    max_size: int = MAX_SIZE,
+    remote_index: Optional[Dict[str, Dict[str, str]]] = None,
+    fetch: Optional[Fetcher] = None,
+) -> None:
+    """
+    Make deltas from the previous to the latest version of each package.
+
+    Existing deltas are reused, and deltas that are no longer referenced are
+    removed. The delta index lists the published deltas.
+
+    :param repo_dir: repository directory, which must have an index
+    :param decisions_path: file in which to remember for which pairs of
+        archives deltas were made, so that pairs for which making a delta
+        failed or was not worth it are not tried again on each run
+    :param max_size: size in bytes above which archives are skipped, as
+        read from the index
+    :param remote_index: index of a remote repository in which to look for
+        previous versions that are no longer in the repository
+    :param fetch: function used to fetch the archives of previous versions
+        from the remote repository
+    """
+    with open(os.path.join(repo_dir, INDEX_NAME), "r") as index_file:
+        # Skipped pairs are not remembered, so that raising the limit
+        # makes their deltas on the next run
+        pairs = [
+            pair
+            for pair in _latest_pairs(index_file.read(), remote_index)
+            if not _too_large(pair, max_size)
+        ]
+
+    previous = _load_decisions(decisions_path)
+    decisions: Dict[str, bool] = {}
+    os.makedirs(os.path.join(repo_dir, DELTA_DIR), exist_ok=True)
+    pending = []
+
+    for pair in pairs:
+        if pair.key in previous and (
+            not previous[pair.key]
+            or os.path.isfile(os.path.join(repo_dir, pair.filename))
+        ):
+            decisions[pair.key] = previous[pair.key]
+        else:
+            pending.append(pair)
+
+    old_paths = _find_old_archives(repo_dir, pending, fetch)
+
+    for pair in pending:
+        old_path = old_paths[pair.old["Filename"]]
+
+        # Previous versions that could not be fetched are not remembered,
+        # so that their deltas are made once they can be
+        if not os.path.isfile(old_path):
+            logger.debug(
+                "Not making delta for %s: previous version is missing",
+                pair.package,
+            )
+            continue
+
+        decisions[pair.key] = _make_delta_file(repo_dir, pair, old_path)
+
+    _publish(repo_dir, [pair for pair in pairs if decisions.get(pair.key)])
+    _save_decisions(decisions_path, decisions)
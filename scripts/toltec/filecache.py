@@ -0,0 +1,191 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Cache values computed from file contents across runs.
+
+Cache entries are keyed by the path of the file and by the metadata returned
+by `stat`, so that a cached value is reused only as long as the file is left
+untouched. The inode change time is part of the key because rebuilt packages
+get the same size, inode and (fixed) modification time as the archive they
+replace, but the kernel always updates the change time on writes.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from .util import file_sha256
+
+logger = logging.getLogger(__name__)
+
+# Version of the cache file format, bump when the layout changes
+_FORMAT_VERSION = 1
+
+# Files changed less than this many nanoseconds before an entry was recorded
+# may have been modified again within the timestamp granularity of the file
+# system without any visible change in their metadata, so entries for such
+# files are never trusted (see “racy Git” for the same problem in Git)
+_RACY_WINDOW_NS = 2_000_000_000
+
+Values = Dict[str, Any]
+
+
+def _stat_key(stat: os.stat_result) -> List[int]:
+    """Get the part of a file’s metadata used to detect modifications."""
+    return [
+        stat.st_dev,
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+    ]
+
+
+class FileCache:
+    """Persistent cache of values computed from file contents."""
+
+    def __init__(self, path: str) -> None:
+        """
+        Load a cache from disk.
+
+        A missing, unreadable or outdated cache file yields an empty cache.
+
+        :param path: path to the file in which the cache is stored
+        """
+        self.path = path
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._changed = False
+
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+
+            if data.get("version") == _FORMAT_VERSION:
+                self._entries = data["entries"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, AttributeError) as err:
+            logger.warning("Ignoring invalid cache file '%s': %s", path, err)
+
+    def get(self, path: str, stat: os.stat_result) -> Values:
+        """
+        Get the cached values for a file.
+
+        :param path: path to the file
+        :param stat: current metadata of the file
+        :returns: cached values, or an empty dictionary if the file changed
+            since the values were recorded
+        """
+        entry = self._entries.get(os.path.abspath(path))
+
+        if entry is None or entry["stat"] != _stat_key(stat):
+            return {}
+
+        return entry["values"]
+
+    def set(self, path: str, stat: os.stat_result, values: Values) -> None:
+        """
+        Record values computed from a file.
+
+        Values are merged into the existing values for the file if its
+        metadata did not change.
+
+        :param path: path to the file
+        :param stat: metadata of the file before the values were computed
+        :param values: values to record
+        """
+        now = time.time_ns()
+
+        if max(stat.st_mtime_ns, stat.st_ctime_ns) > now - _RACY_WINDOW_NS:
+            return
+
+        abs_path = os.path.abspath(path)
+        key = _stat_key(stat)
+        entry = self._entries.get(abs_path)
+
+        if entry is None or entry["stat"] != key:
+            entry = {"stat": key, "values": {}}
+            self._entries[abs_path] = entry
+
+        entry["values"].update(values)
+        self._changed = True
+
+    def retain(self, directory: str, names: Iterable[str]) -> None:
+        """
+        Forget entries for files of a directory that no longer exist.
+
+        :param directory: directory whose entries are considered
+        :param names: names of the files to keep in that directory
+        """
+        abs_dir = os.path.abspath(directory)
+        keep = {os.path.join(abs_dir, name) for name in names}
+
+        for path in list(self._entries):
+            if os.path.dirname(path) == abs_dir and path not in keep:
+                del self._entries[path]
+                self._changed = True
+
+    def save(self) -> None:
+        """Atomically write the cache to disk if it was changed."""
+        if not self._changed:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+
+        with open(temp_path, "w") as file:
+            json.dump(
+                {"version": _FORMAT_VERSION, "entries": self._entries},
+                file,
+                separators=(",", ":"),
+            )
+
+        os.replace(temp_path, self.path)
+        self._changed = False
+
+
+def hash_files(
+    paths: Iterable[str],
+    cache: Optional[FileCache] = None,
+    jobs: Optional[int] = None,
+) -> Dict[str, str]:
+    """
+    Compute the SHA-256 checksums of a set of files.
+
+    Checksums found in the cache are reused. The other files are hashed
+    concurrently on a thread pool (hashing releases the GIL) and their
+    checksums are added to the cache.
+
+    :param paths: paths to the files to hash
+    :param cache: cache of previously computed checksums
+    :param jobs: number of files to hash concurrently
+        (default: number of CPUs)
+    :returns: checksum of each file
+    """
+    result = {}
+    misses: List[Tuple[str, os.stat_result]] = []
+
+    for path in paths:
+        stat = os.stat(path)
+        cached = cache.get(path, stat) if cache is not None else {}
+
+        if "sha256" in cached:
+            result[path] = cached["sha256"]
+        else:
+            misses.append((path, stat))
+
+    if misses:
+        logger.debug("Hashing %d file(s)", len(misses))
+
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            digests = executor.map(lambda miss: file_sha256(miss[0]), misses)
+
+            for (path, stat), digest in zip(misses, digests):
+                result[path] = digest
+
+                if cache is not None:
+                    cache.set(path, stat, {"sha256": digest})
+
+    return result
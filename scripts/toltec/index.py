@@ -0,0 +1,372 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Generate package indexes.
+
+The index is built directly from the ipk archives found in a repository
+directory, using the metadata stored in each archive. This makes it possible
+to index packages without parsing any recipe, including packages that were
+fetched from a remote repository. A contents index mapping installed files to
+packages is generated at the same time (see :mod:`toltec.contents`).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from gzip import GzipFile
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from . import ipk
+from .contents import CONTENTS_NAME, make_contents, write_contents
+from .filecache import FileCache
+from .util import file_sha256
+from .version import InvalidVersionError, Version
+
+logger = logging.getLogger(__name__)
+
+# Name of the plain index file in a repository
+INDEX_NAME = "Packages"
+
+# Name of the compressed index file in a repository
+INDEX_GZIP_NAME = "Packages.gz"
+
+
+def list_packages(repo_dir: str) -> List[str]:
+    """
+    List the package archives of a repository.
+
+    :param repo_dir: repository directory
+    :returns: sorted list of archive file names
+    """
+    return sorted(
+        entry.name
+        for entry in os.scandir(repo_dir)
+        if entry.name.endswith(".ipk") and entry.is_file()
+    )
+
+
+def make_entry(control: str, filename: str, sha256: str, size: int) -> str:
+    """
+    Create the index entry of a package.
+
+    :param control: package metadata (main control file)
+    :param filename: name of the package archive, relative to the repository
+    :param sha256: SHA-256 checksum of the package archive
+    :param size: size of the package archive in bytes
+    :returns: index entry, including the trailing blank line
+    """
+    control = control.rstrip("\n") + "\n"
+    return f"""{control}Filename: {filename}
+SHA256sum: {sha256}
+Size: {size}
+
+"""
+
+
+def parse_fields(entry: str) -> Dict[str, str]:
+    """
+    Parse the fields of an index entry or of a control file.
+
+    :param entry: text of the entry
+    :returns: value of each field, continuation lines included
+    """
+    fields: Dict[str, str] = {}
+    name = None
+
+    for line in entry.splitlines():
+        if not line.strip():
+            continue
+
+        if line[0] in " \t" and name is not None:
+            fields[name] += "\n" + line
+        else:
+            name, _, value = line.partition(":")
+            fields[name] = value.strip()
+
+    return fields
+
+
+def split_index(text: str) -> Dict[str, str]:
+    """
+    Split an index into its entries.
+
+    :param text: contents of the index
+    :returns: text of each entry, keyed by the file name of its package
+    """
+    entries = {}
+
+    for block in text.split("\n\n"):
+        if not block.strip():
+            continue
+
+        entry = block.strip("\n") + "\n\n"
+        filename = parse_fields(entry).get("Filename")
+
+        if filename is not None:
+            entries[filename] = entry
+
+    return entries
+
+
+def group_versions(text: str) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Group the entries of an index by package.
+
+    :param text: contents of the index
+    :returns: fields of each version of each package, latest version first,
+        leaving out entries with a missing or invalid version
+    """
+    return group_fields(
+        parse_fields(entry) for entry in split_index(text).values()
+    )
+
+
+def group_fields(
+    entries: Iterable[Dict[str, str]]
+) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Group parsed index entries by package.
+
+    :param entries: fields of each entry
+    :returns: fields of each version of each package, latest version first,
+        leaving out entries with a missing or invalid version
+    """
+    versions: Dict[str, List[Tuple[Version, Dict[str, str]]]] = {}
+
+    for fields in entries:
+        try:
+            version = Version.parse(fields["Version"])
+        except (InvalidVersionError, KeyError, ValueError):
+            continue
+
+        versions.setdefault(fields.get("Package", ""), []).append(
+            (version, fields)
+        )
+
+    return {
+        name: [
+            fields
+            for _, fields in sorted(
+                candidates, key=lambda candidate: candidate[0], reverse=True
+            )
+        ]
+        for name, candidates in versions.items()
+    }
+
+
+def _read_values(path: str) -> Dict[str, Any]:
+    """
+    Read the values needed to index a package from its archive.
+
+    :param path: path to the package archive
+    :returns: package metadata, list of installed files (None for packages
+        made before file lists were recorded) and checksum of the archive
+    :raises ipk.InvalidPackageError: if the archive cannot be read
+    """
+    with open(path, "rb") as file:
+        files = ipk.read_control_files(file, ("control", ipk.MANIFEST_NAME))
+
+    if "control" not in files:
+        raise ipk.InvalidPackageError("Missing control file in control.tar.gz")
+
+    manifest = files.get(ipk.MANIFEST_NAME)
+    return {
+        "control": files["control"],
+        "files": ipk.parse_manifest(manifest) if manifest is not None else None,
+        "sha256": file_sha256(path),
+    }
+
+
+def _read_index(repo_dir: str) -> Dict[str, str]:
+    """Read the current entries of the index of a repository, if any."""
+    try:
+        with open(os.path.join(repo_dir, INDEX_NAME), "r") as index_file:
+            return split_index(index_file.read())
+    except FileNotFoundError:
+        return {}
+
+
+def _is_current(
+    entry: Optional[str], values: Dict[str, Any], size: int
+) -> bool:
+    """Check whether an existing index entry matches an archive."""
+    if entry is None or "sha256" not in values:
+        return False
+
+    fields = parse_fields(entry)
+    return fields.get("SHA256sum") == values["sha256"] and fields.get(
+        "Size"
+    ) == str(size)
+
+
+def _write_index(repo_dir: str, entries: List[str]) -> None:
+    """
+    Atomically write the index files of a repository.
+
+    Each file is first written to a temporary file which is then renamed,
+    so that a repository served while it is updated never exposes a
+    partially written index.
+    """
+    contents = "".join(entries).encode()
+    index_path = os.path.join(repo_dir, INDEX_NAME)
+    index_gzip_path = os.path.join(repo_dir, INDEX_GZIP_NAME)
+    temp_suffix = f".{os.getpid()}.tmp"
+
+    with open(index_gzip_path + temp_suffix, "wb") as index_gzip_file:
+        with GzipFile(
+            filename=INDEX_NAME,
+            mode="wb",
+            fileobj=index_gzip_file,
+            mtime=0,
+        ) as gzip_file:
+            gzip_file.write(contents)
+
+    with open(index_path + temp_suffix, "wb") as index_file:
+        index_file.write(contents)
+
+    os.replace(index_gzip_path + temp_suffix, index_gzip_path)
+    os.replace(index_path + temp_suffix, index_path)
+
+
+def _write_contents(
+    repo_dir: str,
+    entries: Dict[str, str],
+    manifests: Dict[str, Optional[List[str]]],
+) -> None:
+    """Write the contents index of a repository from the file lists."""
+    by_package: Dict[str, Set[str]] = {}
+    unlisted = 0
+
+    for filename, entry in entries.items():
+        manifest = manifests.get(filename)
+
+        if manifest is None:
+            unlisted += 1
+            continue
+
+        name = parse_fields(entry).get("Package", filename)
+        by_package.setdefault(name, set()).update(manifest)
+
+    if unlisted:
+        logger.debug(
+            "Leaving %d package(s) without a file list out of the contents \
+index",
+            unlisted,
+        )
+
+    write_contents(
+        os.path.join(repo_dir, CONTENTS_NAME),
+        make_contents(
+            {name: sorted(files) for name, files in by_package.items()}
+        ),
+    )
+
+
+def make_index(  # pylint:disable=too-many-locals
+    repo_dir: str,
+    jobs: Optional[int] = None,
+    cache: Optional[FileCache] = None,
+    incremental: bool = False,
+) -> None:
+    """
+    Generate index files for all the packages in a repository.
+
+    Archives that are not in the cache are read concurrently. Entries are
+    sorted by file name.
+
+    In incremental mode, entries of the existing index are kept verbatim for
+    archives that did not change since they were last cached, and the index
+    files are left untouched if no archive was added, changed or removed.
+
+    The contents index is generated from the file lists saved in the
+    archives, which are cached along with the metadata.
+
+    :param repo_dir: repository directory
+    :param jobs: number of archives to read concurrently
+        (default: number of CPUs)
+    :param cache: cache of metadata and checksums of the archives
+    :param incremental: pass true to update the existing index
+        instead of generating it from scratch
+    """
+    filenames = list_packages(repo_dir)
+    stats = {
+        filename: os.stat(os.path.join(repo_dir, filename))
+        for filename in filenames
+    }
+    previous = _read_index(repo_dir) if incremental else {}
+    entries: Dict[str, str] = {}
+    values: Dict[str, Dict[str, Any]] = {}
+    manifests: Dict[str, Optional[List[str]]] = {}
+    misses: List[Tuple[str, os.stat_result]] = []
+
+    for filename, stat in stats.items():
+        path = os.path.join(repo_dir, filename)
+        cached = cache.get(path, stat) if cache is not None else {}
+
+        if "files" not in cached:
+            misses.append((filename, stat))
+        elif _is_current(previous.get(filename), cached, stat.st_size):
+            entries[filename] = previous[filename]
+            manifests[filename] = cached["files"]
+        elif "control" in cached and "sha256" in cached:
+            values[filename] = cached
+        else:
+            misses.append((filename, stat))
+
+    logger.debug(
+        "Reading %d package(s), %d found in cache, %d unchanged",
+        len(misses),
+        len(values),
+        len(entries),
+    )
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        results = executor.map(
+            lambda miss: _read_values(os.path.join(repo_dir, miss[0])),
+            misses,
+        )
+
+        for (filename, stat), result in zip(misses, results):
+            values[filename] = result
+
+            if cache is not None:
+                cache.set(os.path.join(repo_dir, filename), stat, result)
+
+    if cache is not None:
+        cache.retain(repo_dir, filenames)
+        cache.save()
+
+    for filename, value in values.items():
+        manifests[filename] = value["files"]
+        entries[filename] = make_entry(
+            value["control"],
+            filename,
+            value["sha256"],
+            stats[filename].st_size,
+        )
+
+    if incremental:
+        removed = previous.keys() - entries.keys()
+        changed = [
+            filename
+            for filename, entry in entries.items()
+            if previous.get(filename) != entry
+        ]
+
+        if (
+            not changed
+            and not removed
+            and previous
+            and os.path.exists(os.path.join(repo_dir, INDEX_GZIP_NAME))
+            and os.path.exists(os.path.join(repo_dir, CONTENTS_NAME))
+        ):
+            logger.debug("Package index is up to date")
+            return
+
+        logger.debug(
+            "Updating %d entries and removing %d entries",
+            len(changed),
+            len(removed),
+        )
+
+    _write_index(repo_dir, [entries[filename] for filename in filenames])
+    _write_contents(repo_dir, entries, manifests)
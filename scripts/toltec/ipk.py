@@ -1,13 +1,48 @@
 # Copyright (c) 2021 The Toltec Contributors
 # SPDX-License-Identifier: MIT
-"""Make ipk packages."""
+"""Make and read ipk packages."""
 
+from dataclasses import dataclass, field
 from gzip import GzipFile
-from typing import Dict, IO, Optional
+import heapq
+from typing import Dict, FrozenSet, IO, Iterable, List, Optional, Tuple
 from io import BytesIO
 import tarfile
 import operator
 import os
+from . import trace
+
+# Magic bytes at the start of an ar-format ipk
+_AR_MAGIC = b"!<arch>\n"
+
+# Size of an ar member header
+_AR_HEADER_SIZE = 60
+
+# Name of the control file listing the files installed by a package
+MANIFEST_NAME = "files"
+
+
+class InvalidPackageError(Exception):
+    """Raised when an archive is not a valid ipk package."""
+
+
+@dataclass
+class DataStats:
+    """Sizes gathered while creating a data sub-archive."""
+
+    # Total size of the regular files of the package, in bytes
+    installed_size: int = 0
+
+    # Size of the compressed data sub-archive, in bytes
+    compressed_size: int = 0
+
+    # Largest regular files of the package as (size, path) pairs, largest
+    # first
+    largest_files: List[Tuple[int, str]] = field(default_factory=list)
+
+    # Paths of all the entries of the package except directories, relative
+    # to the root of the device, in archive order
+    files: List[str] = field(default_factory=list)
 
 
 def _targz_open(fileobj: IO[bytes], epoch: int) -> tarfile.TarFile:
@@ -24,14 +59,14 @@ def _targz_open(fileobj: IO[bytes], epoch: int) -> tarfile.TarFile:
     try:
         archive = tarfile.TarFile(
             mode="w",
-            fileobj=gzipobj,  # type:ignore
+            fileobj=gzipobj,  # type: ignore
             format=tarfile.GNU_FORMAT,
         )
     except:
         gzipobj.close()
         raise
 
-    archive._extfileobj = False  # type:ignore # pylint:disable=protected-access
+    archive._extfileobj = False  # type: ignore # pylint:disable=protected-access
     return archive
 
 
@@ -82,7 +117,11 @@ def _add_file(
 
 
 def make_control(
-    file: IO[bytes], epoch: int, metadata: str, scripts: Dict[str, str]
+    file: IO[bytes],
+    epoch: int,
+    metadata: str,
+    scripts: Dict[str, str],
+    files: Optional[List[str]] = None,
 ) -> None:
     """
     Create the control sub-archive.
@@ -94,6 +133,9 @@ def make_control(
     :param epoch: fixed modification time to set
     :param metadata: package metadata (main control file)
     :param scripts: optional maintainer scripts
+    :param files: optional list of the files installed by the package,
+        saved in the control sub-archive so that it can be read without
+        decompressing the data sub-archive
     """
     with _targz_open(file, epoch) as archive:
         root_info = tarfile.TarInfo("./")
@@ -105,19 +147,54 @@ def make_control(
         for name, script in sorted(scripts.items(), key=operator.itemgetter(0)):
             _add_file(archive, name, 0o755, epoch, script.encode())
 
+        if files is not None:
+            _add_file(
+                archive,
+                MANIFEST_NAME,
+                0o644,
+                epoch,
+                "".join(path + "\n" for path in files).encode(),
+            )
+
 
-def make_data(file: IO[bytes], epoch: int, pkg_dir: str) -> None:
+def make_data(
+    file: IO[bytes], epoch: int, pkg_dir: str, largest: int = 10
+) -> DataStats:
     """
     Create the data sub-archive.
 
     :param file: file to which the sub-archive will be written
     :param epoch: fixed modification time to set
     :param pkg_dir: directory in which the package tree exists
+    :param largest: number of largest files to report
+    :returns: sizes of the archived files
     """
+    stats = DataStats()
+    heap: List[Tuple[int, str]] = []
+
+    def account(info: tarfile.TarInfo) -> tarfile.TarInfo:
+        info = _clean_info(pkg_dir, epoch, info)
+
+        if not info.isdir():
+            stats.files.append(_member_name(info.name))
+
+        if info.isreg():
+            stats.installed_size += info.size
+            entry = (info.size, info.name[1:])
+
+            if len(heap) < largest:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+
+        return info
+
     with _targz_open(file, epoch) as archive:
-        archive.add(
-            pkg_dir, filter=lambda info: _clean_info(pkg_dir, epoch, info)
-        )
+        archive.add(pkg_dir, filter=account)
+
+    stats.compressed_size = file.tell()
+    stats.largest_files = sorted(heap, reverse=True)
+    return stats
 
 
 def make_ipk(
@@ -126,15 +203,20 @@ def make_ipk(
     pkg_dir: str,
     metadata: str,
     scripts: Dict[str, str],
-) -> None:
+) -> DataStats:
     """
     Create an ipk package.
 
+    The Installed-Size field, in bytes as expected by opkg, is added to the
+    package metadata, and the list of installed files is saved in the
+    control sub-archive.
+
     :param file: file to which the package will be written
     :param epoch: fixed modification time to set
     :param pkg_dir: directory in which the package tree exists
     :param metadata: package metadata (main control file)
     :param scripts: optional maintainer scripts
+    :returns: sizes of the files of the package
     """
     with BytesIO() as control, BytesIO() as data, _targz_open(
         file, epoch
@@ -143,10 +225,142 @@ def make_ipk(
         root_info.type = tarfile.DIRTYPE
         archive.addfile(_clean_info(None, epoch, root_info))
 
-        make_control(control, epoch, metadata, scripts)
-        _add_file(archive, "control.tar.gz", 0o644, epoch, control.getvalue())
+        # The data sub-archive is made first to know the installed size
+        with trace.span("make_data"):
+            stats = make_data(data, epoch, pkg_dir)
 
-        make_data(data, epoch, pkg_dir)
-        _add_file(archive, "data.tar.gz", 0o644, epoch, data.getvalue())
+        with trace.span("make_control"):
+            make_control(
+                control,
+                epoch,
+                metadata + f"Installed-Size: {stats.installed_size}\n",
+                scripts,
+                stats.files,
+            )
+            _add_file(
+                archive, "control.tar.gz", 0o644, epoch, control.getvalue()
+            )
 
+        _add_file(archive, "data.tar.gz", 0o644, epoch, data.getvalue())
         _add_file(archive, "debian-binary", 0o644, epoch, b"2.0\n")
+
+    return stats
+
+
+def _member_name(name: str) -> str:
+    """Normalize the name of an archive member by removing any ./ prefix."""
+    while name.startswith("./"):
+        name = name[2:]
+
+    return name
+
+
+def _read_control_targz(
+    control: IO[bytes], names: FrozenSet[str]
+) -> Dict[str, str]:
+    """
+    Extract files from a control sub-archive.
+
+    :param control: stream of the control.tar.gz sub-archive
+    :param names: names of the files to extract
+    :returns: contents of each of the files that exist, by name
+    """
+    result = {}
+
+    with tarfile.open(fileobj=control, mode="r|gz") as archive:
+        for info in archive:
+            name = _member_name(info.name)
+
+            if name in names and info.isfile():
+                source = archive.extractfile(info)
+                assert source is not None
+                result[name] = source.read().decode()
+
+                if len(result) == len(names):
+                    break
+
+    return result
+
+
+def _read_control_ar(file: IO[bytes], names: FrozenSet[str]) -> Dict[str, str]:
+    """Extract files from the control sub-archive of an ar-format ipk."""
+    while True:
+        header = file.read(_AR_HEADER_SIZE)
+
+        if len(header) < _AR_HEADER_SIZE:
+            raise InvalidPackageError("Missing control.tar.gz member")
+
+        name = header[0:16].decode().strip().rstrip("/")
+        size = int(header[48:58].decode().strip())
+
+        if _member_name(name) == "control.tar.gz":
+            return _read_control_targz(BytesIO(file.read(size)), names)
+
+        # Skip the member contents without reading them, members are
+        # aligned on even offsets
+        file.seek(size + size % 2, os.SEEK_CUR)
+
+
+def _read_control_tar(file: IO[bytes], names: FrozenSet[str]) -> Dict[str, str]:
+    """Extract files from the control sub-archive of a tar-format ipk."""
+    # Read the outer archive as a stream so that members following
+    # control.tar.gz (normally data.tar.gz) are never decompressed
+    with tarfile.open(fileobj=file, mode="r|*") as archive:
+        for info in archive:
+            if _member_name(info.name) == "control.tar.gz":
+                source = archive.extractfile(info)
+                assert source is not None
+                return _read_control_targz(BytesIO(source.read()), names)
+
+    raise InvalidPackageError("Missing control.tar.gz member")
+
+
+def read_control_files(file: IO[bytes], names: Iterable[str]) -> Dict[str, str]:
+    """
+    Read files from the control sub-archive of an ipk package.
+
+    Both the ar-based and the tar-based ipk formats are supported. Only the
+    outer archive headers and the control sub-archive are read.
+
+    :param file: seekable stream of the package
+    :param names: names of the files to read, e.g. “control” or
+        :data:`MANIFEST_NAME`
+    :returns: contents of each of the files that exist, by name
+    :raises InvalidPackageError: if the package cannot be read
+    """
+    magic = file.read(len(_AR_MAGIC))
+
+    try:
+        if magic == _AR_MAGIC:
+            return _read_control_ar(file, frozenset(names))
+
+        file.seek(0)
+        return _read_control_tar(file, frozenset(names))
+    except (tarfile.TarError, EOFError, OSError, ValueError) as err:
+        raise InvalidPackageError(f"Unable to read package: {err}") from err
+
+
+def read_control(file: IO[bytes]) -> str:
+    """
+    Read the package metadata (main control file) from an ipk package.
+
+    :param file: seekable stream of the package
+    :returns: contents of the control file
+    :raises InvalidPackageError: if the package cannot be read
+    """
+    files = read_control_files(file, ("control",))
+
+    if "control" not in files:
+        raise InvalidPackageError("Missing control file in control.tar.gz")
+
+    return files["control"]
+
+
+def parse_manifest(text: str) -> List[str]:
+    """
+    Parse the list of files installed by a package.
+
+    :param text: contents of the :data:`MANIFEST_NAME` control file
+    :returns: paths of the installed files, relative to the root
+    """
+    return [line for line in text.split("\n") if line]
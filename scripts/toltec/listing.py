@@ -0,0 +1,151 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Generate the static web listing of a repository.
+
+The listing is made of a small HTML page and of a compact JSON search index
+holding the metadata of the latest version of each package, which the page
+loads lazily to display, filter and sort the packages. Both files are read
+from the package index instead of the recipes, and are only written again
+when the metadata or the page template change. Gzip compressed variants are
+written next to each file so that they can be served as is.
+"""
+
+from gzip import GzipFile
+import hashlib
+import json
+import logging
+import os
+from typing import Optional
+from . import templating
+from .index import INDEX_NAME, group_versions
+from .util import file_sha256
+
+logger = logging.getLogger(__name__)
+
+# Name of the listing page in a repository
+LISTING_NAME = "index.html"
+
+# Template from which the listing page is rendered
+TEMPLATE_NAME = "listing.html"
+
+# Name of the search index in a repository
+SEARCH_INDEX_NAME = "packages.json"
+
+# Fields of each package in the search index, and the index fields they
+# are read from
+SEARCH_FIELDS = (
+    ("name", "Package"),
+    ("section", "Section"),
+    ("version", "Version"),
+    ("description", "Description"),
+    ("filename", "Filename"),
+    ("url", "Homepage"),
+    ("license", "License"),
+)
+
+
+def make_search_index(index_text: str) -> bytes:
+    """
+    Create the search index of a repository.
+
+    Packages are listed by section, then by name. To keep the index small,
+    each package is an array of the values of :data:`SEARCH_FIELDS`, whose
+    names are given once in the “fields” key.
+
+    :param index_text: contents of the package index
+    :returns: encoded search index
+    """
+    packages = sorted(
+        (
+            [candidates[0].get(key, "") for _, key in SEARCH_FIELDS]
+            for candidates in group_versions(index_text).values()
+        ),
+        key=lambda package: (package[1], package[0]),
+    )
+    return json.dumps(
+        {"fields": [name for name, _ in SEARCH_FIELDS], "packages": packages},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode()
+
+
+def _write(path: str, contents: bytes) -> None:
+    """Atomically write a file and its gzip compressed variant."""
+    temp_suffix = f".{os.getpid()}.tmp"
+
+    with open(path + ".gz" + temp_suffix, "wb") as gzip_file, GzipFile(
+        filename=os.path.basename(path),
+        mode="wb",
+        compresslevel=9,
+        fileobj=gzip_file,
+        mtime=0,
+    ) as compressed:
+        compressed.write(contents)
+
+    with open(path + temp_suffix, "wb") as file:
+        file.write(contents)
+
+    os.replace(path + ".gz" + temp_suffix, path + ".gz")
+    os.replace(path + temp_suffix, path)
+
+
+def _load_hash(state_path: Optional[str]) -> Optional[str]:
+    """Load the hash of the last generated listing."""
+    if state_path is None:
+        return None
+
+    try:
+        with open(state_path, "r") as state_file:
+            return json.load(state_file).get("hash")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def make_listing(repo_dir: str, state_path: Optional[str] = None) -> bool:
+    """
+    Generate the web listing of a repository from its package index.
+
+    :param repo_dir: repository directory, which must have an index
+    :param state_path: file in which to remember the hash of the generated
+        listing, to skip generating it again if nothing changed
+    :returns: true if the listing was written, false if it was up to date
+    """
+    with open(os.path.join(repo_dir, INDEX_NAME), "r") as index_file:
+        search_index = make_search_index(index_file.read())
+
+    template = templating.env.get_template(TEMPLATE_NAME)
+    digest = hashlib.sha256(
+        search_index
+        + b"\0"
+        + file_sha256(
+            os.path.join(os.path.dirname(__file__), "templates", TEMPLATE_NAME)
+        ).encode()
+    ).hexdigest()
+    outputs = [
+        os.path.join(repo_dir, name + suffix)
+        for name in (LISTING_NAME, SEARCH_INDEX_NAME)
+        for suffix in ("", ".gz")
+    ]
+
+    if _load_hash(state_path) == digest and all(
+        os.path.isfile(output) for output in outputs
+    ):
+        logger.debug("Web listing is up to date")
+        return False
+
+    _write(os.path.join(repo_dir, SEARCH_INDEX_NAME), search_index)
+    _write(
+        os.path.join(repo_dir, LISTING_NAME),
+        template.render(
+            search_index=f"./{SEARCH_INDEX_NAME}?v={digest[:16]}"
+        ).encode(),
+    )
+
+    if state_path is not None:
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+
+        with open(state_path, "w") as state_file:
+            json.dump({"hash": digest}, state_file)
+
+    return True
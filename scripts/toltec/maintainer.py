@@ -0,0 +1,117 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Generate the install scripts of packages in the Debian format."""
+
+import textwrap
+from typing import Dict
+from . import bash
+from .recipe import Package
+
+
+def read_library(path: str) -> str:
+    """
+    Read the library of functions available to install scripts.
+
+    :param path: path to the library
+    :returns: contents of the library, without its comment lines
+    """
+    library = ""
+
+    with open(path, "r") as file:
+        for line in file:
+            if not line.strip().startswith("#"):
+                library += line
+
+    return library
+
+
+def _run_on(action: str, body: str) -> str:
+    """Wrap a script body so that it only runs for a given action."""
+    return "\n".join(
+        (
+            textwrap.dedent(
+                f"""\
+                if [[ $1 = {action} ]]; then
+                    script() {{
+                """
+            ),
+            body,
+            textwrap.dedent(
+                """\
+                    }
+                    script
+                fi
+                """
+            ),
+        )
+    )
+
+
+def make_scripts(
+    package: Package,
+    library_variables: bash.Variables,
+    library_functions: bash.Functions,
+) -> Dict[str, str]:
+    """
+    Convert the install functions of a package to Debian install scripts.
+
+    Each script only declares the variables and functions it uses.
+
+    :param package: package whose install functions to convert
+    :param library_variables: variables declared by the install library
+    :param library_functions: functions declared by the install library
+    :returns: contents of each install script (preinst, postinst, prerm
+        and postrm), by name
+    """
+    variables = {
+        **package.parent.variables,
+        **package.variables,
+        **package.custom_variables,
+        **library_variables,
+    }
+    functions = {
+        **package.custom_functions,
+        **library_functions,
+    }
+
+    def with_header(body: str) -> str:
+        """Prepend the declarations used by an install script."""
+        used_variables, used_functions = bash.reachable_declarations(
+            body, variables, functions
+        )
+        return "\n".join(
+            (
+                textwrap.dedent(
+                    """\
+                    #!/usr/bin/env bash
+                    set -euo pipefail
+                    """
+                ),
+                bash.put_variables(used_variables),
+                bash.put_functions(used_functions),
+                body,
+            )
+        )
+
+    scripts = {}
+
+    for name, script, action in (
+        ("preinstall", "preinst", "install"),
+        ("configure", "postinst", "configure"),
+    ):
+        if package.functions[name]:
+            scripts[script] = with_header(
+                _run_on(action, package.functions[name])
+            )
+
+    for step in ("pre", "post"):
+        body = "".join(
+            _run_on(action, package.functions[step + action])
+            for action in ("upgrade", "remove")
+            if package.functions[step + action]
+        )
+
+        if body:
+            scripts[step + "rm"] = with_header(body)
+
+    return scripts
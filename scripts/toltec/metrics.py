@@ -0,0 +1,365 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Export build metrics for Prometheus.
+
+Metrics are collected in memory throughout a run and written with
+:func:`write` in the text format read by the textfile collector of the
+Prometheus node exporter. Files are replaced atomically, so the collector
+never reads a partially written file.
+"""
+
+import abc
+from bisect import bisect_left
+import logging
+import math
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Values of the labels of a sample, in the order in which they are declared
+_LabelValues = Tuple[str, ...]
+
+# Upper bounds of the default histogram buckets, in seconds
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+
+def _escape(value: str) -> str:
+    """Escape a label value."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value."""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+class Metric(abc.ABC):
+    """Base class for all metrics."""
+
+    # Type of the metric in the exposition format
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, description: str, labels: Sequence[str] = ()
+    ) -> None:
+        """
+        Declare a metric.
+
+        :param name: name of the metric
+        :param description: help text of the metric
+        :param labels: names of the labels of the metric
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> _LabelValues:
+        """Get the label values of a sample, checking the label names."""
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                f"Metric {self.name} expects labels {self.labels}, "
+                f"got {tuple(labels)}"
+            )
+
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(
+        self, values: _LabelValues, extra: Optional[Tuple[str, str]] = None
+    ) -> str:
+        """Format the labels of a sample."""
+        pairs = list(zip(self.labels, values))
+
+        if extra is not None:
+            pairs.append(extra)
+
+        if not pairs:
+            return ""
+
+        return (
+            "{"
+            + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+            + "}"
+        )
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[str]:
+        """Format the samples of the metric."""
+
+    def exposition(self) -> str:
+        """Format the metric in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    kind = "counter"
+
+    def __init__(
+        self, name: str, description: str, labels: Sequence[str] = ()
+    ) -> None:
+        super().__init__(name, description, labels)
+        self._values: Dict[_LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """
+        Increase the count.
+
+        :param amount: amount to add to the count
+        :param labels: value of each label of the metric
+        """
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Get the current count."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for key, value in values:
+            yield f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, description: str, labels: Sequence[str] = ()
+    ) -> None:
+        super().__init__(name, description, labels)
+        self._values: Dict[_LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        """
+        Set the current value.
+
+        :param value: new value of the gauge
+        :param labels: value of each label of the metric
+        """
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for key, value in values:
+            yield f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DURATION_BUCKETS,
+    ) -> None:
+        """
+        Declare a histogram.
+
+        :param name: name of the metric
+        :param description: help text of the metric
+        :param labels: names of the labels of the metric
+        :param buckets: upper bounds of the buckets, in increasing order
+        """
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+        # Count of observations in each bucket, sum and count of observations
+        self._values: Dict[_LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Record an observation.
+
+        :param value: observed value
+        :param labels: value of each label of the metric
+        """
+        key = self._key(labels)
+        bucket = bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            counts[bucket] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total, count))
+                for key, (counts, total, count) in self._values.items()
+            )
+
+        for key, (counts, total, count) in values:
+            cumulative = 0
+
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = self._format_labels(key, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+
+            labels = self._format_labels(key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+# Recipes considered by the build, by result (built, cached, failed or
+# skipped because their packages are already available)
+RECIPES = Counter(
+    "toltec_recipes_total",
+    "Number of recipes considered by the build, by result.",
+    ("result",),
+)
+
+# Duration of each build stage
+STAGE_DURATION = Histogram(
+    "toltec_stage_duration_seconds",
+    "Duration of recipe build stages.",
+    ("stage",),
+)
+
+# Bytes downloaded from the network
+DOWNLOADED_BYTES = Counter(
+    "toltec_downloaded_bytes_total",
+    "Number of bytes downloaded, by kind of file (source or package).",
+    ("kind",),
+)
+
+# Bytes written to package archives
+ARCHIVED_BYTES = Counter(
+    "toltec_archived_bytes_total",
+    "Number of bytes written to package archives.",
+)
+
+# Lookups in the artifact cache
+CACHE_LOOKUPS = Counter(
+    "toltec_artifact_cache_lookups_total",
+    "Number of artifact cache lookups, by result (hit or miss).",
+    ("result",),
+)
+
+# Ratio of artifact cache lookups that were hits
+CACHE_HIT_RATIO = Gauge(
+    "toltec_artifact_cache_hit_ratio",
+    "Ratio of artifact cache lookups that restored the packages.",
+)
+
+# Bash scripts run on the host or in containers
+BASH_INVOCATIONS = Counter(
+    "toltec_bash_invocations_total",
+    "Number of Bash scripts run, by place (host or container).",
+    ("place",),
+)
+
+# Docker containers started
+DOCKER_CONTAINERS = Counter(
+    "toltec_docker_containers_total",
+    "Number of Docker containers started, by image.",
+    ("image",),
+)
+
+# Time of the last write of the metrics
+LAST_WRITE = Gauge(
+    "toltec_metrics_last_write_timestamp_seconds",
+    "Unix time at which the metrics were last written.",
+)
+
+# All the exported metrics
+METRICS: List[Metric] = [
+    RECIPES,
+    STAGE_DURATION,
+    DOWNLOADED_BYTES,
+    ARCHIVED_BYTES,
+    CACHE_LOOKUPS,
+    CACHE_HIT_RATIO,
+    BASH_INVOCATIONS,
+    DOCKER_CONTAINERS,
+    LAST_WRITE,
+]
+
+
+def record_cache_lookup(hit: bool) -> None:
+    """Account for a lookup in the artifact cache."""
+    CACHE_LOOKUPS.inc(result="hit" if hit else "miss")
+    hits = CACHE_LOOKUPS.value(result="hit")
+    misses = CACHE_LOOKUPS.value(result="miss")
+    CACHE_HIT_RATIO.set(hits / (hits + misses))
+
+
+def write(path: str) -> None:
+    """
+    Atomically write all the metrics to a file.
+
+    :param path: path to the file, which should end in “.prom” to be picked
+        up by the node exporter
+    """
+    LAST_WRITE.set(time.time())
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(temp_path, "w") as file:
+        for metric in METRICS:
+            file.write(metric.exposition())
+
+    os.replace(temp_path, path)
+
+
+class PeriodicWriter(threading.Thread):
+    """Background thread writing the metrics at a regular interval."""
+
+    def __init__(self, path: str, interval: float) -> None:
+        """
+        Prepare to write the metrics periodically.
+
+        :param path: path to the metrics file
+        :param interval: seconds between two writes
+        """
+        super().__init__(name="metrics", daemon=True)
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                write(self.path)
+            except OSError as err:
+                logger.warning("Unable to write metrics: %s", err)
+
+    def stop(self) -> None:
+        """Stop writing the metrics."""
+        self._stopped.set()
+        self.join()
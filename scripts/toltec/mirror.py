@@ -0,0 +1,244 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Mirror files from a remote server.
+
+Transfers run concurrently up to a configurable limit and stream data with
+large buffers into temporary files, which are renamed to their final location
+only once complete and verified. Interrupted transfers are retried with an
+exponential backoff and resumed where they stopped when the server supports
+range requests.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+import requests
+from .util import file_sha256, HTTP_DATE_FORMAT
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the remote server before giving up on a request
+TIMEOUT = 30
+
+# Size of the buffers used to stream transferred data to disk
+CHUNK_SIZE = 1024 * 1024
+
+# Minimum number of seconds between two progress reports
+PROGRESS_INTERVAL = 5
+
+
+class MirrorError(Exception):
+    """Raised when a transfer fails permanently."""
+
+
+class _TransientError(Exception):
+    """Raised when a transfer attempt fails in a way that can be retried."""
+
+
+@dataclass
+class Transfer:
+    """File to transfer from a remote server."""
+
+    # Remote location of the file
+    url: str
+
+    # Path at which the file is saved
+    path: str
+
+    # Expected SHA-256 checksum of the file, if known
+    sha256: Optional[str] = None
+
+
+class _Progress:
+    """Thread-safe accounting of finished transfers."""
+
+    def __init__(self, total: int) -> None:
+        """
+        Start accounting for transfers.
+
+        :param total: total number of transfers
+        """
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+
+    def add_bytes(self, count: int) -> None:
+        """Account for transferred bytes."""
+        with self._lock:
+            self.bytes += count
+
+    def finish(self, success: bool) -> None:
+        """Account for a finished transfer and report progress."""
+        with self._lock:
+            if success:
+                self.done += 1
+            else:
+                self.failed += 1
+
+            now = time.monotonic()
+
+            if now - self._last_report >= PROGRESS_INTERVAL:
+                self._last_report = now
+                logger.info("Fetched %s", self.summary())
+
+    def summary(self) -> str:
+        """Get a summary of the progress and throughput."""
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return "%d/%d file(s), %.1f MiB in %.1f s (%.1f MiB/s)" % (
+            self.done,
+            self.total,
+            self.bytes / 1024 / 1024,
+            elapsed,
+            self.bytes / 1024 / 1024 / elapsed,
+        )
+
+
+class Mirror:  # pylint:disable=too-few-public-methods
+    """Concurrent, resumable file mirroring engine."""
+
+    def __init__(  # pylint:disable=too-many-arguments
+        self,
+        session: requests.Session,
+        temp_dir: str,
+        jobs: int = 8,
+        retries: int = 4,
+        backoff: float = 1.0,
+    ) -> None:
+        """
+        Create a mirroring engine.
+
+        :param session: HTTP session used for all requests
+        :param temp_dir: directory for incomplete transfers, which must be
+            on the same file system as the destination files
+        :param jobs: maximum number of concurrent transfers
+        :param retries: number of times a failed transfer is retried
+        :param backoff: seconds to wait before the first retry, doubled
+            after each subsequent attempt
+        """
+        self.session = session
+        self.temp_dir = temp_dir
+        self.jobs = jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.transferred = 0
+
+    def fetch(self, transfers: List[Transfer]) -> List[Transfer]:
+        """
+        Run a set of transfers.
+
+        The modification time of each saved file is set from the
+        Last-Modified header sent by the server.
+
+        :param transfers: transfers to run
+        :returns: transfers that completed successfully
+        """
+        os.makedirs(self.temp_dir, exist_ok=True)
+        progress = _Progress(len(transfers))
+
+        def run(transfer: Transfer) -> bool:
+            try:
+                self._fetch_retry(transfer, progress)
+                success = True
+            except MirrorError as err:
+                logger.warning("%s", err)
+                success = False
+
+            progress.finish(success)
+            return success
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = list(executor.map(run, transfers))
+
+        self.transferred += progress.bytes
+        logger.info("Fetched %s", progress.summary())
+        return [
+            transfer for transfer, success in zip(transfers, results) if success
+        ]
+
+    def _fetch_retry(self, transfer: Transfer, progress: _Progress) -> None:
+        """Run a transfer, retrying on transient failures."""
+        temp_path = os.path.join(
+            self.temp_dir, os.path.basename(transfer.path) + ".part"
+        )
+        attempt = 0
+        delay = self.backoff
+
+        while True:
+            try:
+                self._fetch_once(transfer, temp_path, progress)
+                return
+            except (requests.RequestException, _TransientError) as err:
+                attempt += 1
+
+                if attempt > self.retries:
+                    message = (
+                        f"Unable to fetch {transfer.url} after "
+                        f"{attempt} attempt(s): {err}"
+                    )
+                    raise MirrorError(message) from err
+
+                logger.debug(
+                    "Retrying %s in %.1f s: %s", transfer.url, delay, err
+                )
+                time.sleep(delay)
+                delay *= 2
+
+    def _fetch_once(
+        self, transfer: Transfer, temp_path: str, progress: _Progress
+    ) -> None:
+        """Make one attempt at running a transfer."""
+        offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with self.session.get(
+            transfer.url, headers=headers, stream=True, timeout=TIMEOUT
+        ) as req:
+            if req.status_code == 206:
+                mode = "ab"
+            elif req.status_code == 200:
+                mode = "wb"
+            elif req.status_code == 416:
+                # Partial file is larger than the remote file, start over
+                os.remove(temp_path)
+                raise _TransientError("Invalid partial file")
+            elif req.status_code in (408, 429) or req.status_code >= 500:
+                raise _TransientError(f"Got status code {req.status_code}")
+            else:
+                raise MirrorError(
+                    f"Unable to fetch {transfer.url}, got status code \
+{req.status_code}"
+                )
+
+            with open(temp_path, mode) as local:
+                for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+                    local.write(chunk)
+                    progress.add_bytes(len(chunk))
+
+            last_modified_str = req.headers.get("Last-Modified")
+
+        if (
+            transfer.sha256 is not None
+            and file_sha256(temp_path) != transfer.sha256
+        ):
+            os.remove(temp_path)
+            raise _TransientError("Invalid checksum")
+
+        if last_modified_str is not None:
+            last_modified = int(
+                datetime.strptime(
+                    last_modified_str, HTTP_DATE_FORMAT
+                ).timestamp()
+            )
+            os.utime(temp_path, (last_modified, last_modified))
+
+        os.replace(temp_path, transfer.path)
@@ -18,3 +18,15 @@ WORK_DIR = os.path.join(GIT_DIR, "build", "package")
 
 # Directory used for storing built packages
 REPO_DIR = os.path.join(GIT_DIR, "build", "repo")
+
+# Directory where logs of repository-wide build steps are stored
+LOG_DIR = os.path.join(GIT_DIR, "build", "logs")
+
+# Directory where sources are fetched ahead of their recipe builds
+PREFETCH_DIR = os.path.join(GIT_DIR, "build", "prefetch")
+
+# Directory used for storing data reused across builds
+CACHE_DIR = os.path.join(GIT_DIR, "build", "cache")
+
+# Database in which the history of builds is recorded
+BUILD_DB = os.path.join(GIT_DIR, "build", "history.sqlite")
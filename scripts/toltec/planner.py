@@ -0,0 +1,271 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Plan the order in which recipes are built.
+
+The duration of each stage of a recipe build is recorded after every
+successful build. Recipes do not depend on each other at build time, so the
+critical path of a parallel build is made of single recipes and the plan
+starts the longest recipes first, each on the least loaded worker (longest
+processing time first scheduling).
+
+The peak memory use of each recipe build is recorded as well. When the memory
+of the host is limited, builds are only started alongside other builds if
+they all fit in the available memory.
+"""
+
+from dataclasses import dataclass
+import heapq
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Version of the history file format, bump when the layout changes
+_FORMAT_VERSION = 1
+
+# Weight of the latest build in the recorded duration of each stage, the
+# remaining weight going to the previously recorded duration
+_SMOOTHING = 0.5
+
+# Estimated duration in seconds of a recipe that was never built, used when
+# no other recipe was built either
+DEFAULT_ESTIMATE = 60.0
+
+
+class DurationHistory:
+    """Persistent record of the duration of recipe build stages."""
+
+    def __init__(self, path: str) -> None:
+        """
+        Load the build history from disk.
+
+        A missing, unreadable or outdated history file yields an empty
+        history.
+
+        :param path: path to the file in which the history is stored
+        """
+        self.path = path
+        self._recipes: Dict[str, Dict[str, float]] = {}
+        self._memory: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+
+            if data.get("version") == _FORMAT_VERSION:
+                self._recipes = data["recipes"]
+                self._memory = data.get("memory", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, AttributeError) as err:
+            logger.warning("Ignoring invalid build history '%s': %s", path, err)
+
+    def record(
+        self,
+        recipe_name: str,
+        stages: Dict[str, float],
+        peak_memory: int = 0,
+    ) -> None:
+        """
+        Record the stage durations of a successful build and save them.
+
+        :param recipe_name: name of the built recipe
+        :param stages: duration in seconds of each stage of the build
+        :param peak_memory: highest memory use of the build containers, in
+            bytes (0 if unknown)
+        """
+        with self._lock:
+            previous = self._recipes.get(recipe_name, {})
+            self._recipes[recipe_name] = {
+                stage: (
+                    _SMOOTHING * duration + (1 - _SMOOTHING) * previous[stage]
+                    if stage in previous
+                    else duration
+                )
+                for stage, duration in stages.items()
+            }
+
+            if peak_memory:
+                self._memory[recipe_name] = peak_memory
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+
+            with open(temp_path, "w") as file:
+                json.dump(
+                    {
+                        "version": _FORMAT_VERSION,
+                        "recipes": self._recipes,
+                        "memory": self._memory,
+                    },
+                    file,
+                    indent=4,
+                    sort_keys=True,
+                )
+
+            os.replace(temp_path, self.path)
+
+    def stages(self, recipe_name: str) -> Optional[Dict[str, float]]:
+        """Get the recorded stage durations of a recipe, if any."""
+        return self._recipes.get(recipe_name)
+
+    def memory(self, recipe_name: str) -> Optional[int]:
+        """Get the recorded peak memory use of a recipe build, if any."""
+        return self._memory.get(recipe_name)
+
+    def estimate(self, recipe_name: str) -> float:
+        """
+        Estimate the duration of a recipe build.
+
+        Recipes which were never built are assumed to take as long as the
+        average recorded recipe.
+
+        :param recipe_name: name of the recipe
+        :returns: estimated duration in seconds
+        """
+        stages = self._recipes.get(recipe_name)
+
+        if stages is not None:
+            return sum(stages.values())
+
+        if self._recipes:
+            return sum(
+                sum(stages.values()) for stages in self._recipes.values()
+            ) / len(self._recipes)
+
+        return DEFAULT_ESTIMATE
+
+
+@dataclass
+class PlannedBuild:
+    """Recipe build scheduled by the planner."""
+
+    # Name of the recipe to build
+    recipe: str
+
+    # Names of the packages to build
+    packages: List[str]
+
+    # Estimated duration of the build in seconds
+    estimate: float
+
+    # Whether the packages can be restored from the artifact cache
+    cached: bool
+
+    # Index of the worker expected to run the build
+    worker: int
+
+    # Estimated time at which the build starts, in seconds from the start
+    start: float
+
+    # Memory reserved for the build, in bytes
+    memory: int = 0
+
+
+def plan(  # pylint: disable=too-many-arguments
+    builds: Dict[str, List[str]],
+    history: DurationHistory,
+    jobs: int = 1,
+    cached: Optional[Set[str]] = None,
+    memory: Optional[Dict[str, int]] = None,
+    host_memory: Optional[int] = None,
+) -> List[PlannedBuild]:
+    """
+    Plan a set of recipe builds.
+
+    :param builds: packages to build, grouped by recipe
+    :param history: durations of the previous builds
+    :param jobs: number of recipes built in parallel
+    :param cached: recipes whose packages are in the artifact cache, which
+        are assumed to take no time
+    :param memory: memory needed by each recipe build, in bytes
+    :param host_memory: memory available to concurrent builds, in bytes
+        (default: unlimited)
+    :returns: scheduled builds, in the order in which they must be started
+    """
+    cached = cached or set()
+    memory = memory or {}
+    estimates = {
+        recipe: 0.0 if recipe in cached else history.estimate(recipe)
+        for recipe in builds
+    }
+    order = sorted(builds, key=lambda recipe: (-estimates[recipe], recipe))
+
+    # Workers ordered by the time at which they are available
+    workers = [(0.0, worker) for worker in range(max(jobs, 1))]
+
+    # Builds in progress, ordered by the time at which they end, with the
+    # memory they use
+    running: List[Tuple[float, int]] = []
+    result = []
+
+    for recipe in order:
+        start, worker = heapq.heappop(workers)
+        demand = 0 if recipe in cached else memory.get(recipe, 0)
+
+        if host_memory is not None:
+            while running and running[0][0] <= start:
+                heapq.heappop(running)
+
+            # Wait for other builds to end until there is enough memory,
+            # running oversized builds alone
+            while (
+                running
+                and sum(used for _, used in running) + demand > host_memory
+            ):
+                start = max(start, heapq.heappop(running)[0])
+
+            heapq.heappush(running, (start + estimates[recipe], demand))
+
+        result.append(
+            PlannedBuild(
+                recipe=recipe,
+                packages=builds[recipe],
+                estimate=estimates[recipe],
+                cached=recipe in cached,
+                worker=worker,
+                start=start,
+                memory=demand,
+            )
+        )
+        heapq.heappush(workers, (start + estimates[recipe], worker))
+
+    return result
+
+
+def makespan(builds: Iterable[PlannedBuild]) -> float:
+    """Get the estimated wall-clock duration of a plan."""
+    return max((build.start + build.estimate for build in builds), default=0.0)
+
+
+def format_plan(builds: List[PlannedBuild]) -> str:
+    """Format a plan for display."""
+    lines = []
+
+    for build in builds:
+        lines.append(
+            "{start:>8.0f}s  worker {worker:<3d} {recipe:<30} {estimate:>7.0f}s"
+            "{cached}  ({packages})".format(
+                start=build.start,
+                worker=build.worker,
+                recipe=build.recipe,
+                estimate=build.estimate,
+                cached=" (cached)" if build.cached else "",
+                packages=", ".join(build.packages),
+            )
+        )
+
+    lines.append(
+        "Estimated wall-clock time: {:.0f}s for {} recipe(s), {} from the "
+        "artifact cache".format(
+            makespan(builds),
+            len(builds),
+            sum(1 for build in builds if build.cached),
+        )
+    )
+    return "\n".join(lines)
@@ -0,0 +1,159 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Fetch the sources of upcoming recipe builds in the background.
+
+While a recipe is being built, the sources of the next recipes in the build
+order are fetched, verified and extracted to a staging directory, from which
+they are moved to the build directory when the recipe’s turn comes. This
+overlaps network transfers with the builds, which are mostly bound by the
+CPU.
+"""
+
+from collections import deque
+import logging
+import os
+import shutil
+import threading
+from typing import Deque, Dict, Iterable, Optional, Tuple
+from . import paths
+from .builder import Builder
+
+logger = logging.getLogger(__name__)
+
+
+def _tree_size(root: str) -> int:
+    """Get the total size of the files under a directory, in bytes."""
+    return sum(
+        os.path.getsize(os.path.join(directory, filename))
+        for directory, _, filenames in os.walk(root)
+        for filename in filenames
+        if not os.path.islink(os.path.join(directory, filename))
+    )
+
+
+class Prefetcher:  # pylint: disable=too-many-instance-attributes
+    """Background fetcher of the sources of upcoming builds."""
+
+    def __init__(
+        self,
+        builder: Builder,
+        recipes: Iterable[str],
+        depth: int = 2,
+        max_size: Optional[int] = None,
+    ) -> None:
+        """
+        Prepare to fetch sources in the background.
+
+        :param builder: builder used to fetch the sources
+        :param recipes: names of the recipes to prefetch, in build order
+        :param depth: maximum number of recipes whose sources are staged
+            but not yet taken by their build
+        :param max_size: once the staged sources reach this size in bytes,
+            wait for builds to take them before fetching more (the limit can
+            be exceeded by the sources of one recipe)
+        """
+        self.builder = builder
+        self.depth = depth
+        self.max_size = max_size
+        self._queue: Deque[str] = deque(recipes)
+        self._staged: Dict[str, Tuple[str, int]] = {}
+        self._running: Optional[str] = None
+        self._cancelled = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="prefetch", daemon=True
+        )
+
+    def start(self) -> None:
+        """Start fetching sources, discarding leftovers of previous runs."""
+        shutil.rmtree(paths.PREFETCH_DIR, ignore_errors=True)
+        self._thread.start()
+
+    def _can_fetch(self) -> bool:
+        """Check whether the next recipe can be prefetched."""
+        if self._cancelled or not self._queue:
+            return True
+
+        if len(self._staged) >= self.depth:
+            return False
+
+        return (
+            self.max_size is None
+            or sum(size for _, size in self._staged.values()) < self.max_size
+        )
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(self._can_fetch)
+
+                if self._cancelled or not self._queue:
+                    return
+
+                recipe_name = self._queue.popleft()
+                self._running = recipe_name
+
+            src_dir = os.path.join(paths.PREFETCH_DIR, recipe_name)
+            size = None
+
+            try:
+                shutil.rmtree(src_dir, ignore_errors=True)
+                os.makedirs(src_dir)
+                self.builder.fetch_sources(recipe_name, src_dir)
+                size = _tree_size(src_dir)
+            except Exception as err:  # pylint:disable=broad-except
+                # The build will fetch the sources itself and report errors
+                logger.warning(
+                    "Unable to prefetch sources of %s: %s", recipe_name, err
+                )
+
+            with self._condition:
+                self._running = None
+
+                if size is not None and not self._cancelled:
+                    self._staged[recipe_name] = (src_dir, size)
+                else:
+                    shutil.rmtree(src_dir, ignore_errors=True)
+
+                self._condition.notify_all()
+
+    def take(self, recipe_name: str) -> Optional[str]:
+        """
+        Get the prefetched sources of a recipe which is about to be built.
+
+        Waits for the sources if they are being fetched. If they were not
+        fetched yet, they are removed from the queue so that the build
+        fetches them itself.
+
+        :param recipe_name: name of the recipe
+        :returns: directory containing the sources, which the caller must
+            move or remove, or None if the sources were not prefetched
+        """
+        with self._condition:
+            if recipe_name in self._queue:
+                self._queue.remove(recipe_name)
+                return None
+
+            self._condition.wait_for(lambda: self._running != recipe_name)
+            staged = self._staged.pop(recipe_name, None)
+            self._condition.notify_all()
+
+        return staged[0] if staged is not None else None
+
+    def cancel(self) -> None:
+        """
+        Stop prefetching and remove the sources that were not taken.
+
+        A transfer in progress is not interrupted, but its result is
+        discarded.
+        """
+        with self._condition:
+            self._cancelled = True
+            self._queue.clear()
+
+            for src_dir, _ in self._staged.values():
+                shutil.rmtree(src_dir, ignore_errors=True)
+
+            self._staged.clear()
+            self._condition.notify_all()
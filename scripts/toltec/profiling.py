@@ -0,0 +1,209 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Profile the build tooling.
+
+When profiling is enabled with :func:`enable`, each region delimited with
+:func:`stage` is run under cProfile and its statistics are saved as a pstats
+file, which can be inspected with `python -m pstats` or snakeviz. Regions
+delimited with :func:`memory` are additionally measured with tracemalloc if
+memory profiling is enabled. Both functions return a no-op context manager
+while profiling is disabled.
+
+Stages must not be nested within the same thread, since cProfile can only
+run one profiler per thread. Memory measurements are process-wide, so they
+include allocations from other threads when recipes are built in parallel.
+"""
+
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+import cProfile
+from functools import wraps
+import io
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+# Context manager returned when profiling is disabled
+_NULL_REGION = nullcontext()
+
+# Number of frames recorded for each allocation by tracemalloc
+_TRACEMALLOC_FRAMES = 8
+
+
+class Profiler:
+    """Collect profiles of build stages."""
+
+    def __init__(self, track_memory: bool = False) -> None:
+        """
+        Start profiling.
+
+        :param track_memory: whether to measure memory allocations
+        """
+        self.track_memory = track_memory
+        self.stats: Optional[pstats.Stats] = None
+        self.peaks: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(_TRACEMALLOC_FRAMES)
+
+    @contextmanager
+    def stage(self, name: str, directory: str) -> Iterator[None]:
+        """
+        Profile a stage and save its statistics.
+
+        :param name: name of the stage, used as the name of the pstats file
+        :param directory: directory in which to save the pstats file
+        """
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # Recent Python versions only allow a single active profiler
+            # per process, in which case concurrent stages are not profiled
+            logger.warning("Not profiling stage %s (profiler busy)", name)
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            os.makedirs(directory, exist_ok=True)
+            profile.dump_stats(os.path.join(directory, f"{name}.pstats"))
+
+            with self._lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    @contextmanager
+    def region(self, name: str) -> Iterator[None]:
+        """
+        Measure the peak memory allocated in a region of code.
+
+        Before Python 3.9, the peak cannot be reset and the measured peak
+        is the highest one since profiling started.
+
+        :param name: name under which the allocations are accounted
+        """
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()  # type: ignore
+
+        start, _ = tracemalloc.get_traced_memory()
+
+        try:
+            yield
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+
+            with self._lock:
+                self.peaks[name] = max(self.peaks.get(name, 0), peak - start)
+
+    def summary(self, top: int) -> str:
+        """
+        Summarize the collected profiles.
+
+        :param top: number of functions and regions to show
+        :returns: summary of the hottest functions and of the regions with
+            the highest memory peaks
+        """
+        lines: List[str] = []
+
+        if self.stats is not None:
+            output = io.StringIO()
+            self.stats.stream = output  # type: ignore
+            self.stats.sort_stats("cumulative").print_stats(top)
+            lines.append(output.getvalue().strip())
+
+        if self.peaks:
+            lines.append("Peak memory allocations:")
+            lines.extend(
+                f"  {name}: {peak / 1024 / 1024:.1f} MiB"
+                for name, peak in sorted(
+                    self.peaks.items(), key=lambda item: -item[1]
+                )[:top]
+            )
+
+        return "\n".join(lines)
+
+
+# Profiler in use, if profiling is enabled
+_profiler: Optional[Profiler] = None  # pylint:disable=invalid-name
+
+
+def enable(track_memory: bool = False) -> Profiler:
+    """
+    Start profiling.
+
+    :param track_memory: whether to measure memory allocations
+    """
+    global _profiler  # pylint:disable=global-statement,invalid-name
+    _profiler = Profiler(track_memory)
+    return _profiler
+
+
+def stage(name: str, directory: str) -> AbstractContextManager:
+    """
+    Profile a build stage, if profiling is enabled.
+
+    :param name: name of the stage
+    :param directory: directory in which to save the statistics
+    :returns: context manager delimiting the stage
+    """
+    profiler = _profiler
+
+    if profiler is None:
+        return _NULL_REGION
+
+    return profiler.stage(name, directory)
+
+
+def memory(name: str) -> AbstractContextManager:
+    """
+    Measure the memory allocated in a region, if memory profiling is enabled.
+
+    :param name: name under which the allocations are accounted
+    :returns: context manager delimiting the region
+    """
+    profiler = _profiler
+
+    if profiler is None or not profiler.track_memory:
+        return _NULL_REGION
+
+    return profiler.region(name)
+
+
+def profiled(
+    directory: str,
+) -> Callable[[Callable[..., _T]], Callable[..., _T]]:
+    """
+    Profile each call to a function, if profiling is enabled.
+
+    :param directory: directory in which to save the statistics
+    """
+
+    def decorator(function: Callable[..., _T]) -> Callable[..., _T]:
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> _T:
+            with stage(function.__name__, directory):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def print_summary(top: int) -> None:
+    """Print a summary of the collected profiles, if profiling."""
+    if _profiler is not None:
+        print(_profiler.summary(top))
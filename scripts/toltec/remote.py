@@ -0,0 +1,182 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Access remote package repositories.
+
+The state of a remote repository is known from its package index, which is
+fetched once per run and only transferred again when it has changed. Package
+archives are then mirrored concurrently over a shared pool of connections
+and verified against the checksums recorded in the index.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from . import index, metrics, paths
+from .mirror import Mirror, Transfer
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the remote server before giving up
+TIMEOUT = 30
+
+
+class RemoteError(Exception):
+    """Raised when a remote repository cannot be accessed."""
+
+
+class RemoteRepo:
+    """Remote repository of Toltec packages."""
+
+    def __init__(self, url: str, jobs: int = 8) -> None:
+        """
+        Create a client for a remote repository.
+
+        :param url: root URL of the repository
+        :param jobs: maximum number of concurrent downloads
+        """
+        self.url = url.rstrip("/")
+        self.jobs = jobs
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.cache_dir = os.path.join(
+            paths.CACHE_DIR,
+            "remote",
+            hashlib.sha256(self.url.encode()).hexdigest()[:16],
+        )
+
+    def fetch_index(self) -> Dict[str, Dict[str, str]]:
+        """
+        Fetch the package index of the repository.
+
+        The last fetched copy of the index is kept in the cache directory and
+        the request is made conditional on the index having changed since.
+
+        :returns: fields of each index entry, keyed by package file name
+        :raises RemoteError: if the index cannot be fetched
+        """
+        index_url = f"{self.url}/{index.INDEX_GZIP_NAME}"
+        cached_path = os.path.join(self.cache_dir, index.INDEX_GZIP_NAME)
+        meta_path = cached_path + ".json"
+        headers = {}
+
+        try:
+            with open(meta_path, "r") as meta_file:
+                meta = json.load(meta_file)
+
+            if os.path.isfile(cached_path):
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+        except (OSError, ValueError):
+            pass
+
+        try:
+            req = self.session.get(index_url, headers=headers, timeout=TIMEOUT)
+        except requests.RequestException as err:
+            raise RemoteError(
+                f"Unable to fetch remote index '{index_url}': {err}"
+            ) from err
+
+        if req.status_code == 304:
+            logger.debug("Remote index is unchanged since last run")
+        elif req.status_code == 404:
+            # Treating a missing index as empty would rebuild everything
+            raise RemoteError(f"Remote repository has no index at {index_url}")
+        elif req.status_code == 200:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            with open(cached_path + ".tmp", "wb") as cached_file:
+                cached_file.write(req.content)
+
+            with open(meta_path + ".tmp", "w") as meta_file:
+                json.dump(
+                    {
+                        "etag": req.headers.get("ETag"),
+                        "last_modified": req.headers.get("Last-Modified"),
+                    },
+                    meta_file,
+                )
+
+            os.replace(cached_path + ".tmp", cached_path)
+            os.replace(meta_path + ".tmp", meta_path)
+        else:
+            raise RemoteError(
+                f"Unexpected status code while fetching remote index \
+'{index_url}', got {req.status_code}"
+            )
+
+        with gzip.open(cached_path, "rt") as index_file:
+            entries = index.split_index(index_file.read())
+
+        return {
+            filename: index.parse_fields(entry)
+            for filename, entry in entries.items()
+        }
+
+    def fetch_file(self, filename: str) -> Optional[bytes]:
+        """
+        Fetch a small file from the repository.
+
+        :param filename: name of the file, relative to the repository root
+        :returns: contents of the file, or None if it does not exist
+        :raises RemoteError: if the file cannot be fetched
+        """
+        file_url = f"{self.url}/{filename}"
+
+        try:
+            req = self.session.get(file_url, timeout=TIMEOUT)
+        except requests.RequestException as err:
+            raise RemoteError(f"Unable to fetch '{file_url}': {err}") from err
+
+        if req.status_code == 404:
+            return None
+
+        if req.status_code != 200:
+            raise RemoteError(
+                f"Unexpected status code while fetching '{file_url}', \
+got {req.status_code}"
+            )
+
+        return req.content
+
+    def download(
+        self,
+        filenames: Iterable[str],
+        remote_index: Dict[str, Dict[str, str]],
+        dest_dir: str,
+    ) -> List[str]:
+        """
+        Download package archives from the repository.
+
+        :param filenames: names of the archives to download
+        :param remote_index: index of the repository, as returned by
+            :meth:`fetch_index`
+        :param dest_dir: directory in which to save the archives
+        :returns: names of the archives that were successfully downloaded
+        """
+        engine = Mirror(
+            self.session,
+            temp_dir=os.path.join(paths.CACHE_DIR, "partial"),
+            jobs=self.jobs,
+        )
+        done = engine.fetch(
+            [
+                Transfer(
+                    url=f"{self.url}/{filename}",
+                    path=os.path.join(dest_dir, filename),
+                    sha256=remote_index[filename].get("SHA256sum"),
+                )
+                for filename in filenames
+            ]
+        )
+        metrics.DOWNLOADED_BYTES.inc(engine.transferred, kind="package")
+        return [os.path.basename(transfer.path) for transfer in done]
@@ -4,16 +4,25 @@
 Build the package repository.
 """
 
-from datetime import datetime
-import gzip
-import itertools
 import logging
 import os
-from typing import Dict, List, Optional
-import requests
-from .recipe import Recipe
-from .util import file_sha256, HTTP_DATE_FORMAT
-from . import paths, templating
+import tempfile
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from .builddb import BuildDatabase
+from .contents import CONTENTS_NAME, read_contents
+from .filecache import FileCache
+from .recipe import Package, Recipe
+from .remote import RemoteError, RemoteRepo
+from . import (
+    changes,
+    delta,
+    index,
+    listing,
+    paths,
+    profiling,
+    resolver,
+    trace,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -24,25 +33,114 @@ class Repo:
     def __init__(self) -> None:
         """Initialize the package repository."""
         self.recipes = {}
+        self.manifest: changes.Manifest = {}
 
-        for name in os.listdir(paths.RECIPE_DIR):
-            if name[0] != ".":
-                self.recipes[name] = Recipe.from_file(
-                    os.path.join(paths.RECIPE_DIR, name)
+        with trace.span("load recipes"), profiling.stage(
+            "load_recipes", paths.LOG_DIR
+        ):
+            for name in os.listdir(paths.RECIPE_DIR):
+                if name[0] != ".":
+                    self.recipes[name] = Recipe.from_file(
+                        os.path.join(paths.RECIPE_DIR, name)
+                    )
+
+    @trace.traced
+    @profiling.profiled(paths.LOG_DIR)
+    def find_changes(self, remote: Optional[str]) -> Set[str]:
+        """
+        Find recipes which changed since their last successful build.
+
+        The build manifest is read from the local repository, or from the
+        remote repository if there is no local manifest. Recipes which
+        depend on a changed recipe are selected as well.
+
+        :param remote: remote server from which to fetch the build manifest
+        :returns: names of the recipes which need to be rebuilt
+        """
+        logger.info("Scanning for changed recipes")
+        manifest_path = os.path.join(paths.REPO_DIR, changes.MANIFEST_NAME)
+
+        self.manifest = changes.load_manifest(manifest_path)
+
+        # The remote manifest is only kept in memory, it gets written to the
+        # local repository by :meth:`save_manifest` after the build
+        if not os.path.isfile(manifest_path) and remote is not None:
+            contents = RemoteRepo(remote).fetch_file(changes.MANIFEST_NAME)
+
+            if contents is not None:
+                try:
+                    self.manifest = changes.parse_manifest(contents.decode())
+                except ValueError as err:
+                    logger.warning(
+                        "Ignoring invalid remote build manifest: %s", err
+                    )
+
+        changed = changes.changed_recipes(
+            self.recipes.keys(), paths.RECIPE_DIR, self.manifest
+        )
+
+        for name in sorted(changed):
+            logger.info("Recipe %s changed since its last build", name)
+
+        return changes.with_reverse_dependencies(self.recipes, changed)
+
+    @trace.traced
+    @profiling.profiled(paths.LOG_DIR)
+    def save_manifest(self, built: Iterable[str]) -> None:
+        """
+        Record successfully built recipes in the build manifest.
+
+        Recipes which were never recorded are added to the manifest if
+        all their packages exist in the repo.
+
+        :param built: names of the recipes that were built
+        """
+        built = set(built)
+
+        for name in list(self.manifest):
+            if name not in self.recipes:
+                del self.manifest[name]
+
+        for recipe in self.recipes.values():
+            if recipe.name in built or (
+                recipe.name not in self.manifest
+                and all(
+                    os.path.isfile(
+                        os.path.join(paths.REPO_DIR, package.filename())
+                    )
+                    for package in recipe.packages.values()
                 )
+            ):
+                self.manifest[recipe.name] = changes.hash_recipe(
+                    os.path.join(paths.RECIPE_DIR, recipe.name)
+                )
+
+        changes.save_manifest(
+            os.path.join(paths.REPO_DIR, changes.MANIFEST_NAME),
+            self.manifest,
+        )
 
+    @trace.traced
+    @profiling.profiled(paths.LOG_DIR)
     def fetch_packages(
-        self, remote: Optional[str], fetch_missing: bool
+        self, remote: Optional[str], fetch_missing: bool, jobs: int = 8
     ) -> Dict[str, List[str]]:
         """
         Fetch missing packages.
 
         :param remote: remote server from which to check for existing packages
         :param fetch_missing: pass true to fetch missing packages from remote
+        :param jobs: maximum number of packages to fetch concurrently
         :returns: missing packages grouped by parent recipe
         """
         logger.info("Scanning for missing packages")
         missing: Dict[str, List[str]] = {}
+        to_fetch: Dict[str, Tuple[Recipe, Package]] = {}
+
+        remote_repo = RemoteRepo(remote, jobs) if remote is not None else None
+        remote_index = (
+            remote_repo.fetch_index() if remote_repo is not None else {}
+        )
 
         for recipe in self.recipes.values():
             missing[recipe.name] = []
@@ -54,83 +152,164 @@ class Repo:
                 if os.path.isfile(local_path):
                     continue
 
-                if remote is not None:
-                    remote_path = os.path.join(remote, filename)
-
+                if filename in remote_index:
                     if fetch_missing:
-                        req = requests.get(remote_path)
-
-                        if req.status_code == 200:
-                            with open(local_path, "wb") as local:
-                                for chunk in req.iter_content(chunk_size=1024):
-                                    local.write(chunk)
-
-                            last_modified = int(
-                                datetime.strptime(
-                                    req.headers["Last-Modified"],
-                                    HTTP_DATE_FORMAT,
-                                ).timestamp()
-                            )
-
-                            os.utime(local_path, (last_modified, last_modified))
-                            continue
-                    else:
-                        req = requests.head(remote_path)
-                        if req.status_code == 200:
-                            continue
+                        to_fetch[filename] = (recipe, package)
+                    continue
 
                 logger.info(
                     "Package %s (%s) is missing", package.pkgid(), recipe.name
                 )
                 missing[recipe.name].append(package.name)
 
+        if remote_repo is not None and to_fetch:
+            logger.info("Fetching %d package(s) from remote", len(to_fetch))
+            fetched = set(
+                remote_repo.download(
+                    to_fetch.keys(), remote_index, paths.REPO_DIR
+                )
+            )
+
+            for filename, (recipe, package) in to_fetch.items():
+                if filename not in fetched:
+                    logger.info(
+                        "Package %s (%s) is missing",
+                        package.pkgid(),
+                        recipe.name,
+                    )
+                    missing[recipe.name].append(package.name)
+
         return missing
 
-    def make_index(self) -> None:
-        """Generate index files for all the packages in the repo."""
+    @trace.traced
+    @profiling.profiled(paths.LOG_DIR)
+    def make_index(  # pylint: disable=no-self-use
+        self, database: Optional[BuildDatabase] = None
+    ) -> None:
+        """
+        Generate index files for all the packages in the repo.
+
+        :param database: database in which to record a snapshot of the index
+        """
         logger.info("Generating package index")
-        index_path = os.path.join(paths.REPO_DIR, "Packages")
-        index_gzip_path = os.path.join(paths.REPO_DIR, "Packages.gz")
+        index.make_index(
+            paths.REPO_DIR,
+            cache=FileCache(os.path.join(paths.CACHE_DIR, "repo.json")),
+            incremental=True,
+        )
 
-        with open(index_path, "w") as index_file:
-            with gzip.open(index_gzip_path, "wt") as index_gzip_file:
-                for recipe in self.recipes.values():
-                    for package in recipe.packages.values():
-                        filename = package.filename()
-                        local_path = os.path.join(paths.REPO_DIR, filename)
+        if database is not None:
+            with open(
+                os.path.join(paths.REPO_DIR, index.INDEX_NAME), "r"
+            ) as file:
+                database.record_index(
+                    index.parse_fields(entry)
+                    for entry in index.split_index(file.read()).values()
+                )
 
-                        if not os.path.isfile(local_path):
-                            continue
+    @trace.traced
+    @profiling.profiled(paths.LOG_DIR)
+    def make_deltas(  # pylint: disable=no-self-use
+        self, remote: Optional[str], max_size: int = delta.MAX_SIZE
+    ) -> None:
+        """
+        Generate deltas between versions of the packages in the repo.
 
-                        control = package.control_fields()
-                        control += f"""Filename: {filename}
-SHA256sum: {file_sha256(local_path)}
-Size: {os.path.getsize(local_path)}
+        Previous versions which are not in the repo are fetched from the
+        remote repository when needed, into a temporary directory.
 
-"""
+        :param remote: remote server from which to fetch previous versions
+        :param max_size: size in bytes above which packages get no delta
+        """
+        logger.info("Generating package deltas")
+        remote_repo = RemoteRepo(remote) if remote is not None else None
+        remote_index = None
 
-                        index_file.write(control)
-                        index_gzip_file.write(control)
+        if remote_repo is not None:
+            try:
+                remote_index = remote_repo.fetch_index()
+            except RemoteError as err:
+                logger.warning(
+                    "Only making deltas from local packages: %s", err
+                )
 
-    def make_listing(self) -> None:
-        """Generate the static web listing for packages in the repo."""
-        logger.info("Generating web listing")
+        os.makedirs(paths.CACHE_DIR, exist_ok=True)
+
+        # Fetched archives are renamed from the cache directory, so they
+        # must be saved on the same file system
+        with tempfile.TemporaryDirectory(dir=paths.CACHE_DIR) as old_dir:
+
+            def fetch(filenames: List[str]) -> Dict[str, str]:
+                if remote_repo is None or remote_index is None:
+                    return {}
 
-        by_section = lambda package: package.section
-        packages = [
-            package
-            for recipe in self.recipes.values()
-            for package in recipe.packages.values()
-        ]
-        sections = dict(
-            (section, list(group))
-            for section, group in itertools.groupby(
-                sorted(packages, key=by_section), key=by_section
+                return {
+                    filename: os.path.join(old_dir, filename)
+                    for filename in remote_repo.download(
+                        filenames, remote_index, old_dir
+                    )
+                }
+
+            delta.make_deltas(
+                paths.REPO_DIR,
+                decisions_path=os.path.join(paths.CACHE_DIR, "deltas.json"),
+                max_size=max_size,
+                remote_index=remote_index,
+                fetch=fetch,
+            )
+
+    @trace.traced
+    @profiling.profiled(paths.LOG_DIR)
+    def check_dependencies(  # pylint: disable=no-self-use
+        self, strict: bool = False
+    ) -> bool:
+        """
+        Check that all the packages in the repo can be installed.
+
+        Packages which install the same files without conflicting with each
+        other are also reported, using the contents index.
+
+        :param strict: pass true to count file collisions as problems,
+            instead of only warning about them
+        :returns: true if no dependency problem was found
+        """
+        logger.info("Checking package dependencies")
+
+        with open(os.path.join(paths.REPO_DIR, index.INDEX_NAME), "r") as file:
+            text = file.read()
+
+        problems = resolver.check_index(text)
+        contents_path = os.path.join(paths.REPO_DIR, CONTENTS_NAME)
+
+        if os.path.exists(contents_path):
+            problems += resolver.check_collisions(
+                text, read_contents(contents_path)
             )
-        )
 
-        listing_path = os.path.join(paths.REPO_DIR, "index.html")
-        template = templating.env.get_template("listing.html")
+        success = True
 
-        with open(listing_path, "w") as listing_file:
-            listing_file.write(template.render(sections=sections))
+        for problem in problems:
+            if problem.kind == "external":
+                logger.debug("%s", problem)
+            elif problem.kind == "collision" and not strict:
+                logger.warning("%s", problem)
+            else:
+                logger.error("%s", problem)
+                success = False
+
+        return success
+
+    @trace.traced
+    @profiling.profiled(paths.LOG_DIR)
+    def make_listing(self) -> None:  # pylint: disable=no-self-use
+        """
+        Generate the static web listing for packages in the repo.
+
+        The listing is generated from the package index, which must have
+        been made beforehand, and is only written again if it changed.
+        """
+        logger.info("Generating web listing")
+        listing.make_listing(
+            paths.REPO_DIR,
+            state_path=os.path.join(paths.CACHE_DIR, "listing.json"),
+        )
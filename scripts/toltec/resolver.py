@@ -0,0 +1,480 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Check that the packages of a repository can be installed.
+
+Dependencies and conflicts are parsed following the syntax described in
+<https://www.debian.org/doc/debian-policy/ch-relationships.html>. All the
+packages are loaded into indexed provider and reverse-dependency maps, which
+are then used to check every package in a single pass.
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+from functools import lru_cache
+import re
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from .index import parse_fields
+from .version import Version, InvalidVersionError
+
+# Parse a single relationship item, e.g. “foo (>= 1.0)”
+_RELATION = re.compile(
+    r"""
+    ^\s*(?P<name>[A-Za-z0-9][A-Za-z0-9.+-]*)\s*
+    (?:\(\s*(?P<op><<|<=|=|>=|>>|<|>)\s*(?P<version>[^\s)]+)\s*\))?
+    \s*$
+    """,
+    re.VERBOSE,
+)
+
+# Obsolete relation operators and their modern equivalents
+_OBSOLETE_OPS = {"<": "<=", ">": ">="}
+
+
+class RelationError(Exception):
+    """Raised when a relationship field cannot be parsed."""
+
+
+@dataclass(frozen=True)
+class Relation:
+    """Relationship to a package, optionally restricted to some versions."""
+
+    name: str
+    op: Optional[str] = None
+    version: Optional[Version] = None
+
+    def satisfied_by(self, version: Version) -> bool:
+        """Check whether a version of the related package is suitable."""
+        if self.op is None or self.version is None:
+            return True
+
+        if self.op == "<<":
+            return version < self.version
+
+        if self.op == "<=":
+            return version <= self.version
+
+        if self.op == "=":
+            return version == self.version
+
+        if self.op == ">=":
+            return version >= self.version
+
+        return version > self.version
+
+    def __str__(self) -> str:
+        if self.op is None:
+            return self.name
+
+        return f"{self.name} ({self.op} {self.version})"
+
+
+# Relationship satisfied by any one of several alternatives
+Alternatives = Tuple[Relation, ...]
+
+
+@lru_cache(maxsize=None)
+def parse_relation(item: str) -> Relation:
+    """
+    Parse a relationship item.
+
+    :param item: relationship, e.g. “foo (>= 1.0)”
+    :returns: parsed relationship
+    :raises RelationError: if the item is invalid
+    """
+    match = _RELATION.match(item)
+
+    if match is None:
+        raise RelationError(f"Invalid relationship '{item}'")
+
+    if match.group("op") is None:
+        return Relation(match.group("name"))
+
+    try:
+        version = Version.parse(match.group("version"))
+    except (InvalidVersionError, ValueError) as err:
+        raise RelationError(
+            f"Invalid version in relationship '{item}'"
+        ) from err
+
+    op = match.group("op")
+    return Relation(match.group("name"), _OBSOLETE_OPS.get(op, op), version)
+
+
+@lru_cache(maxsize=None)
+def _parse_alternatives(group: str) -> Alternatives:
+    """Parse a “|”-separated list of alternative relationships."""
+    return tuple(parse_relation(item) for item in group.split("|"))
+
+
+def parse_relations(items: Iterable[Optional[str]]) -> List[Alternatives]:
+    """
+    Parse a relationship field.
+
+    :param items: items of the field, each of which can contain several
+        comma-separated relationships and “|”-separated alternatives
+    :returns: parsed relationships
+    :raises RelationError: if an item is invalid
+    """
+    result = []
+
+    for item in items:
+        if not item:
+            continue
+
+        for group in item.split(","):
+            if group.strip():
+                result.append(_parse_alternatives(group))
+
+    return result
+
+
+@dataclass
+class PackageInfo:
+    """Relationship information about a package in a repository."""
+
+    name: str
+    version: Version
+    depends: List[Alternatives] = field(default_factory=list)
+    conflicts: List[Alternatives] = field(default_factory=list)
+    provides: List[Relation] = field(default_factory=list)
+
+    def pkgid(self) -> str:
+        """Get a human-readable identifier for this package."""
+        return f"{self.name} ({self.version})"
+
+
+@dataclass
+class Problem:
+    """Installability problem of a package."""
+
+    # Identifier of the affected package
+    package: str
+
+    # Either "invalid", "unsatisfiable", "conflict", "external" or
+    # "collision"
+    kind: str
+
+    # Human-readable description of the problem
+    message: str
+
+    def __str__(self) -> str:
+        return f"{self.package}: {self.message}"
+
+
+def package_from_fields(fields: Dict[str, str]) -> PackageInfo:
+    """
+    Load relationship information from a control file or index entry.
+
+    :param fields: parsed fields of the entry
+    :returns: package information
+    :raises RelationError: if a relationship field is invalid
+    """
+    return PackageInfo(
+        name=fields["Package"],
+        version=Version.parse(fields["Version"]),
+        depends=parse_relations([fields.get("Depends", "")]),
+        conflicts=parse_relations([fields.get("Conflicts", "")]),
+        provides=[
+            relation
+            for group in parse_relations([fields.get("Provides", "")])
+            for relation in group
+        ],
+    )
+
+
+class Resolver:
+    """Indexed view of the relationships between packages of a repository."""
+
+    def __init__(self, packages: Iterable[PackageInfo]) -> None:
+        """
+        Index a set of packages.
+
+        :param packages: packages to index
+        """
+        self.packages = list(packages)
+
+        # Packages able to satisfy a relationship on a given name,
+        # newest versions first
+        self.providers: Dict[str, List[PackageInfo]] = defaultdict(list)
+
+        # Names of packages which depend on a given name
+        self.reverse_depends: Dict[str, Set[str]] = defaultdict(set)
+
+        # Cached results of :meth:`candidates`
+        self._candidates: Dict[Relation, List[PackageInfo]] = {}
+
+        for package in self.packages:
+            self.providers[package.name].append(package)
+
+            for provided in package.provides:
+                self.providers[provided.name].append(package)
+
+            for group in package.depends:
+                for relation in group:
+                    self.reverse_depends[relation.name].add(package.name)
+
+        for providers in self.providers.values():
+            providers.sort(key=lambda package: package.version, reverse=True)
+
+    @staticmethod
+    def _satisfies(package: PackageInfo, relation: Relation) -> bool:
+        """
+        Check whether a package satisfies a relationship.
+
+        A package provided under another name only satisfies a versioned
+        relationship if it is provided with a suitable version.
+        """
+        if package.name == relation.name:
+            return relation.satisfied_by(package.version)
+
+        return any(
+            provided.name == relation.name
+            and (
+                relation.op is None
+                or (
+                    provided.op == "="
+                    and provided.version is not None
+                    and relation.satisfied_by(provided.version)
+                )
+            )
+            for provided in package.provides
+        )
+
+    def candidates(self, relation: Relation) -> List[PackageInfo]:
+        """Get the packages which satisfy a relationship, newest first."""
+        result = self._candidates.get(relation)
+
+        if result is None:
+            result = [
+                package
+                for package in self.providers.get(relation.name, [])
+                if self._satisfies(package, relation)
+            ]
+            self._candidates[relation] = result
+
+        return result
+
+    def _required_by(self) -> Dict[int, List[PackageInfo]]:
+        """
+        Build the reverse map of required dependencies.
+
+        A dependency without alternatives requires the newest suitable
+        provider to be installed, since it is the one that opkg picks.
+
+        :returns: packages which directly require each package,
+            keyed by the identity of the required package
+        """
+        result: Dict[int, List[PackageInfo]] = defaultdict(list)
+
+        for package in self.packages:
+            for group in package.depends:
+                if len(group) == 1:
+                    candidates = self.candidates(group[0])
+
+                    if candidates and candidates[0] is not package:
+                        result[id(candidates[0])].append(package)
+
+        return result
+
+    @staticmethod
+    def _ancestors(
+        package: PackageInfo,
+        required_by: Dict[int, List[PackageInfo]],
+        memo: Dict[int, Dict[int, PackageInfo]],
+    ) -> Dict[int, PackageInfo]:
+        """Get the packages whose installation requires a given package."""
+        if id(package) in memo:
+            return memo[id(package)]
+
+        result = {id(package): package}
+        stack = [package]
+
+        while stack:
+            for parent in required_by.get(id(stack.pop()), []):
+                if id(parent) not in result:
+                    result[id(parent)] = parent
+                    stack.append(parent)
+
+        memo[id(package)] = result
+        return result
+
+    def check(self) -> List[Problem]:
+        """
+        Check that every package of the repository can be installed.
+
+        Dependencies on names that no package provides are reported as
+        “external” problems, since they may be satisfied by the system or
+        by other repositories.
+
+        Conflicts are checked from each pair of conflicting packages,
+        walking the reverse dependencies of both packages to find the
+        packages which require them both. This is cheap since conflicts
+        are rare, whereas computing the full set of requirements of each
+        package would be quadratic on deep dependency chains.
+
+        :returns: list of problems, empty if all packages are installable
+        """
+        problems: Dict[int, List[Problem]] = defaultdict(list)
+
+        for package in self.packages:
+            for group in package.depends:
+                if any(self.candidates(relation) for relation in group):
+                    continue
+
+                alternatives = " | ".join(str(relation) for relation in group)
+
+                if all(
+                    relation.name not in self.providers for relation in group
+                ):
+                    problems[id(package)].append(
+                        Problem(
+                            package.pkgid(),
+                            "external",
+                            f"depends on {alternatives}, which is not \
+provided by the repository",
+                        )
+                    )
+                else:
+                    problems[id(package)].append(
+                        Problem(
+                            package.pkgid(),
+                            "unsatisfiable",
+                            f"depends on {alternatives}, which no version \
+in the repository satisfies",
+                        )
+                    )
+
+        required_by = self._required_by()
+        memo: Dict[int, Dict[int, PackageInfo]] = {}
+
+        for package in self.packages:
+            for group in package.conflicts:
+                for relation in group:
+                    for other in self.candidates(relation):
+                        if other is package:
+                            continue
+
+                        first = self._ancestors(package, required_by, memo)
+                        second = self._ancestors(other, required_by, memo)
+
+                        for key in first.keys() & second.keys():
+                            problems[key].append(
+                                Problem(
+                                    first[key].pkgid(),
+                                    "conflict",
+                                    f"requires both {package.pkgid()} and \
+{other.pkgid()}, which conflict with each other",
+                                )
+                            )
+
+        return [
+            problem
+            for package in self.packages
+            for problem in problems.get(id(package), [])
+        ]
+
+
+def _load_index(text: str) -> Tuple[List[PackageInfo], List[Problem]]:
+    """
+    Load relationship information from a package index.
+
+    :param text: contents of the index
+    :returns: packages of the index, and problems with invalid entries
+    """
+    packages = []
+    problems = []
+
+    for entry in text.split("\n\n"):
+        if not entry.strip():
+            continue
+
+        fields = parse_fields(entry)
+
+        try:
+            packages.append(package_from_fields(fields))
+        except (
+            RelationError,
+            InvalidVersionError,
+            KeyError,
+            ValueError,
+        ) as err:
+            problems.append(
+                Problem(fields.get("Filename", "?"), "invalid", str(err))
+            )
+
+    return packages, problems
+
+
+def check_index(text: str) -> List[Problem]:
+    """
+    Check that every package of a package index can be installed.
+
+    :param text: contents of the index
+    :returns: list of problems, empty if all packages are installable
+    """
+    packages, problems = _load_index(text)
+    return problems + Resolver(packages).check()
+
+
+def check_collisions(
+    text: str, owners: Mapping[str, List[str]]
+) -> List[Problem]:
+    """
+    Check that packages installing the same files conflict with each other.
+
+    opkg refuses to install a package which overwrites a file of another
+    installed package, so such packages must declare a conflict for opkg
+    to replace one with the other instead of failing halfway.
+
+    :param text: contents of the package index
+    :param owners: names of the packages which install each file, as read
+        from the contents index
+    :returns: one problem for each pair of colliding packages
+    """
+    packages, _ = _load_index(text)
+    resolver = Resolver(packages)
+    declared: Dict[Tuple[str, str], bool] = {}
+    collisions: Dict[Tuple[str, str], List[str]] = defaultdict(list)
+
+    def conflicts(name: str, other_name: str) -> bool:
+        """Check whether any version of a package conflicts with another."""
+        return any(
+            other.name == other_name
+            for package in resolver.providers.get(name, [])
+            if package.name == name
+            for group in package.conflicts
+            for relation in group
+            for other in resolver.candidates(relation)
+        )
+
+    for path, names in owners.items():
+        for index, first in enumerate(names):
+            for second in names[index + 1 :]:
+                pair = (first, second)
+
+                if pair not in declared:
+                    declared[pair] = conflicts(first, second) or conflicts(
+                        second, first
+                    )
+
+                if not declared[pair]:
+                    collisions[pair].append(path)
+
+    def pkgid(name: str) -> str:
+        """Get the identifier of the newest version of a package."""
+        for package in resolver.providers.get(name, []):
+            if package.name == name:
+                return package.pkgid()
+
+        return name
+
+    return [
+        Problem(
+            pkgid(first),
+            "collision",
+            f"installs {len(paths)} file(s) also installed by \
+{pkgid(second)}, such as /{paths[0]}, without conflicting with it",
+        )
+        for (first, second), paths in sorted(collisions.items())
+    ]
@@ -0,0 +1,231 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Measure and limit the resources used by build containers.
+
+While a build script runs in a container, the Docker stats API is sampled in
+a background thread to record the peak memory use, CPU time and block I/O of
+the container. Builds can also be given CPU and memory limits, which are
+enforced by Docker and used to pack parallel builds onto a host.
+"""
+
+from dataclasses import dataclass
+import json
+import logging
+import re
+import threading
+from typing import Any, Dict, Optional
+from docker.models.containers import Container
+
+logger = logging.getLogger(__name__)
+
+# Parse memory sizes such as “512m” or “4G”
+_SIZE_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", re.I)
+
+# Multiplier for each size unit
+_SIZE_UNITS = {
+    "": 1,
+    "k": 1024,
+    "m": 1024 * 1024,
+    "g": 1024 * 1024 * 1024,
+    "t": 1024 * 1024 * 1024 * 1024,
+}
+
+# Seconds to wait for the sampling thread to finish after a container exits
+_SAMPLER_JOIN_TIMEOUT = 5
+
+
+def parse_size(value: str) -> int:
+    """
+    Parse a memory size.
+
+    :param value: size in bytes, or with a k, m, g or t suffix
+    :returns: size in bytes
+    :raises ValueError: if the size is invalid
+    """
+    match = _SIZE_REGEX.match(value)
+
+    if match is None:
+        raise ValueError(f"Invalid size '{value}'")
+
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).lower()])
+
+
+@dataclass
+class ResourceLimits:
+    """Resources allowed to a build container."""
+
+    # Number of CPUs the container can use, possibly fractional
+    cpus: Optional[float] = None
+
+    # Maximum memory use of the container, in bytes
+    memory: Optional[int] = None
+
+
+def load_limits(path: str) -> Dict[str, ResourceLimits]:
+    """
+    Load per-recipe resource limits.
+
+    The limits file is a JSON object mapping recipe names to objects with
+    optional “cpus” and “memory” keys, for example
+    ``{"koreader": {"cpus": 4, "memory": "6g"}}``. Limits under the “*” key
+    apply to recipes that are not listed.
+
+    :param path: path to the limits file
+    :returns: limits for each recipe
+    :raises ValueError: if the file is invalid
+    """
+    with open(path, "r") as file:
+        data = json.load(file)
+
+    if not isinstance(data, dict):
+        raise ValueError("Resource limits must be a JSON object")
+
+    result = {}
+
+    for name, limits in data.items():
+        memory = limits.get("memory")
+        cpus = limits.get("cpus")
+        result[name] = ResourceLimits(
+            cpus=float(cpus) if cpus is not None else None,
+            memory=parse_size(str(memory)) if memory is not None else None,
+        )
+
+    return result
+
+
+def limits_for(
+    limits: Dict[str, ResourceLimits], recipe_name: str
+) -> ResourceLimits:
+    """Get the resource limits that apply to a recipe."""
+    return limits.get(recipe_name, limits.get("*", ResourceLimits()))
+
+
+@dataclass
+class ResourceUsage:
+    """Resources used by a build container."""
+
+    # Highest sampled memory use, in bytes
+    peak_memory: int = 0
+
+    # Total CPU time, in seconds
+    cpu_time: float = 0.0
+
+    # Bytes read from block devices
+    block_read: int = 0
+
+    # Bytes written to block devices
+    block_write: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"peak memory {self.peak_memory / 1024 / 1024:.0f} MiB, "
+            f"CPU time {self.cpu_time:.1f} s, "
+            f"read {self.block_read / 1024 / 1024:.0f} MiB, "
+            f"written {self.block_write / 1024 / 1024:.0f} MiB"
+        )
+
+
+class ResourceSampler(threading.Thread):
+    """Background thread sampling the resource use of a container."""
+
+    def __init__(self, container: Container, usage: ResourceUsage) -> None:
+        """
+        Prepare to sample a container.
+
+        :param container: running container to sample
+        :param usage: receives the sampled resource use
+        """
+        super().__init__(name=f"sampler-{container.short_id}", daemon=True)
+        self.container = container
+        self.usage = usage
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        try:
+            for sample in self.container.stats(stream=True, decode=True):
+                if self._stopped.is_set():
+                    break
+
+                self._update(sample)
+        except Exception as err:  # pylint:disable=broad-except
+            # Sampling is best-effort and must never fail a build
+            logger.debug("Unable to sample container resources: %s", err)
+
+    def _update(self, sample: Dict[str, Any]) -> None:
+        """Account for a sample returned by the stats API."""
+        memory = sample.get("memory_stats") or {}
+        self.usage.peak_memory = max(
+            self.usage.peak_memory,
+            memory.get("max_usage", 0),
+            memory.get("usage", 0),
+        )
+
+        cpu = (sample.get("cpu_stats") or {}).get("cpu_usage") or {}
+
+        if cpu.get("total_usage"):
+            self.usage.cpu_time = cpu["total_usage"] / 1e9
+
+        blkio = (sample.get("blkio_stats") or {}).get(
+            "io_service_bytes_recursive"
+        )
+
+        if blkio:
+            self.usage.block_read = sum(
+                entry["value"]
+                for entry in blkio
+                if entry.get("op", "").lower() == "read"
+            )
+            self.usage.block_write = sum(
+                entry["value"]
+                for entry in blkio
+                if entry.get("op", "").lower() == "write"
+            )
+
+    def stop(self) -> None:
+        """Stop sampling and wait for the last sample to be accounted."""
+        self._stopped.set()
+        self.join(_SAMPLER_JOIN_TIMEOUT)
+
+
+class ResourcePool:
+    """Memory available to concurrent builds on a host."""
+
+    def __init__(self, memory: Optional[int]) -> None:
+        """
+        Create a pool of resources.
+
+        :param memory: memory available to builds, in bytes (None for
+            unlimited)
+        """
+        self.memory = memory
+        self._used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, memory: int) -> None:
+        """
+        Wait until enough memory is available, then reserve it.
+
+        Requests for more memory than the whole pool are granted once no
+        other build is running.
+
+        :param memory: memory to reserve, in bytes
+        """
+        if self.memory is None:
+            return
+
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._used == 0
+                or self._used + memory <= (self.memory or 0)
+            )
+            self._used += memory
+
+    def release(self, memory: int) -> None:
+        """Release memory reserved with :meth:`acquire`."""
+        if self.memory is None:
+            return
+
+        with self._condition:
+            self._used -= memory
+            self._condition.notify_all()
@@ -0,0 +1,125 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Report and limit the size of packages.
+
+The device has a small root partition, so the installed and compressed
+sizes of each package are reported after it is archived and can be checked
+against per-package budgets.
+"""
+
+from dataclasses import dataclass
+import json
+import os
+from typing import Dict, List, Optional
+from .ipk import DataStats
+from .recipe import Package
+from .resources import parse_size
+
+
+@dataclass
+class SizeBudget:
+    """Maximum sizes allowed for a package."""
+
+    # Maximum total size of the installed files, in bytes
+    installed: Optional[int] = None
+
+    # Maximum size of the package archive, in bytes
+    archive: Optional[int] = None
+
+
+def load_budgets(path: str) -> Dict[str, SizeBudget]:
+    """
+    Load per-package size budgets.
+
+    The budgets file is a JSON object mapping package names to objects with
+    optional “installed” and “archive” keys, for example
+    ``{"koreader": {"installed": "200m", "archive": "60m"}}``. The budget
+    under the “*” key applies to packages that are not listed.
+
+    :param path: path to the budgets file
+    :returns: budget of each package
+    :raises ValueError: if the file is invalid
+    """
+    with open(path, "r") as file:
+        data = json.load(file)
+
+    if not isinstance(data, dict):
+        raise ValueError("Size budgets must be a JSON object")
+
+    result = {}
+
+    for name, budget in data.items():
+        installed = budget.get("installed")
+        archive = budget.get("archive")
+        result[name] = SizeBudget(
+            installed=(
+                parse_size(str(installed)) if installed is not None else None
+            ),
+            archive=parse_size(str(archive)) if archive is not None else None,
+        )
+
+    return result
+
+
+def budget_for(budgets: Dict[str, SizeBudget], package_name: str) -> SizeBudget:
+    """Get the size budget that applies to a package."""
+    return budgets.get(package_name, budgets.get("*", SizeBudget()))
+
+
+def check_budget(
+    budget: SizeBudget, stats: DataStats, archive_size: int
+) -> List[str]:
+    """
+    Check the sizes of a package against its budget.
+
+    :param budget: budget of the package
+    :param stats: sizes gathered while archiving the package
+    :param archive_size: size of the package archive, in bytes
+    :returns: description of each exceeded limit
+    """
+    problems = []
+
+    if budget.installed is not None and stats.installed_size > budget.installed:
+        problems.append(
+            f"installed size {stats.installed_size} bytes exceeds "
+            f"{budget.installed} bytes"
+        )
+
+    if budget.archive is not None and archive_size > budget.archive:
+        problems.append(
+            f"archive size {archive_size} bytes exceeds {budget.archive} bytes"
+        )
+
+    return problems
+
+
+def write_report(
+    path: str, package: Package, stats: DataStats, archive_size: int
+) -> None:
+    """
+    Write a report of the sizes of a package.
+
+    :param path: path to the report file
+    :param package: archived package
+    :param stats: sizes gathered while archiving the package
+    :param archive_size: size of the package archive, in bytes
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, "w") as file:
+        json.dump(
+            {
+                "package": package.name,
+                "version": str(package.version),
+                "archive_size": archive_size,
+                "data_size": stats.compressed_size,
+                "installed_size": stats.installed_size,
+                "largest_files": [
+                    {"path": name, "size": size}
+                    for size, name in stats.largest_files
+                ],
+            },
+            file,
+            indent=4,
+        )
@@ -0,0 +1,179 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Trace where build time goes.
+
+Code regions are instrumented with :func:`span`, which records nothing and
+costs a single global lookup until tracing is enabled with :func:`enable`.
+Recorded spans are written in the Chrome trace event format, which can be
+opened with <https://ui.perfetto.dev> or chrome://tracing, with one track
+for each thread.
+"""
+
+from contextlib import AbstractContextManager, nullcontext
+from functools import wraps
+import json
+import os
+import threading
+import time
+from types import TracebackType
+from typing import Any, Callable, Dict, List, Optional, Type, TypeVar
+
+_T = TypeVar("_T")
+
+# Context manager returned by :func:`span` when tracing is disabled
+_NULL_SPAN = nullcontext()
+
+
+class Tracer:
+    """Collect spans from all threads."""
+
+    def __init__(self) -> None:
+        """Start collecting spans."""
+        self.start = time.perf_counter_ns()
+        self.events: List[Dict[str, Any]] = []
+        self._tracks: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def track(self) -> int:
+        """Get the identifier of the track of the current thread."""
+        ident = threading.get_ident()
+        track = self._tracks.get(ident)
+
+        if track is None:
+            with self._lock:
+                track = len(self._tracks)
+                self._tracks[ident] = track
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": track,
+                        "args": {"name": threading.current_thread().name},
+                    }
+                )
+
+        return track
+
+    def add(  # pylint: disable=too-many-arguments
+        self,
+        name: str,
+        start: int,
+        end: int,
+        track: int,
+        args: Dict[str, Any],
+    ) -> None:
+        """
+        Record a finished span.
+
+        :param name: name of the span
+        :param start: start time of the span, in nanoseconds
+        :param end: end time of the span, in nanoseconds
+        :param track: track on which the span happened
+        :param args: additional information to attach to the span
+        """
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.start) / 1000,
+            "dur": (end - start) / 1000,
+            "pid": os.getpid(),
+            "tid": track,
+        }
+
+        if args:
+            event["args"] = args
+
+        with self._lock:
+            self.events.append(event)
+
+    def write(self, path: str) -> None:
+        """Write the collected spans to a trace file."""
+        with self._lock:
+            events = list(self.events)
+
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events}, file)
+
+
+class _Span(AbstractContextManager):
+    """Span of time recorded by a tracer."""
+
+    def __init__(self, tracer: Tracer, name: str, args: Dict[str, Any]) -> None:
+        super().__init__()
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+
+        self.tracer.add(
+            self.name,
+            self.start,
+            time.perf_counter_ns(),
+            self.tracer.track(),
+            self.args,
+        )
+
+
+# Tracer in use, if tracing is enabled
+_tracer: Optional[Tracer] = None  # pylint:disable=invalid-name
+
+
+def enable() -> Tracer:
+    """Start tracing spans."""
+    global _tracer  # pylint:disable=global-statement,invalid-name
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable() -> None:
+    """Stop tracing spans."""
+    global _tracer  # pylint:disable=global-statement,invalid-name
+    _tracer = None
+
+
+def span(name: str, **args: Any) -> AbstractContextManager:
+    """
+    Record the time spent in a block of code.
+
+    :param name: name of the span
+    :param args: additional information to attach to the span
+    :returns: context manager delimiting the span
+    """
+    tracer = _tracer
+
+    if tracer is None:
+        return _NULL_SPAN
+
+    return _Span(tracer, name, args)
+
+
+def traced(function: Callable[..., _T]) -> Callable[..., _T]:
+    """Record the time spent in each call to a function."""
+
+    @wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> _T:
+        with span(function.__qualname__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def write(path: str) -> None:
+    """Write all the spans traced so far to a trace file, if tracing."""
+    if _tracer is not None:
+        _tracer.write(path)
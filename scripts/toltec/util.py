@@ -10,7 +10,7 @@ import itertools
 import os
 import shutil
 import sys
-from typing import Any, Callable, Dict, IO, List, Optional
+from typing import Any, Callable, Dict, IO, List, Optional, Tuple
 import zipfile
 import tarfile
 
@@ -223,3 +223,20 @@ def list_tree(root: str) -> List[str]:
             result.append(os.path.join(directory, file))
 
     return sorted(result)
+
+
+def tree_state(root: str) -> Dict[str, Tuple[int, int, int]]:
+    """
+    Get the mode, size and modification time of everything under a folder.
+
+    :param root: root folder to start from
+    :returns: state of each item under the root folder, which changes when
+        items are created, removed, moved or written to
+    """
+    result = {}
+
+    for path in list_tree(root):
+        stat = os.lstat(path)
+        result[path] = (stat.st_mode, stat.st_size, stat.st_mtime_ns)
+
+    return result
@@ -2,23 +2,78 @@
 # SPDX-License-Identifier: MIT
 """Work with Debian-style package versions."""
 
+from functools import total_ordering
 import re
-from typing import Optional
+from typing import Dict, List, Optional, Tuple, Union
 
 # Characters permitted in the upstream version part of a version number
 _VERSION_CHARS = re.compile("^[A-Za-z0-9.+~-]+$")
 
+# Split a version part into alternating non-digit and digit runs
+_VERSION_RUNS = re.compile("([^0-9]*)([0-9]*)")
+
+# Versions which were already parsed, keyed by their original string
+_interned: Dict[str, "Version"] = {}
+
+# Key used for comparing a version part
+PartKey = Tuple[Union[int, Tuple[int, ...]], ...]
+
+# Key used for comparing versions
+VersionKey = Tuple[int, PartKey, PartKey]
+
+
+def _char_order(char: str) -> int:
+    """Get the weight of a non-digit character in comparisons."""
+    if char == "~":
+        return -1
+
+    if char.isalpha():
+        return ord(char)
+
+    return ord(char) + 256
+
+
+def _part_key(part: str) -> PartKey:
+    """
+    Compute the comparison key of an upstream version or revision.
+
+    The part is split into alternating runs of non-digits and digits.
+    Non-digit runs are turned into tuples of character weights terminated by
+    a zero, which sorts the end of a run after any tilde and before any other
+    character. Digit runs are compared numerically. A final zero tuple stands
+    for the end of the part, which compares to further runs of the other part
+    the same way.
+    """
+    key: List[Union[int, Tuple[int, ...]]] = []
+
+    for match in _VERSION_RUNS.finditer(part):
+        letters, digits = match.groups()
+
+        if not letters and not digits:
+            continue
+
+        key.append(tuple(_char_order(char) for char in letters) + (0,))
+        key.append(int(digits) if digits else 0)
+
+    key.append((0,))
+    return tuple(key)
+
 
 class InvalidVersionError(Exception):
     """Raised when construction of an invalid version is attempted."""
 
 
+@total_ordering
 class Version:
     """
-    Parse package versions.
+    Parse and compare package versions.
 
     See <https://www.debian.org/doc/debian-policy/ch-controlfields.html#s-f-version>
     for details about the format and the comparison rules.
+
+    Versions are immutable. Their comparison key is computed once, when they
+    are created, and versions parsed from the same string share the same
+    instance.
     """
 
     def __init__(self, epoch: int, upstream: str, revision: str):
@@ -33,10 +88,21 @@ class Version:
             raise InvalidVersionError("Invalid chars in revision")
 
         self._original: Optional[str] = None
+        self.key: VersionKey = (
+            epoch,
+            _part_key(upstream),
+            _part_key(revision),
+        )
+        self._hash = hash(self.key)
 
     @staticmethod
     def parse(version: str) -> "Version":
         """Parse a version number."""
+        interned = _interned.get(version)
+
+        if interned is not None:
+            return interned
+
         original = version
         colon = version.find(":")
 
@@ -58,8 +124,24 @@ class Version:
 
         result = Version(epoch, upstream, revision)
         result._original = original  # pylint:disable=protected-access
+        _interned[original] = result
         return result
 
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+
+        return self.key == other.key
+
+    def __lt__(self, other: "Version") -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+
+        return self.key < other.key
+
+    def __hash__(self) -> int:
+        return self._hash
+
     def __str__(self) -> str:
         if self._original is not None:
             # Use the original parsed version string